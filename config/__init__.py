@@ -16,6 +16,37 @@
 # Do not use environment variables. We use a secrets file and load our own dictionary:
 #
 
+#
+# The file is read on first lookup rather than at import, so importing a module that uses settings does not
+# touch the disk until a route actually needs a value:
+#
+
+from collections.abc import Mapping
+import threading
 from .build_config import read_dict
 
-settings = read_dict(None)
+
+class LazySettings(Mapping):
+    def __init__(self, file_name=None):
+        self._file_name = file_name
+        self._values = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    self._values = read_dict(self._file_name)
+        return self._values
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+settings = LazySettings(None)
@@ -0,0 +1,268 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from google_helpers.limiter import api_call
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# Lease-based lock so a cron run that outlasts its interval is not joined by a second one working on the same
+# blobs and buckets. A lease is a small record {holder, expires, fencing_token} kept in a register that only
+# supports compare-and-swap on a generation number: GCS objects written with if_generation_match in App Engine,
+# a lock-protected local file for tests and local runs. Whoever holds an unexpired lease owns the work; a
+# heartbeat thread keeps renewing it. A holder whose renewals have failed for ttl_secs counts its own lease as
+# lost, since by then somebody else may have taken it over. The fencing token goes up every time the lease
+# changes hands; TaskRun tags its checkpoints with it and refuses to overwrite one written under a newer token.
+#
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class GcsLeaseBackend(object):
+    def __init__(self, storage_client, bucket_name, prefix='idc-cron-locks'):
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _key(self, name):
+        return '{0}/{1}.json'.format(self.prefix, name)
+
+    def read(self, name):
+        """
+        Returns (generation, record); generation 0 means no record yet
+        """
+        from google.cloud.exceptions import NotFound
+        with api_call('storage'):
+            blob = self.bucket.get_blob(self._key(name))
+        if blob is None:
+            return 0, None
+        try:
+            with api_call('storage'):
+                data = blob.download_as_bytes(if_generation_match=blob.generation)
+        except NotFound:
+            return 0, None
+        except Exception as e:
+            if getattr(e, 'code', None) == 412:
+                # Changed under us; report it as held by somebody else and let the caller retry later:
+                return blob.generation, {'holder': None, 'expires': float('inf'), 'fencing_token': 0}
+            raise
+        return blob.generation, json.loads(data.decode('utf-8'))
+
+    def write(self, name, record, expected_generation):
+        """
+        Returns the new generation, or None if the register changed since expected_generation
+        """
+        blob = self.bucket.blob(self._key(name))
+        try:
+            with api_call('storage'):
+                blob.upload_from_string(json.dumps(record), content_type='application/json',
+                                        if_generation_match=expected_generation)
+        except Exception as e:
+            if getattr(e, 'code', None) == 412:
+                return None
+            raise
+        return blob.generation
+
+
+class LocalFileLeaseBackend(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, '{0}.json'.format(name))
+
+    def _read_file(self, name):
+        try:
+            with open(self._path(name), 'r') as f:
+                saved = json.load(f)
+            return saved['generation'], saved['record']
+        except FileNotFoundError:
+            return 0, None
+
+    def read(self, name):
+        with self._locked(name):
+            return self._read_file(name)
+
+    def write(self, name, record, expected_generation):
+        with self._locked(name):
+            generation, _ = self._read_file(name)
+            if generation != expected_generation:
+                return None
+            generation += 1
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'generation': generation, 'record': record}, f)
+            os.replace(tmp_path, self._path(name))
+            return generation
+
+    def _locked(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        return _FileLock(self._path(name) + '.lock', self._lock)
+
+
+class _FileLock(object):
+    """
+    Thread lock plus an flock, so separate processes sharing the directory also take turns
+    """
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+        self.thread_lock.acquire()
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.thread_lock.release()
+        return False
+
+
+class Lease(object):
+    def __init__(self, backend, name, ttl_secs, holder=None, clock=time.time):
+        self.backend = backend
+        self.name = name
+        self.ttl_secs = ttl_secs
+        self.holder = holder or '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._clock = clock
+        self._generation = None
+        self._renewed_at = None
+        self._lost = False
+        self.fencing_token = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def lost(self):
+        """
+        True once a renewal was refused, or once no renewal has succeeded for ttl_secs
+        """
+        if self._lost:
+            return True
+        return self._generation is not None and self._clock() >= self._renewed_at + self.ttl_secs
+
+    @property
+    def held(self):
+        return self._generation is not None and not self.lost
+
+    def acquire(self):
+        generation, record = self.backend.read(self.name)
+        now = self._clock()
+        if record is not None and record.get('holder') and record['expires'] > now:
+            logger.info('Lease {0} is held by {1} for another {2:.0f} secs'.format(self.name, record['holder'],
+                                                                                  record['expires'] - now))
+            return False
+        last_token = record.get('fencing_token', 0) if record is not None else 0
+        new_record = {'holder': self.holder, 'expires': now + self.ttl_secs,
+                      'fencing_token': last_token + 1}
+        new_generation = self.backend.write(self.name, new_record, generation)
+        if new_generation is None:
+            return False
+        self._generation = new_generation
+        self._renewed_at = now
+        self.fencing_token = new_record['fencing_token']
+        self._lost = False
+        return True
+
+    def renew(self):
+        if not self.held:
+            raise LeaseLostError(self.name)
+        now = self._clock()
+        record = {'holder': self.holder, 'expires': now + self.ttl_secs, 'fencing_token': self.fencing_token}
+        new_generation = self.backend.write(self.name, record, self._generation)
+        if new_generation is None:
+            self._lost = True
+            raise LeaseLostError(self.name)
+        self._generation = new_generation
+        self._renewed_at = now
+
+    def release(self):
+        self._stop_heartbeat()
+        if not self.held:
+            return
+        record = {'holder': None, 'expires': 0, 'fencing_token': self.fencing_token}
+        if self.backend.write(self.name, record, self._generation) is None:
+            logger.warning('Lease {0} changed hands before release'.format(self.name))
+        self._generation = None
+
+    def check(self):
+        if not self.held:
+            raise LeaseLostError(self.name)
+
+    def start_heartbeat(self, interval=None):
+        interval = interval if interval is not None else self.ttl_secs / 3.0
+        self._stop.clear()
+
+        def beat():
+            while not self._stop.wait(interval):
+                try:
+                    self.renew()
+                except LeaseLostError:
+                    logger.error('Lost lease {0}'.format(self.name))
+                    return
+                except Exception as e:
+                    # A failed renewal is not fatal until the lease actually expires:
+                    logger.warning('Lease {0} renewal failed: {1}'.format(self.name, str(e)))
+
+        self._heartbeat = threading.Thread(target=beat, name='lease-{0}'.format(self.name), daemon=True)
+        self._heartbeat.start()
+
+    def _stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def __enter__(self):
+        if self.acquire():
+            self.start_heartbeat()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def get_lease(name):
+    from config import settings
+    ttl_secs = float(settings.get('TASK_LOCK_TTL_SECS', 120))
+    bucket_name = settings.get('TASK_LOCK_BUCKET', settings.get('TASK_STATE_BUCKET'))
+    if bucket_name:
+        from google.cloud import storage
+        storage_client = storage.Client(project=settings['DEPLOY_PROJECT_ID'])
+        backend = GcsLeaseBackend(storage_client, bucket_name)
+    else:
+        directory = settings.get('TASK_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'idc-cron-locks'))
+        backend = LocalFileLeaseBackend(directory)
+    return Lease(backend, name, ttl_secs)
@@ -0,0 +1,278 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from http.client import HTTPException
+from google_helpers.metrics import metrics
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# Shared, per-service concurrency limiting for calls into Google APIs. Each service (storage, bigquery,
+# cloudresourcemanager, ...) gets one AdaptiveLimiter that grows the number of calls allowed in flight
+# additively while calls are fast and succeed, and cuts it multiplicatively when we see throttling (429),
+# backend errors (5xx) or latency blowing past the target. In front of that sits a CircuitBreaker, so when
+# a service is clearly unhealthy we fail immediately instead of queueing up serial retries behind it.
+#
+# Defaults can be overridden per service in the config file, e.g.:
+#   API_LIMITER_MAX_CONCURRENCY=32
+#   API_LIMITER_STORAGE_MAX_CONCURRENCY=64
+#
+
+DEFAULTS = {
+    'INITIAL_CONCURRENCY': 4,
+    'MIN_CONCURRENCY': 1,
+    'MAX_CONCURRENCY': 32,
+    'LATENCY_TARGET_SECS': 10.0,
+    'BACKOFF_FACTOR': 0.5,
+    'BREAKER_FAILURE_THRESHOLD': 5,
+    'BREAKER_RESET_SECS': 30.0,
+}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a call while the breaker for a service is open
+    """
+    def __init__(self, service, retry_in):
+        super().__init__('Circuit open for {0}: retry in {1:.1f} secs'.format(service, retry_in))
+        self.service = service
+        self.retry_in = retry_in
+
+
+#
+# Sort an outcome into success, throttled (429), server error (5xx) or a caller error that says nothing
+# about the health of the service (e.g. a 404 or 403):
+#
+
+SUCCESS = 'success'
+THROTTLED = 'throttled'
+SERVER_ERROR = 'server_error'
+CLIENT_ERROR = 'client_error'
+
+
+def classify_exception(e):
+    status = None
+    resp = getattr(e, 'resp', None)
+    if resp is not None:
+        status = getattr(resp, 'status', None)
+    if status is None:
+        status = getattr(e, 'code', None)
+    if status is None and isinstance(e, (HTTPException, ConnectionError, TimeoutError)):
+        return SERVER_ERROR
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return CLIENT_ERROR
+    if status == 429:
+        return THROTTLED
+    if status >= 500:
+        return SERVER_ERROR
+    return CLIENT_ERROR
+
+
+class CircuitBreaker(object):
+    """
+    Closed -> open after N consecutive unhealthy outcomes; open -> half-open after a cool-down, where one
+    probe call is let through. A healthy probe closes the breaker, an unhealthy one opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, service, failure_threshold, reset_secs, clock=time.monotonic):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_out = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def before_call(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                waited = self._clock() - self._opened_at
+                if waited < self.reset_secs:
+                    metrics.inc('api_calls', service=self.service, outcome='circuit_open')
+                    raise CircuitOpenError(self.service, self.reset_secs - waited)
+                self._state = self.HALF_OPEN
+                self._probe_out = False
+            if self._state == self.HALF_OPEN:
+                if self._probe_out:
+                    raise CircuitOpenError(self.service, self.reset_secs)
+                self._probe_out = True
+
+    def after_call(self, outcome):
+        with self._lock:
+            if outcome in (THROTTLED, SERVER_ERROR):
+                self._failures += 1
+                if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                    if self._state != self.OPEN:
+                        logger.warning('Circuit breaker for {0} opened after {1} failures'.format(self.service,
+                                                                                            self._failures))
+                    self._state = self.OPEN
+                    self._opened_at = self._clock()
+            else:
+                if self._state != self.CLOSED:
+                    logger.info('Circuit breaker for {0} closed'.format(self.service))
+                self._state = self.CLOSED
+                self._failures = 0
+            self._probe_out = False
+
+
+class AdaptiveLimiter(object):
+    """
+    AIMD concurrency limit for one service. The limit is a float so the additive increase can be spread
+    over a full window of calls (limit += 1 / limit per healthy call); at most one multiplicative decrease
+    is applied per window so a burst of errors from calls already in flight does not collapse it to the floor.
+    """
+    def __init__(self, service, initial, minimum, maximum, latency_target, backoff, clock=time.monotonic):
+        self.service = service
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._clock = clock
+        self._limit = float(max(minimum, min(initial, maximum)))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        with self._cond:
+            return int(self._limit)
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return self._in_flight
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, outcome, latency):
+        with self._cond:
+            self._in_flight -= 1
+            if outcome in (THROTTLED, SERVER_ERROR) or latency > self.latency_target:
+                now = self._clock()
+                if now - self._last_decrease >= latency:
+                    self._limit = max(float(self.minimum), self._limit * self.backoff)
+                    self._last_decrease = now
+            elif outcome == SUCCESS:
+                self._limit = min(float(self.maximum), self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+
+class ServiceGuard(object):
+    """
+    The breaker and limiter for one service, used as a context manager around each API call
+    """
+    def __init__(self, service, limiter, breaker):
+        self.service = service
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @contextmanager
+    def __call__(self):
+        self.breaker.before_call()
+        self.limiter.acquire()
+        start = time.monotonic()
+        outcome = SUCCESS
+        try:
+            yield self
+        except Exception as e:
+            outcome = classify_exception(e)
+            raise
+        finally:
+            latency = time.monotonic() - start
+            self.limiter.release(outcome, latency)
+            self.breaker.after_call(outcome)
+            metrics.inc('api_calls', service=self.service, outcome=outcome)
+            metrics.observe('api_call_seconds', latency, service=self.service)
+
+    def call(self, func, *args, **kwargs):
+        with self():
+            return func(*args, **kwargs)
+
+
+#
+# One guard per service for the whole process, so every task module shares the same budget:
+#
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def _setting(service, key):
+    # Imported here so the helpers can be used without a config file present:
+    try:
+        from config import settings
+        specific = settings.get('API_LIMITER_{0}_{1}'.format(service.upper(), key))
+        general = settings.get('API_LIMITER_{0}'.format(key))
+    except Exception:
+        specific = general = None
+    value = specific if specific is not None else general
+    return type(DEFAULTS[key])(value) if value is not None else DEFAULTS[key]
+
+
+def get_guard(service):
+    with _guards_lock:
+        guard = _guards.get(service)
+        if guard is None:
+            limiter = AdaptiveLimiter(service,
+                                      _setting(service, 'INITIAL_CONCURRENCY'),
+                                      _setting(service, 'MIN_CONCURRENCY'),
+                                      _setting(service, 'MAX_CONCURRENCY'),
+                                      _setting(service, 'LATENCY_TARGET_SECS'),
+                                      _setting(service, 'BACKOFF_FACTOR'))
+            breaker = CircuitBreaker(service,
+                                     _setting(service, 'BREAKER_FAILURE_THRESHOLD'),
+                                     _setting(service, 'BREAKER_RESET_SECS'))
+            guard = ServiceGuard(service, limiter, breaker)
+            _guards[service] = guard
+        return guard
+
+
+def api_call(service):
+    """
+    Context manager form: with api_call('storage'): blob.delete()
+    """
+    return get_guard(service)()
+
+
+def limiter_status():
+    with _guards_lock:
+        guards = list(_guards.values())
+    return {guard.service: {'limit': guard.limiter.limit,
+                            'in_flight': guard.limiter.in_flight,
+                            'breaker': guard.breaker.state} for guard in guards}
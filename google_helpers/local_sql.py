@@ -0,0 +1,226 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import re
+import time
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# A local stand-in for BigQuery, so the SQL our tasks generate can be run and timed on a laptop against
+# Parquet or CSV fixtures instead of paying for a scan. Pass a LocalSqlClient where a bigquery.Client would go
+# (generic_bq_harness checks for it), after registering the input tables:
+#
+#   client = LocalSqlClient(project='local')
+#   client.register_fixture('local.raw.proxy_logs', 'fixtures/proxy_logs.parquet')
+#
+# Queries run in DuckDB (an optional dependency, imported on first use) after translate_sql has turned the
+# BigQuery Standard SQL we use into DuckDB's dialect:
+#   - `project.dataset.table` names become quoted identifiers, and so do query destinations
+#   - "double quoted" strings become 'single quoted' strings; r'raw' strings become plain ones
+#   - REGEXP_CONTAINS -> regexp_matches; REGEXP_EXTRACT -> regexp_extract on the first capture group,
+#     with no match giving NULL as in BigQuery
+#   - CAST(x AS INT64 / FLOAT64 / BOOL / BYTES / NUMERIC) use the DuckDB type names
+# That covers the pipeline SQL in this repo; it is not a general BigQuery emulator.
+#
+
+TYPE_NAMES = {
+    'INT64': 'BIGINT',
+    'FLOAT64': 'DOUBLE',
+    'BOOL': 'BOOLEAN',
+    'BYTES': 'BLOB',
+    'NUMERIC': 'DECIMAL(38, 9)',
+}
+
+_TOKEN_RE = re.compile(r'''
+    (?P<backtick>`[^`]*`)
+  | (?P<raw>[rR](?:'[^']*'|"[^"]*"))
+  | (?P<string>'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")
+  | (?P<comment>--[^\n]*|\#[^\n]*)
+  | (?P<word>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<space>\s+)
+  | (?P<other>.)
+''', re.VERBOSE | re.DOTALL)
+
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', "'": "'", '"': '"'}
+
+
+def _quote_string(value):
+    return "'{0}'".format(value.replace("'", "''"))
+
+
+def _unescape(body):
+    return re.sub(r'\\(.)', lambda m: _ESCAPES.get(m.group(1), m.group(1)), body)
+
+
+def _tokens(sql):
+    """
+    (kind, text) pairs, with strings and names already in DuckDB form
+    """
+    out = []
+    for match in _TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'backtick':
+            out.append(('name', '"{0}"'.format(text[1:-1].replace('"', '""'))))
+        elif kind == 'raw':
+            out.append(('string', _quote_string(text[2:-1])))
+        elif kind == 'string':
+            out.append(('string', _quote_string(_unescape(text[1:-1]))))
+        elif kind != 'comment':
+            out.append((kind, text))
+    return _rename_cast_types(out)
+
+
+def _significant(tokens, index, step):
+    index += step
+    while 0 <= index < len(tokens) and tokens[index][0] == 'space':
+        index += step
+    return tokens[index][1] if 0 <= index < len(tokens) else None
+
+
+def _rename_cast_types(tokens):
+    """
+    Only in CAST(x AS type): a column aliased "AS bytes" has to stay as it is
+    """
+    out = []
+    for index, (kind, text) in enumerate(tokens):
+        if kind == 'word' and text.upper() in TYPE_NAMES:
+            previous = _significant(tokens, index, -1)
+            if previous is not None and previous.upper() == 'AS' and _significant(tokens, index, 1) == ')':
+                text = TYPE_NAMES[text.upper()]
+        out.append((kind, text))
+    return out
+
+
+def _call_args(tokens, open_index):
+    """
+    Split the arguments of the call whose '(' is at open_index. Returns (args, index of the closing ')')
+    """
+    depth = 0
+    args = [[]]
+    for index in range(open_index, len(tokens)):
+        kind, text = tokens[index]
+        if text == '(':
+            depth += 1
+            if depth == 1:
+                continue
+        elif text == ')':
+            depth -= 1
+            if depth == 0:
+                return args, index
+        elif text == ',' and depth == 1:
+            args.append([])
+            continue
+        args[-1].append((kind, text))
+    raise ValueError('Unbalanced parentheses in SQL')
+
+
+def _join(tokens):
+    return ''.join(text for _, text in tokens)
+
+
+def _rewrite_calls(tokens):
+    out = []
+    index = 0
+    while index < len(tokens):
+        kind, text = tokens[index]
+        name = text.upper() if kind == 'word' else None
+        if name in ('REGEXP_CONTAINS', 'REGEXP_EXTRACT'):
+            open_index = index + 1
+            while open_index < len(tokens) and tokens[open_index][0] == 'space':
+                open_index += 1
+            if open_index < len(tokens) and tokens[open_index][1] == '(':
+                args, close_index = _call_args(tokens, open_index)
+                args = [_join(_rewrite_calls(arg)).strip() for arg in args]
+                if name == 'REGEXP_CONTAINS':
+                    call = 'regexp_matches({0})'.format(', '.join(args))
+                else:
+                    group = 1 if re.search(r'(?<!\\)\((?!\?)', args[1]) else 0
+                    call = "NULLIF(regexp_extract({0}, {1}, {2}), '')".format(args[0], args[1], group)
+                out.append(('call', call))
+                index = close_index + 1
+                continue
+        out.append((kind, text))
+        index += 1
+    return out
+
+
+def translate_sql(sql):
+    return _join(_rewrite_calls(_tokens(sql)))
+
+
+def local_table_name(full_table_name):
+    return '"{0}"'.format(full_table_name.replace('"', '""'))
+
+
+class LocalSqlClient(object):
+    """
+    Runs query jobs in an embedded DuckDB database. project plays the part of the client's default project
+    when a destination is given as dataset and table.
+    """
+    def __init__(self, project='local', database=':memory:'):
+        import duckdb
+        self.project = project
+        self.connection = duckdb.connect(database)
+
+    def register_fixture(self, full_table_name, path):
+        """
+        Make a Parquet or CSV file readable as `full_table_name`
+        """
+        if path.endswith('.parquet'):
+            reader = 'read_parquet({0})'.format(_quote_string(path))
+        else:
+            reader = 'read_csv_auto({0}, header=true)'.format(_quote_string(path))
+        self.connection.execute('CREATE OR REPLACE VIEW {0} AS SELECT * FROM {1}'.format(
+            local_table_name(full_table_name), reader))
+
+    def register_dataframe(self, full_table_name, df):
+        self.connection.register('_fixture_frame', df)
+        self.connection.execute('CREATE OR REPLACE TABLE {0} AS SELECT * FROM _fixture_frame'.format(
+            local_table_name(full_table_name)))
+        self.connection.unregister('_fixture_frame')
+
+    def table_exists(self, full_table_name):
+        rows = self.connection.execute('SELECT 1 FROM information_schema.tables WHERE table_name = ?',
+                                       [full_table_name]).fetchall()
+        return len(rows) > 0
+
+    def run_query(self, sql, target_dataset, dest_table, write_disposition):
+        """
+        Run BigQuery SQL into project.target_dataset.dest_table. Returns the elapsed seconds
+        """
+        full_table_name = '{0}.{1}.{2}'.format(self.project, target_dataset, dest_table)
+        destination = local_table_name(full_table_name)
+        query = translate_sql(sql)
+        start = time.perf_counter()
+        if write_disposition == 'WRITE_APPEND' and self.table_exists(full_table_name):
+            self.connection.execute('INSERT INTO {0} {1}'.format(destination, query))
+        else:
+            if write_disposition == 'WRITE_EMPTY' and self.table_exists(full_table_name):
+                count = self.connection.execute('SELECT COUNT(*) FROM {0}'.format(destination)).fetchone()[0]
+                if count:
+                    raise ValueError('{0} is not empty'.format(full_table_name))
+            self.connection.execute('CREATE OR REPLACE TABLE {0} AS {1}'.format(destination, query))
+        elapsed = time.perf_counter() - start
+        logger.info('Local query into {0}: {1:.3f} secs'.format(full_table_name, elapsed))
+        return elapsed
+
+    def to_dataframe(self, full_table_name):
+        return self.connection.execute('SELECT * FROM {0}'.format(local_table_name(full_table_name))).df()
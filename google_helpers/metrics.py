@@ -0,0 +1,215 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import bisect
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# Lightweight in-process metrics: counters, duration histograms and timed spans, all labelled (project, tag,
+# stage, ...). Values accumulate for the life of the instance, and /tasks/metrics renders them in Prometheus text
+# format, where counters are expected to be cumulative.
+#
+# Runs can overlap on one instance (a cron request next to a follow-up), so what a run did is not the change in
+# the global values. main.py runs each task in run_scope(), a registry of its own that also receives everything
+# recorded from the thread running it, or from work handed to a pool through bind(), and exports that as one
+# structured Cloud Logging entry per run. Summing the entries gives true totals however long an instance lives.
+# An entry that fails to export is kept and written with the next export.
+#
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._scopes = {}
+        self.started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        scope = self._scopes.get(threading.get_ident())
+        if scope is not None:
+            scope.inc(name, value, **labels)
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = Histogram(buckets)
+                self._histograms[key] = hist
+            hist.observe(value)
+        scope = self._scopes.get(threading.get_ident())
+        if scope is not None:
+            scope.observe(name, value, buckets, **labels)
+
+    @contextmanager
+    def _scoped(self, scope):
+        thread = threading.get_ident()
+        previous = self._scopes.get(thread)
+        self._scopes[thread] = scope
+        try:
+            yield scope
+        finally:
+            if previous is None:
+                del self._scopes[thread]
+            else:
+                self._scopes[thread] = previous
+
+    def run_scope(self):
+        """
+        Context manager giving a fresh registry that also gets what this thread records while it is open
+        """
+        return self._scoped(MetricsRegistry())
+
+    def bind(self, func):
+        """
+        func, recording into the calling thread's run scope from whichever thread it is called on
+        """
+        scope = self._scopes.get(threading.get_ident())
+        if scope is None:
+            return func
+
+        def scoped(*args, **kwargs):
+            with self._scoped(scope):
+                return func(*args, **kwargs)
+        return scoped
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time a block; records <name>_seconds and counts failures in <name>_errors
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('{0}_errors'.format(name), **labels)
+            raise
+        finally:
+            self.observe('{0}_seconds'.format(name), time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': hist.count, 'sum': round(hist.sum, 6),
+                           'buckets': dict(zip([str(b) for b in hist.buckets] + ['+Inf'], hist.counts))}
+                          for (name, labels), hist in sorted(self._histograms.items())]
+        return {'started': self.started, 'counters': counters, 'histograms': histograms}
+
+    def delta_since(self, baseline=None):
+        """
+        Changes since baseline (a value returned by an earlier call; None for the start of the instance), with
+        unchanged series left out. Returns (entry, new baseline)
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        since, old_counters, old_histograms = baseline or (self.started, {}, {})
+        counters = []
+        histograms = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                value -= old_counters.get((name, labels), 0)
+                if value:
+                    counters.append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), hist in sorted(self._histograms.items()):
+                old_counts, old_sum, old_count = old_histograms.get((name, labels), ([0] * len(hist.counts), 0.0, 0))
+                if hist.count == old_count:
+                    continue
+                histograms.append({'name': name, 'labels': dict(labels), 'count': hist.count - old_count,
+                                   'sum': round(hist.sum - old_sum, 6),
+                                   'buckets': dict(zip([str(b) for b in hist.buckets] + ['+Inf'],
+                                                       [new - old for new, old in zip(hist.counts, old_counts)]))})
+            baseline = (now, dict(self._counters),
+                        {key: (list(hist.counts), hist.sum, hist.count) for key, hist in self._histograms.items()})
+        entry = {'started': self.started, 'since': since, 'until': now, 'counters': counters,
+                 'histograms': histograms}
+        return entry, baseline
+
+    def render_prometheus(self):
+        def fmt(labels, extra=None):
+            pairs = list(labels) + ([extra] if extra else [])
+            if not pairs:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(k, v.replace('"', '\\"')) for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append('idc_cron_{0}_total{1} {2}'.format(name, fmt(labels), value))
+            for (name, labels), hist in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append('idc_cron_{0}_bucket{1} {2}'.format(name, fmt(labels, ('le', str(bound))), cumulative))
+                lines.append('idc_cron_{0}_sum{1} {2}'.format(name, fmt(labels), hist.sum))
+                lines.append('idc_cron_{0}_count{1} {2}'.format(name, fmt(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+MAX_UNEXPORTED = 20
+
+_unexported = []
+_export_lock = threading.Lock()
+
+
+def export_to_cloud_logging(client, log_name, run_metrics, **labels):
+    """
+    Write what a run recorded (its run_scope() registry) as a structured log entry, after any earlier entries
+    that failed to export
+    """
+    entry = run_metrics.delta_since()[0]
+    entry.update(labels)
+    with _export_lock:
+        _unexported.append(entry)
+        try:
+            while _unexported:
+                client.logger(log_name).log_struct({'cron_metrics': _unexported[0]})
+                _unexported.pop(0)
+        except Exception as e:
+            logger.error('Exception while exporting metrics: {0}'.format(str(e)))
+            del _unexported[:-MAX_UNEXPORTED]
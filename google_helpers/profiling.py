@@ -0,0 +1,195 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import datetime
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# Opt-in profiling of a single task run, for when a route suddenly gets slow in production. Turned on with a
+# request parameter (?profile=cpu or ?profile=sample) or a config key (TASK_PROFILE=cpu, or per task
+# TASK_PROFILE_<TASK_NAME>=sample). "cpu" runs the task under cProfile and writes a .pstats file; cProfile only
+# sees the request thread, so work the task hands to a thread pool (storage report reads, archive copies) shows up
+# as time waiting on the pool and nothing more. "sample" polls the stacks of every thread in the process every
+# TASK_PROFILE_INTERVAL_SECS and writes collapsed stacks (flamegraph.pl / speedscope input), each rooted at its
+# thread's name, so pool work is there too, next to whatever else the instance was running; use it for tasks that
+# fan out. "memory" traces allocations with tracemalloc, which slows everything down noticeably, and
+# writes the peak and the top allocation sites. Modes combine with commas (?profile=sample,memory). An unknown
+# mode is logged and nothing is profiled. Artifacts go to TASK_PROFILE_BUCKET if set, otherwise to
+# TASK_PROFILE_DIR. When profiling is off the only cost is looking up the mode.
+#
+
+PROFILE_MODES = ('cpu', 'sample', 'memory')
+DEFAULT_SAMPLE_INTERVAL = 0.01
+TOP_ALLOCATIONS = 25
+
+
+def profile_mode(args, task_name):
+    from config import settings
+    mode = args.get('profile') if args is not None else None
+    if not mode:
+        mode = settings.get('TASK_PROFILE_{0}'.format(task_name.upper()), settings.get('TASK_PROFILE'))
+    if not mode or mode in ('False', 'false', '0'):
+        return None
+    modes = [part.strip() for part in mode.split(',') if part.strip()]
+    unknown = [part for part in modes if part not in PROFILE_MODES]
+    if unknown or not modes:
+        logger.warning('Not profiling {0}: unknown profile mode {1}; use one or more of {2}'.format(
+            task_name, mode, ', '.join(PROFILE_MODES)))
+        return None
+    return ','.join(modes)
+
+
+class StackSampler(object):
+    """
+    Polls the stacks of all other threads from a background thread and counts collapsed stacks, each under the
+    name of its thread
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                         code.co_firstlineno))
+                    frame = frame.f_back
+                if frames:
+                    frames.append(names.get(thread_id, 'thread-{0}'.format(thread_id)))
+                    self.stacks[';'.join(reversed(frames))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+def _write_artifact(name, data):
+    from config import settings
+    bucket_name = settings.get('TASK_PROFILE_BUCKET')
+    if bucket_name:
+        from google.cloud import storage
+        storage_client = storage.Client(project=settings['DEPLOY_PROJECT_ID'])
+        blob = storage_client.bucket(bucket_name).blob('profiles/{0}'.format(name))
+        blob.upload_from_string(data)
+        location = 'gs://{0}/profiles/{1}'.format(bucket_name, name)
+    else:
+        directory = settings.get('TASK_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'idc-cron-profiles'))
+        os.makedirs(directory, exist_ok=True)
+        location = os.path.join(directory, name)
+        with open(location, 'wb') as f:
+            f.write(data)
+    logger.info('Wrote profile artifact {0}'.format(location))
+    return location
+
+
+def _memory_report(snapshot, peak, current):
+    out = io.StringIO()
+    out.write('peak_bytes {0}\ncurrent_bytes {1}\n\n'.format(peak, current))
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        out.write('{0}\n'.format(stat))
+    return out.getvalue().encode('utf-8')
+
+
+@contextmanager
+def profiled(task_name, mode):
+    if mode is None:
+        yield None
+        return
+
+    from config import settings
+    modes = mode.split(',')
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    base_name = '{0}-{1}'.format(task_name, stamp)
+
+    tracemalloc = None
+    started_tracing = False
+    if 'memory' in modes:
+        import tracemalloc
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python 3.9+; on older runtimes the peak covers everything since tracing started
+            tracemalloc.reset_peak()
+
+    profiler = None
+    sampler = None
+    if 'cpu' in modes:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if 'sample' in modes:
+        interval = float(settings.get('TASK_PROFILE_INTERVAL_SECS', DEFAULT_SAMPLE_INTERVAL))
+        sampler = StackSampler(interval)
+        sampler.start()
+
+    start = time.perf_counter()
+    try:
+        yield mode
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        snapshot = None
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            logger.info('Profiled {0} ({1}): {2:.1f} secs, peak traced memory {3} bytes'.format(
+                task_name, mode, elapsed, peak))
+        else:
+            logger.info('Profiled {0} ({1}): {2:.1f} secs'.format(task_name, mode, elapsed))
+        try:
+            if profiler is not None:
+                import marshal
+                profiler.create_stats()
+                _write_artifact('{0}.pstats'.format(base_name), marshal.dumps(profiler.stats))
+            if sampler is not None:
+                _write_artifact('{0}.collapsed'.format(base_name), sampler.collapsed().encode('utf-8'))
+            if snapshot is not None:
+                _write_artifact('{0}.memory.txt'.format(base_name), _memory_report(snapshot, peak, current))
+        except Exception as e:
+            logger.error('Exception while writing profile for {0}: {1}'.format(task_name, str(e)))
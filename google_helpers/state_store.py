@@ -0,0 +1,199 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import json
+import os
+import tempfile
+from google_helpers.limiter import api_call
+import logging
+
+logger = logging.getLogger('main_logger')
+
+#
+# Small key/value store for state that has to survive between cron invocations (continuation tokens, caches).
+# Keys are slash-separated paths. In App Engine the state lives in a GCS bucket (TASK_STATE_BUCKET); for local
+# runs and tests a directory works just as well (TASK_STATE_DIR).
+#
+# get_bytes_versioned/put_bytes_if_generation are a compare-and-swap for writers that must not overwrite each
+# other (checkpoints written under a lease). The generation is opaque; 0 means the key does not exist.
+#
+
+
+class StateStore(object):
+    """
+    Subclasses provide get_bytes/put_bytes/delete and the versioned pair; JSON values are layered on top
+    """
+    def get_json(self, key):
+        data = self.get_bytes(key)
+        return None if data is None else json.loads(data.decode('utf-8'))
+
+    def put_json(self, key, value):
+        self.put_bytes(key, json.dumps(value).encode('utf-8'))
+
+    def get_json_versioned(self, key):
+        generation, data = self.get_bytes_versioned(key)
+        return generation, None if data is None else json.loads(data.decode('utf-8'))
+
+    def put_json_if_generation(self, key, value, generation):
+        return self.put_bytes_if_generation(key, json.dumps(value).encode('utf-8'), generation)
+
+
+class _FileLock(object):
+    """
+    An flock on a side file, so writers in other threads and processes take turns
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        return False
+
+
+class LocalFileStateStore(StateStore):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a reader never sees half a file:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _generation(self, key):
+        # Every put replaces the file, so its inode and mtime change:
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return 0
+        return [stat.st_ino, stat.st_mtime_ns]
+
+    def get_bytes_versioned(self, key):
+        with _FileLock(self._path(key) + '.lock'):
+            return self._generation(key), self.get_bytes(key)
+
+    def put_bytes_if_generation(self, key, data, generation):
+        with _FileLock(self._path(key) + '.lock'):
+            if self._generation(key) != generation:
+                return False
+            self.put_bytes(key, data)
+            return True
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class GcsStateStore(StateStore):
+    def __init__(self, storage_client, bucket_name, prefix='idc-cron-state'):
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _blob(self, key):
+        return self.bucket.blob('{0}/{1}'.format(self.prefix, key))
+
+    def get_bytes(self, key):
+        from google.cloud.exceptions import NotFound
+        try:
+            with api_call('storage'):
+                return self._blob(key).download_as_bytes()
+        except NotFound:
+            return None
+
+    def put_bytes(self, key, data):
+        with api_call('storage'):
+            self._blob(key).upload_from_string(data, content_type='application/octet-stream')
+
+    def get_bytes_versioned(self, key):
+        from google.cloud.exceptions import NotFound
+        with api_call('storage'):
+            blob = self.bucket.get_blob('{0}/{1}'.format(self.prefix, key))
+        if blob is None:
+            return 0, None
+        try:
+            with api_call('storage'):
+                return blob.generation, blob.download_as_bytes(if_generation_match=blob.generation)
+        except NotFound:
+            return 0, None
+        except Exception as e:
+            if getattr(e, 'code', None) == 412:
+                # Rewritten between the metadata and the download; report the old generation so the put fails
+                return blob.generation, None
+            raise
+
+    def put_bytes_if_generation(self, key, data, generation):
+        try:
+            with api_call('storage'):
+                self._blob(key).upload_from_string(data, content_type='application/octet-stream',
+                                                   if_generation_match=generation)
+        except Exception as e:
+            if getattr(e, 'code', None) == 412:
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        from google.cloud.exceptions import NotFound
+        try:
+            with api_call('storage'):
+                self._blob(key).delete()
+        except NotFound:
+            pass
+
+
+_store = None
+
+
+def get_state_store():
+    global _store
+    if _store is None:
+        from config import settings
+        bucket_name = settings.get('TASK_STATE_BUCKET')
+        if bucket_name:
+            from google.cloud import storage
+            storage_client = storage.Client(project=settings['DEPLOY_PROJECT_ID'])
+            _store = GcsStateStore(storage_client, bucket_name, settings.get('TASK_STATE_PREFIX', 'idc-cron-state'))
+        else:
+            directory = settings.get('TASK_STATE_DIR', os.path.join(tempfile.gettempdir(), 'idc-cron-state'))
+            _store = LocalFileStateStore(directory)
+    return _store
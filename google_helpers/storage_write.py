@@ -0,0 +1,290 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import threading
+from contextlib import contextmanager
+import pyarrow as pa
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from google_helpers.state_store import get_state_store
+
+#
+# Appends dataframes to BigQuery tables through the Storage Write API instead of a load job, which skips the
+# load job queue and its daily quota, so rows are queryable as soon as a file is read.
+#
+# Each append() is all or nothing: the rows go to a new PENDING stream as Arrow record batches, with explicit
+# offsets, and become visible only when the stream is finalized and committed in one batch commit. If anything
+# fails before the commit nothing is visible, and the caller can simply try again.
+#
+# That alone is at-least-once: the commit can succeed and the caller die (or lose the response) before it records
+# that, and the retry writes the file again. So an append with a marker (the file's load job id) first saves the
+# stream name under the marker in the state store, before the commit. An append that finds a marker asks BigQuery
+# whether that stream was committed, and if it was, writes nothing. The caller drops the marker with forget() once
+# the file is archived. A committed stream is only kept by BigQuery for a while, so this covers a retry within
+# days, not weeks; an unknown stream is taken as never committed.
+#
+# Pending streams cannot be shared between files without losing that, so what is pooled is the client: one
+# BigQueryWriteClient, and its gRPC channel, per process (get_write_client). Pass a client in to use something
+# else, such as an in-process fake; it needs create_write_stream, append_rows, finalize_write_stream,
+# batch_commit_write_streams and (for markers) get_write_stream with the signatures of the real one. Needs the google-cloud-bigquery-storage
+# package, which is imported on first use.
+#
+
+MAX_REQUEST_BYTES = 8 * 1024 * 1024  # Under the 10MB AppendRows request limit
+
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'DATE': pa.date32(),
+}
+
+#
+# gRPC status codes, mapped to the HTTP status classify_exception understands:
+#
+
+GRPC_TO_HTTP = {
+    1: 499,   # CANCELLED
+    2: 500,   # UNKNOWN
+    3: 400,   # INVALID_ARGUMENT
+    4: 504,   # DEADLINE_EXCEEDED
+    5: 404,   # NOT_FOUND
+    6: 409,   # ALREADY_EXISTS
+    7: 403,   # PERMISSION_DENIED
+    8: 429,   # RESOURCE_EXHAUSTED
+    9: 400,   # FAILED_PRECONDITION
+    10: 503,  # ABORTED
+    11: 400,  # OUT_OF_RANGE
+    12: 501,  # UNIMPLEMENTED
+    13: 500,  # INTERNAL
+    14: 503,  # UNAVAILABLE
+    15: 500,  # DATA_LOSS
+    16: 401,  # UNAUTHENTICATED
+}
+
+#
+# Once our stream exists, these codes are about the stream rather than the rows or the table: an offset already
+# written (ALREADY_EXISTS) or past the end (OUT_OF_RANGE), a stream gone (NOT_FOUND) or already finalized
+# (FAILED_PRECONDITION). Nothing was committed, and a retry writes the file again to a fresh stream, so they are
+# reported as retryable (503). From create_write_stream they keep their mapping; NOT_FOUND there is the table.
+#
+
+STREAM_RETRY_CODES = (5, 6, 9, 11)
+
+#
+# BatchCommitWriteStreams reports StorageError codes instead, mapped to the gRPC code they amount to.
+# STREAM_ALREADY_COMMITTED (2) means our rows are in, and is not an error:
+#
+
+COMMIT_ERROR_TO_GRPC = {
+    1: 5,   # TABLE_NOT_FOUND
+    3: 14,  # STREAM_NOT_FOUND
+    4: 14,  # INVALID_STREAM_TYPE
+    5: 14,  # INVALID_STREAM_STATE
+    6: 14,  # STREAM_FINALIZED
+}
+STREAM_ALREADY_COMMITTED = 2
+
+
+class StorageWriteError(Exception):
+    """
+    An append or commit was rejected. code is the HTTP equivalent of the gRPC status
+    """
+    def __init__(self, message, grpc_code=None, on_stream=False):
+        super().__init__(message)
+        self.grpc_code = grpc_code
+        if on_stream and grpc_code in STREAM_RETRY_CODES:
+            self.code = 503
+        else:
+            self.code = GRPC_TO_HTTP.get(grpc_code, 400)
+
+
+def _grpc_code(e):
+    # google.api_core exceptions carry a grpc.StatusCode, whose value is (code, name):
+    status = getattr(e, 'grpc_status_code', None)
+    return status.value[0] if status is not None else None
+
+
+def arrow_schema(bq_schema):
+    return pa.schema([pa.field(field.name, ARROW_TYPES[field.field_type], nullable=(field.mode != 'REQUIRED'))
+                      for field in bq_schema])
+
+
+def record_batches(df, schema, max_bytes=MAX_REQUEST_BYTES):
+    """
+    df as Arrow record batches in schema, each small enough for one AppendRows request
+    """
+    # Columns the frame lacks (c_ip_region without a region database) are written as nulls:
+    table = pa.Table.from_pandas(df.reindex(columns=schema.names), schema=schema, preserve_index=False)
+    if table.num_rows == 0:
+        return []
+    rows_per_batch = max(1, int(table.num_rows * max_bytes / max(table.nbytes, 1)))
+    return table.to_batches(max_chunksize=rows_per_batch)
+
+
+def _types():
+    from google.cloud.bigquery_storage_v1 import types
+    return types
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_write_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import bigquery_storage_v1
+            _client = bigquery_storage_v1.BigQueryWriteClient()
+        return _client
+
+
+class StorageWriter(object):
+
+    def __init__(self, write_client=None, max_request_bytes=MAX_REQUEST_BYTES, store=None):
+        self.client = write_client or get_write_client()
+        self.max_request_bytes = max_request_bytes
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_state_store()
+        return self._store
+
+    @staticmethod
+    def _marker_key(marker):
+        return 'write_api_streams/{0}.json'.format(marker)
+
+    def _committed_rows(self, marker):
+        """
+        Rows committed by an earlier append under marker, or None if it did not get that far
+        """
+        record = self.store.get_json(self._marker_key(marker))
+        if not record:
+            return None
+        try:
+            with api_call('bigquery'):
+                stream = self.client.get_write_stream(name=record['stream'])
+        except Exception as e:
+            if _grpc_code(e) == 5:
+                # NOT_FOUND: a pending stream that was never committed and has been cleaned up
+                return None
+            raise
+        return record['rows'] if getattr(stream, 'commit_time', None) else None
+
+    def forget(self, marker):
+        """
+        Drop the marker of a file that is archived, and so will not be appended again
+        """
+        self.store.delete(self._marker_key(marker))
+
+    def _requests(self, stream_name, schema, batches):
+        types = _types()
+        serialized_schema = types.ArrowSchema(serialized_schema=schema.serialize().to_pybytes())
+        offset = 0
+        for index, batch in enumerate(batches):
+            arrow_rows = types.AppendRowsRequest.ArrowData(
+                rows=types.ArrowRecordBatch(serialized_record_batch=batch.serialize().to_pybytes(),
+                                            row_count=batch.num_rows))
+            request = types.AppendRowsRequest(offset=offset, arrow_rows=arrow_rows)
+            if index == 0:
+                # Only the first request on a connection names the stream and carries the schema:
+                request.write_stream = stream_name
+                request.arrow_rows.writer_schema = serialized_schema
+            offset += batch.num_rows
+            yield request
+
+    @contextmanager
+    def _stream_errors(self, full_table_name):
+        """
+        Turn a gRPC exception about our stream into a StorageWriteError that is retried on a fresh stream
+        """
+        try:
+            yield
+        except StorageWriteError:
+            raise
+        except Exception as e:
+            code = _grpc_code(e)
+            if code not in STREAM_RETRY_CODES:
+                raise
+            raise StorageWriteError('Stream write to {0} failed: {1}'.format(full_table_name, str(e)), code,
+                                    on_stream=True) from e
+
+    def append(self, df, full_table_name, bq_schema, labels=None, marker=None):
+        """
+        Write df to the table (project.dataset.table) in one pending stream and commit it, unless an earlier append
+        under the same marker was committed. Returns rows written
+        """
+        labels = labels or {}
+        if marker is not None:
+            done = self._committed_rows(marker)
+            if done is not None:
+                metrics.inc('ingest_write_already_committed', **labels)
+                return done
+        types = _types()
+        project, dataset, table = full_table_name.split('.')
+        parent = 'projects/{0}/datasets/{1}/tables/{2}'.format(project, dataset, table)
+        schema = arrow_schema(bq_schema)
+        batches = record_batches(df, schema, self.max_request_bytes)
+        rows = sum(batch.num_rows for batch in batches)
+        if not rows:
+            return 0
+
+        with metrics.span('ingest_write_append', **labels):
+            with api_call('bigquery'):
+                stream = self.client.create_write_stream(
+                    parent=parent, write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING))
+            with api_call('bigquery'), self._stream_errors(full_table_name):
+                for response in self.client.append_rows(requests=self._requests(stream.name, schema, batches)):
+                    if response.error.code:
+                        raise StorageWriteError('Append to {0} failed: {1}'.format(
+                            full_table_name, response.error.message), response.error.code, on_stream=True)
+                    if response.row_errors:
+                        raise StorageWriteError('Append to {0} rejected rows: {1}'.format(
+                            full_table_name, [error.message for error in response.row_errors[:5]]))
+
+        with metrics.span('ingest_write_commit', **labels):
+            with api_call('bigquery'), self._stream_errors(full_table_name):
+                finalized = self.client.finalize_write_stream(name=stream.name)
+            if finalized.row_count != rows:
+                # Never commit a partial file; the stream is abandoned and the caller retries:
+                raise StorageWriteError('Stream for {0} finalized with {1} rows, expected {2}'.format(
+                    full_table_name, finalized.row_count, rows), 10)
+            if marker is not None:
+                self.store.put_json(self._marker_key(marker), {'stream': stream.name, 'rows': rows})
+            with api_call('bigquery'), self._stream_errors(full_table_name):
+                committed = self.client.batch_commit_write_streams(
+                    request=types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=[stream.name]))
+        errors = [error for error in committed.stream_errors if error.code != STREAM_ALREADY_COMMITTED]
+        if errors:
+            if marker is not None:
+                # Not committed, so a retry must write the file again:
+                self.forget(marker)
+            raise StorageWriteError('Commit to {0} failed: {1}'.format(
+                full_table_name, [error.error_message for error in errors]),
+                COMMIT_ERROR_TO_GRPC.get(int(errors[0].code), 3))
+
+        metrics.inc('ingest_rows_loaded', rows, **labels)
+        return rows
@@ -22,6 +22,9 @@ from googleapiclient.errors import HttpError
 #from google.appengine.api.urlfetch_errors import DeadlineExceededError as FetchDeadlineExceededError
 #from google.appengine.api.remote_socket._remote_socket_error import error as GoogleSocketError
 from http.client import HTTPException
+from urllib.parse import urlparse
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
 import logging
 
 logger = logging.getLogger('main_logger')
@@ -37,18 +40,21 @@ def build_with_retries(service_tag, version_tag, creds, num_retries, http=None):
     while (retries > 0) and (service is None):
         retries -= 1
         try:
-            if http:
-                service = discovery.build(service_tag, version_tag, http=http, cache_discovery=False)
-            else:
-                service = discovery.build(service_tag, version_tag, credentials=creds, cache_discovery=False)
+            with api_call(service_tag):
+                if http:
+                    service = discovery.build(service_tag, version_tag, http=http, cache_discovery=False)
+                else:
+                    service = discovery.build(service_tag, version_tag, credentials=creds, cache_discovery=False)
         #except (APIDeadlineExceededError, FetchDeadlineExceededError, HTTPException, GoogleSocketError) as e:
         except (HTTPException) as e:
+            metrics.inc('api_retries', task=service_tag)
             if num_retries > 0:
                 logger.info('{0} Exception: {1} : {2} : trying {3}'.format(service_tag, str(type(e)), str(e), num_retries))
             else:
                 logger.error('{0} Exception: {1} : {2} : gave up {3}'.format(service_tag, str(type(e)), str(e), num_retries))
         except HttpError as e:
             if e.resp.status == 503 or e.resp.status == 500:  # worth a retry on a backend error...
+                metrics.inc('api_retries', task=service_tag)
                 if num_retries > 0:
                     logger.info('{0} HttpError: {1} : code {2} : trying {3}'.format(service_tag, str(e), e.resp.status,
                                                                                     num_retries))
@@ -67,30 +73,44 @@ def build_with_retries(service_tag, version_tag, creds, num_retries, http=None):
 
     return service
 
+#
+# Figure out which API a discovery request is headed for, so it is charged to the right limiter:
+#
+
+
+def service_for_request(req):
+    host = urlparse(getattr(req, 'uri', '') or '').hostname or ''
+    return host.split('.')[0] if host else 'googleapis'
+
 #
 # Use this in place of execute() to catch all the bogus Google errors!
 #
 
 
-def execute_with_retries(req, task, retries, http=None):
+def execute_with_retries(req, task, retries, http=None, service=None):
+    if service is None:
+        service = service_for_request(req)
     num_retries = retries
     resp = None
     while (num_retries > 0) and (resp is None):
         num_retries -= 1
         try:
             # Still got a Deadline Exceeded with num_retries=3. Don't bother!
-            if http:
-                resp = req.execute(http=http)
-            else:
-                resp = req.execute()
+            with api_call(service):
+                if http:
+                    resp = req.execute(http=http)
+                else:
+                    resp = req.execute()
         #except (APIDeadlineExceededError, FetchDeadlineExceededError, HTTPException, GoogleSocketError) as e:
         except (HTTPException) as e:
+            metrics.inc('api_retries', task=task)
             if num_retries > 0:
                 logger.info('{0} Exception: {1} : {2} : trying {3}'.format(task, str(type(e)), str(e), num_retries))
             else:
                 logger.error('{0} Exception: {1} : {2} : gave up {3}'.format(task, str(type(e)), str(e), num_retries))
         except HttpError as e:
             if e.resp.status == 503 or e.resp.status == 500:  # worth a retry on a backend error...
+                metrics.inc('api_retries', task=task)
                 if num_retries > 0:
                     logger.info('{0} HttpError: {1} : code {2} : trying {3}'.format(task, str(e), e.resp.status,
                                                                                     num_retries))
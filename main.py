@@ -16,27 +16,118 @@ limitations under the License.
 
 """
 
-from tasks.log_buckets_and_members import logit
-from tasks.bucket_access_to_bq import sink_from_bucket_to_table
-from tasks.proxy_usage_processing import process_logs
-from tasks.check_cron_health import check_for_cron
-from flask import Flask
-from google.cloud import logging as glog
+from importlib import import_module
+from urllib.parse import urlencode
+import threading
+from flask import Flask, Response, request
 from config import settings
 import logging
 
-# Get standard logger set up
-gcp_id = settings['DEPLOY_PROJECT_ID']
-client = glog.Client(project=gcp_id)
-client.get_default_handler()
-client.setup_logging()
+#
+# Task modules pull in pandas, numpy and the Google client libraries, which costs seconds on an F2 instance.
+# Nothing heavy is imported here: each route loads its task module on first use, and the Cloud Logging client
+# is built the first time a route needs it. App Engine warmup requests (/_ah/warmup) preload everything before
+# the instance takes traffic.
+#
+
+WARMUP_MODULES = ['tasks.check_cron_health',
+                  'tasks.log_buckets_and_members',
+                  'tasks.bucket_access_to_bq',
+                  'tasks.proxy_usage_processing',
+                  'tasks.bucket_inventory']
+
+_log_client = None
+_log_client_lock = threading.Lock()
+
+
+def get_log_client():
+    global _log_client
+    if _log_client is None:
+        with _log_client_lock:
+            if _log_client is None:
+                from google.cloud import logging as glog
+                # Get standard logger set up
+                gcp_id = settings['DEPLOY_PROJECT_ID']
+                client = glog.Client(project=gcp_id)
+                client.get_default_handler()
+                client.setup_logging()
+                _log_client = client
+    return _log_client
+
+
+def task_function(module_name, func_name):
+    return getattr(import_module(module_name), func_name)
+
+
+#
+# Run a task under a time budget. If it stops early it leaves a continuation token, and we ask for a follow-up
+# request (when a follow-up queue is configured) so the rest does not wait for the next cron tick. The follow-up
+# carries since=<start of the pass>, so it skips the projects this pass already finished. The task holds a
+# lease on each project while it works on it, so a run that outlasts the cron interval is never joined by a
+# second one on the same project.
+#
+# A request with ?shard=<i>&shards=<n> only does that shard's slice of the projects, and reports back to the
+# coordinator when it is done. Leases and continuation tokens are per project, so they do not depend on the
+# shard count, and an unsharded run and a round of shards never work on one project at once:
+#
+
+SHARDABLE_TASKS = {
+    'log_buckets_and_members': '/tasks/log_buckets_and_members',
+    'process_proxy_usage': '/tasks/process_proxy_usage',
+    'transfer_bucket_access_to_bq': '/tasks/transfer_bucket_access_to_bq',
+    'bucket_inventory': '/tasks/bucket_inventory',
+}
+
+
+def run_budgeted_task(task_name, module_name, func_name, *args):
+    from tasks.task_runtime import start_run, enqueue_request
+    from tasks.sharding import ShardSpec, record_shard_done
+    shard = ShardSpec.from_request_args(request.args)
+    run_name = task_name if shard is None else '{0}-{1}'.format(task_name, shard.suffix())
+    from google_helpers.metrics import metrics, export_to_cloud_logging
+    from google_helpers.profiling import profile_mode, profiled
+    since = float(request.args['since']) if 'since' in request.args else None
+    run = start_run(task_name, since=since)
+    with metrics.run_scope() as run_metrics:
+        try:
+            with profiled(run_name, profile_mode(request.args, task_name)):
+                task_function(module_name, func_name)(*args, run=run, shard=shard)
+        finally:
+            export_to_cloud_logging(get_log_client(), settings.get('METRICS_LOG_NAME', 'idc_cron_metrics'),
+                                    run_metrics, task=run_name)
+    if run.lease_lost():
+        return run
+    if run.finished:
+        record_shard_done(task_name, shard, True)
+    else:
+        follow_up = '{0}?{1}'.format(request.path, urlencode(dict(request.args.items(), since=run.since)))
+        if not enqueue_request(follow_up):
+            record_shard_done(task_name, shard, False)
+    return run
+
+
+def warm_up():
+    get_log_client()
+    for module_name in WARMUP_MODULES:
+        import_module(module_name)
+
 
 app = Flask(__name__)
 
+@app.route('/_ah/warmup')
+def warmup_work():
+    try:
+        warm_up()
+    except Exception as e:
+        logging.exception(e)
+
+    return ''
+
 @app.route('/tasks/log_buckets_and_members')
 def iam_cron_work():
     try:
-        logit(client)
+        client = get_log_client()
+        run_budgeted_task('log_buckets_and_members', 'tasks.log_buckets_and_members', 'logit', client)
     except Exception as e:
         logging.exception(e)
 
@@ -45,7 +136,8 @@ def iam_cron_work():
 @app.route('/tasks/process_proxy_usage')
 def proxy_cron_work():
     try:
-        process_logs()
+        get_log_client()
+        run_budgeted_task('process_proxy_usage', 'tasks.proxy_usage_processing', 'process_logs')
     except Exception as e:
         logging.exception(e)
 
@@ -55,16 +147,65 @@ def proxy_cron_work():
 def access_cron_work():
 
     try:
-        sink_from_bucket_to_table()
+        get_log_client()
+        run_budgeted_task('transfer_bucket_access_to_bq', 'tasks.bucket_access_to_bq', 'sink_from_bucket_to_table')
     except Exception as e:
         logging.exception(e)
 
     return ''
 
+@app.route('/tasks/bucket_inventory')
+def inventory_cron_work():
+
+    try:
+        get_log_client()
+        run_budgeted_task('bucket_inventory', 'tasks.bucket_inventory', 'take_inventory')
+    except Exception as e:
+        logging.exception(e)
+
+    return ''
+
+@app.route('/tasks/coordinate/<task_name>')
+def coordinate_cron_work(task_name):
+
+    try:
+        from tasks.sharding import start_round
+        from tasks.task_runtime import enqueue_request
+        if task_name not in SHARDABLE_TASKS:
+            logging.error('No shardable task named {0}'.format(task_name))
+            return ''
+        shard_count = int(request.args.get('shards', settings.get('TASK_SHARD_COUNT', 1)))
+        get_log_client()
+        round_id = start_round(task_name, shard_count)
+        for index in range(shard_count):
+            uri = '{0}?shard={1}&shards={2}&round={3}'.format(SHARDABLE_TASKS[task_name], index, shard_count, round_id)
+            if not enqueue_request(uri):
+                logging.error('Cannot dispatch shards for {0}: TASK_FOLLOW_UP_QUEUE is not set'.format(task_name))
+                break
+    except Exception as e:
+        logging.exception(e)
+
+    return ''
+
+#
+# Metrics for scraping, under /tasks/ so app.yaml routes it. Served only when METRICS_ROUTE_ENABLED=True (local
+# and dev runs), or to requests carrying the X-Appengine-Cron header, which App Engine strips from outside requests:
+#
+
+@app.route('/tasks/metrics')
+def metrics_work():
+    if settings.get('METRICS_ROUTE_ENABLED', 'False') != 'True' and \
+            request.headers.get('X-Appengine-Cron') != 'true':
+        return Response('Not found', status=404, mimetype='text/plain')
+    from google_helpers.metrics import metrics
+    return Response(metrics.render_prometheus(), mimetype='text/plain')
+
 @app.route('/tasks/check_cron')
 def check_cron_work():
 
     try:
+        get_log_client()
+        check_for_cron = task_function('tasks.check_cron_health', 'check_for_cron')
         check_for_cron()
     except Exception as e:
         logging.exception(e)
@@ -0,0 +1,145 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from types import SimpleNamespace
+import numpy as np
+import pyarrow as pa
+import pandas as pd
+
+#
+# Seconds from "file parsed" to "rows committed" for the two ingest engines (INGEST_STORAGE_LOGS_ENGINE), on
+# synthetic usage logs. Run from the repo root:
+#
+#   python scripts/bench_ingest_engines.py --project <id> --dataset <scratch dataset> [--rows 100000] [--files 5]
+#   python scripts/bench_ingest_engines.py --fake [--rows 100000] [--files 5]
+#
+# Against a real project it writes the same frames with a load job and with the Storage Write API into a
+# scratch table, checks the row count, and drops the table. With --fake the write API side runs against an
+# in-process fake client that decodes every Arrow batch, which measures our own encode and request overhead
+# without a project. Both need google-cloud-bigquery-storage.
+#
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_log_codecs import synthetic_usage_csv
+from google_helpers.storage_write import StorageWriter
+from tasks.bucket_access_to_bq import get_usage_schema, usage_times_to_datetime, write_rows
+
+
+class FakeWriteClient(object):
+    """
+    Accepts pending streams in memory; committed rows are counted per table
+    """
+    def __init__(self):
+        self.streams = {}
+        self.committed = {}
+
+    def create_write_stream(self, parent, write_stream):
+        name = '{0}/streams/{1}'.format(parent, len(self.streams))
+        self.streams[name] = {'parent': parent, 'rows': 0, 'schema': None}
+        return SimpleNamespace(name=name)
+
+    def append_rows(self, requests):
+        stream = None
+        for request in requests:
+            if request.write_stream:
+                stream = self.streams[request.write_stream]
+                stream['schema'] = pa.ipc.read_schema(
+                    pa.py_buffer(request.arrow_rows.writer_schema.serialized_schema))
+            if request.offset != stream['rows']:
+                raise ValueError('Append at offset {0}, stream has {1} rows'.format(request.offset, stream['rows']))
+            batch = pa.ipc.read_record_batch(pa.py_buffer(request.arrow_rows.rows.serialized_record_batch),
+                                             stream['schema'])
+            stream['rows'] += batch.num_rows
+            yield SimpleNamespace(error=SimpleNamespace(code=0, message=''), row_errors=[])
+
+    def finalize_write_stream(self, name):
+        return SimpleNamespace(row_count=self.streams[name]['rows'])
+
+    def batch_commit_write_streams(self, request):
+        for name in request.write_streams:
+            stream = self.streams.pop(name)
+            self.committed[stream['parent']] = self.committed.get(stream['parent'], 0) + stream['rows']
+        return SimpleNamespace(stream_errors=[])
+
+
+def usage_frames(rows, files):
+    dtype = get_usage_schema(True)[1]
+    frame = usage_times_to_datetime(pd.read_csv(io.BytesIO(synthetic_usage_csv(rows)), dtype=dtype))
+    return [frame] * files
+
+
+def timed(write, frames):
+    times = []
+    for frame in frames:
+        start = time.perf_counter()
+        write(frame)
+        times.append(time.perf_counter() - start)
+    return np.asarray(times)
+
+
+def report(engine, times, rows):
+    print('{0:<10} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>12,.0f}'.format(
+        engine, np.median(times), times.min(), times.max(), rows / np.median(times)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the load job and Storage Write API ingest engines')
+    parser.add_argument('--project', help='Project for the scratch table')
+    parser.add_argument('--dataset', help='Existing dataset for the scratch table')
+    parser.add_argument('--fake', action='store_true', help='Use an in-process fake write client, no project')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows per file')
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--location', default='US')
+    args = parser.parse_args()
+    if not args.fake and not (args.project and args.dataset):
+        parser.error('Give --project and --dataset, or --fake')
+
+    frames = usage_frames(args.rows, args.files)
+    schema = get_usage_schema(False)[0]
+    print('{0:<10} {1:>9} {2:>9} {3:>9} {4:>12}'.format('engine', 'median s', 'min s', 'max s', 'rows/s'))
+
+    if args.fake:
+        client = FakeWriteClient()
+        writer = StorageWriter(write_client=client)
+        table = 'local.bench.usage'
+        report('write_api', timed(lambda df: writer.append(df, table, schema), frames), args.rows)
+        assert sum(client.committed.values()) == args.rows * args.files
+        return
+
+    from google.cloud import bigquery
+    bq_client = bigquery.Client(project=args.project)
+    table = '{0}.{1}.bench_usage_{2}'.format(args.project, args.dataset, int(time.time()))
+    bq_client.create_table(bigquery.Table(table, schema=schema))
+    try:
+        for engine, writer in (('load', None), ('write_api', StorageWriter())):
+            times = timed(lambda df: write_rows(bq_client, writer, df, table, schema, args.location, {}), frames)
+            report(engine, times, args.rows)
+        count = list(bq_client.query('SELECT COUNT(*) AS n FROM `{0}`'.format(table)).result())[0].n
+        print('{0:,} rows in {1}, expected {2:,}'.format(count, table, 2 * args.rows * args.files))
+    finally:
+        bq_client.delete_table(table, not_found_ok=True)
+
+
+if __name__ == '__main__':
+    main()
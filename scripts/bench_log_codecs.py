@@ -0,0 +1,104 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+#
+# Bytes moved and CPU per row for plain, gzip and zstd usage logs, read through the same streaming path the
+# ingest task uses. Run from the repo root:
+#
+#   python scripts/bench_log_codecs.py [--rows 500000] [--file <real usage log>]
+#
+# Without --file a synthetic usage log is generated. zstd is skipped if zstandard is not installed.
+#
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tasks.log_codecs import read_log_csv
+from tasks.bucket_access_to_bq import get_usage_schema
+
+
+def synthetic_usage_csv(rows):
+    rng = np.random.default_rng(0)
+    ips = np.array(['{0}.{1}.{2}.{3}'.format(*rng.integers(1, 255, 4)) for _ in range(5000)])
+    buckets = np.array(['idc-open-data', 'idc-open-data-two', 'public-datasets-idc'])
+    df = pd.DataFrame({
+        'time_micros': 1590969600000000 + np.sort(rng.integers(0, 3600 * 1000000, rows)),
+        'c_ip': rng.choice(ips, rows),
+        'c_ip_type': 1,
+        'c_ip_region': '',
+        'cs_method': 'GET',
+        'cs_uri': ['/download/storage/v1/b/x/o/{0}.dcm?alt=media'.format(i) for i in rng.integers(0, 10 ** 7, rows)],
+        'sc_status': rng.choice([200, 206, 304, 404], rows),
+        'cs_bytes': 0,
+        'sc_bytes': rng.integers(1000, 10 ** 7, rows),
+        'time_taken_micros': rng.integers(1000, 10 ** 6, rows),
+        'cs_host': 'storage.googleapis.com',
+        'cs_referer': '',
+        'cs_user_agent': 'python-requests/2.24.0',
+        's_request_id': ['ADPycd{0:032x}'.format(i) for i in rng.integers(0, 2 ** 62, rows)],
+        'cs_operation': 'GET_Object',
+        'cs_bucket': rng.choice(buckets, rows),
+        'cs_object': ['{0}.dcm'.format(i) for i in rng.integers(0, 10 ** 7, rows)],
+    })
+    return df.to_csv(index=False).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compressed log reads')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--file', help='Use this uncompressed usage log instead of synthetic data')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            raw = f.read()
+    else:
+        raw = synthetic_usage_csv(args.rows)
+
+    encoders = [('none', lambda data: data), ('gzip', lambda data: gzip.compress(data, compresslevel=6))]
+    try:
+        import zstandard
+        encoders.append(('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data)))
+    except ImportError:
+        print('zstandard not installed, skipping zstd')
+
+    dtype = get_usage_schema(True)[1]
+    print('{0:<6} {1:>14} {2:>7} {3:>12} {4:>14}'.format('codec', 'bytes', 'ratio', 'cpu secs', 'cpu us/row'))
+    with tempfile.TemporaryDirectory() as directory:
+        for codec, encode in encoders:
+            path = os.path.join(directory, 'usage.{0}'.format(codec))
+            with open(path, 'wb') as f:
+                f.write(encode(raw))
+            size = os.path.getsize(path)
+            start = time.process_time()
+            df = read_log_csv(path, dtype)
+            cpu = time.process_time() - start
+            print('{0:<6} {1:>14,} {2:>7.2f} {3:>12.3f} {4:>14.2f}'.format(codec, size, len(raw) / size, cpu,
+                                                                          cpu * 1e6 / len(df)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+#
+# Run the proxy usage pipeline (extract_log_fields -> daily_byte_max -> daily_user_and_largest) on a laptop,
+# using the same SQL as production run through DuckDB. Run from the repo root:
+#
+#   python scripts/run_proxy_pipeline_local.py [--raw fixtures/proxy_logs.parquet] [--rows 100000] [--out dir]
+#
+# --raw is a Parquet or CSV export of the raw proxy log table (timeStamp, textPayload). Without it a synthetic
+# log is generated. Stage timings are printed, and with --out each stage's table is written as Parquet so a
+# change to the SQL can be diffed against the previous output. Needs the duckdb package.
+#
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google_helpers.local_sql import LocalSqlClient
+from tasks.proxy_usage_processing import extract_log_fields, daily_byte_max, daily_user_and_largest
+
+PROJECT = 'local'
+RAW_TABLE = 'local.raw.proxy_logs'
+DATASET = 'stats'
+STAGES = [
+    (extract_log_fields, RAW_TABLE, 'processed'),
+    (daily_byte_max, 'local.stats.processed', 'bytes'),
+    (daily_user_and_largest, 'local.stats.bytes', 'largest'),
+]
+
+
+def synthetic_proxy_logs(rows, days=30, users=2000):
+    rng = np.random.default_rng(0)
+    day = pd.Timestamp('2020-06-01') + pd.to_timedelta(rng.integers(0, days, rows), unit='D')
+    ips = np.array(['10.{0}.{1}.{2}'.format(*rng.integers(0, 255, 3)) for _ in range(users)])
+    ip = rng.choice(ips, rows)
+    count = rng.integers(0, 10 ** 10, rows)
+    is_global = rng.random(rows) < 0.1
+    day_text = day.strftime('%Y-%m-%d')
+    payload = np.where(is_global,
+                       'GLOBAL USAGE ON ' + day_text + ' is now ' + count.astype(str) + ' bytes',
+                       'USAGE ON ' + day_text + ' FOR IP ' + ip + ' is now ' + count.astype(str) + ' bytes')
+    return pd.DataFrame({'timeStamp': day, 'textPayload': payload})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the proxy usage pipeline locally')
+    parser.add_argument('--raw', help='Parquet or CSV fixture of the raw proxy log table')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows of synthetic log when --raw is not given')
+    parser.add_argument('--out', help='Write each stage table to this directory as Parquet')
+    args = parser.parse_args()
+
+    client = LocalSqlClient(project=PROJECT)
+    if args.raw:
+        client.register_fixture(RAW_TABLE, args.raw)
+    else:
+        client.register_dataframe(RAW_TABLE, synthetic_proxy_logs(args.rows))
+
+    for stage_func, input_table, dest_table in STAGES:
+        start = time.perf_counter()
+        stage_func(client, input_table, DATASET, dest_table, False)
+        elapsed = time.perf_counter() - start
+        df = client.to_dataframe('{0}.{1}.{2}'.format(PROJECT, DATASET, dest_table))
+        print('{0:<24} {1:>10,} rows {2:>8.3f} secs'.format(stage_func.__name__, len(df), elapsed))
+        if args.out:
+            os.makedirs(args.out, exist_ok=True)
+            df.to_parquet(os.path.join(args.out, '{0}.parquet'.format(dest_table)), index=False)
+
+    print(df.head(10).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Cold start guard for main.py. Run from the repo root:
+#
+#   python scripts/startup_profile.py [--max-secs 1.0] [--top 15]
+#
+# Imports main in a fresh interpreter under -X importtime, prints the slowest imports, and fails if the import
+# pulled in any of the heavy task dependencies or took longer than --max-secs. It then times the first
+# /tasks/check_cron request through the Flask test client with the logging client stubbed out, since that route
+# must not need to load anything else.
+#
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ['pandas', 'numpy', 'google.cloud.bigquery', 'google.cloud.storage', 'googleapiclient',
+                 'oauth2client', 'gcsfs', 'pyarrow']
+
+CHILD_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import main
+import_secs = time.perf_counter() - start
+main._log_client = object()
+client = main.app.test_client()
+start = time.perf_counter()
+client.get('/tasks/check_cron')
+request_secs = time.perf_counter() - start
+heavy = [name for name in {heavy} if name in sys.modules]
+print('RESULT', import_secs, request_secs, ','.join(heavy))
+'''
+
+
+def parse_importtime(stderr_text):
+    rows = []
+    for line in stderr_text.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        rows.append((int(fields[1].strip()), int(fields[0].strip()), fields[2].rstrip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile cold start of the cron service')
+    parser.add_argument('--max-secs', type=float, default=1.0, help='Fail if importing main takes longer')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as config_file:
+        config_file.write('DEPLOY_PROJECT_ID=startup-profile\n')
+    env = dict(os.environ, IDC_CRON_CONFIG=config_file.name, PYTHONPATH=repo_root)
+    try:
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT.format(heavy=HEAVY_MODULES)],
+                              cwd=repo_root, env=env, capture_output=True, text=True)
+    finally:
+        os.remove(config_file.name)
+
+    if proc.returncode != 0:
+        print(proc.stderr)
+        return proc.returncode
+
+    rows = parse_importtime(proc.stderr)
+    rows.sort(reverse=True)
+    print('Slowest imports (cumulative us, self us, module):')
+    for cumulative, self_us, name in rows[:args.top]:
+        print('{0:>10} {1:>10} {2}'.format(cumulative, self_us, name))
+
+    result = [line for line in proc.stdout.splitlines() if line.startswith('RESULT')][-1].split(' ')
+    import_secs = float(result[1])
+    request_secs = float(result[2])
+    heavy = [name for name in (result[3].split(',') if len(result) > 3 else []) if name]
+    print('import main: {0:.3f} secs, first /tasks/check_cron: {1:.3f} secs'.format(import_secs, request_secs))
+
+    failed = False
+    if heavy:
+        print('FAIL: heavy modules loaded at startup: {0}'.format(', '.join(heavy)))
+        failed = True
+    if import_secs > args.max_secs:
+        print('FAIL: import main took longer than {0} secs'.format(args.max_secs))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
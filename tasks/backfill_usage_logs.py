@@ -0,0 +1,216 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import datetime
+import hashlib
+import multiprocessing
+import time
+from google.cloud import storage
+from google.cloud import bigquery
+import pandas as pd
+from google_helpers.limiter import api_call
+from google_helpers.state_store import get_state_store
+from tasks.bucket_access_to_bq import get_usage_schema, get_storage_schema, usage_times_to_datetime, \
+    parse_log_file_names, ensure_ingest_tables, load_dataframe, load_job_done, archive_blobs, read_storage_report, \
+    collapse_storage_reports
+from tasks.ip_regions import enrich_regions
+from tasks.log_codecs import read_log_csv, strip_codec_suffix
+from tasks.usage_rollups import RollupAccumulator, rollups_enabled
+from config import settings
+import logging
+
+#
+# Bulk backfill of historical storage logs into BigQuery, replacing scripts/combine_logs.sh. Run from the repo root:
+#
+#   python -m tasks.backfill_usage_logs --project <id> --tag <tag> [--start 2020-06-01] [--end 2020-07-01]
+#                                       [--prefix <name prefix>] [--kind usage|storage|both]
+#                                       [--workers 8] [--batch-rows 2000000] [--dry-run]
+#
+# Files in the date range are read by a pool of worker processes, with timestamps converted in one vectorized
+# pass per file. Frames are combined into large load batches, and once a batch is loaded its files are moved to
+# the archive bucket in bulk (parallel copies, batched deletes). Before a batch is loaded, its names and its load
+# job id (derived from the table and the names) are saved in the state store. A restart after a crash looks that
+# job up: if it loaded, the files are archived instead of loaded twice, and otherwise they are simply picked up
+# again, like every file still in the source bucket. That makes the command resumable.
+#
+
+DEFAULT_BATCH_ROWS = 2000000
+
+
+def read_usage_file(url):
+    df = read_log_csv(url, get_usage_schema(True)[1])
+    return enrich_regions(usage_times_to_datetime(df))
+
+
+def read_storage_file(url_and_time):
+    url, report_time = url_and_time
+    return read_storage_report(url, report_time)
+
+
+def _state_key(project, kind):
+    return 'backfill/{0}-{1}.json'.format(project, kind)
+
+
+def _batch_job_id(kind, full_table, names):
+    digest = hashlib.sha1('\n'.join([full_table] + sorted(names)).encode('utf-8')).hexdigest()
+    return 'backfill_{0}_{1}'.format(kind, digest[:32])
+
+
+def _finish_pending(store, bq_client, storage_client, source_bucket, archive_bucket, project, kind, location):
+    """
+    Archive the files of a batch that a previous run loaded before it died
+    """
+    pending = store.get_json(_state_key(project, kind))
+    if not pending:
+        return
+    # A record without a job id was written by an older version, after its load had finished:
+    if 'job_id' not in pending or load_job_done(bq_client, pending['job_id'], location,
+                                                {'project': project, 'kind': kind}):
+        archived = archive_blobs(storage_client, source_bucket, archive_bucket, pending['loaded'])
+        logging.info('Archived {0} files loaded by an earlier backfill run'.format(len(archived)))
+    else:
+        logging.info('Load {0} of an earlier backfill run did not finish; its {1} files will be loaded again'.format(
+            pending['job_id'], len(pending['loaded'])))
+    store.delete(_state_key(project, kind))
+
+
+def backfill_kind(project, kind, listing, bq_client, storage_client, source_bucket, archive_bucket, full_table,
+                  workers, batch_rows, dry_run, store):
+    files = listing[listing['kind'] == kind].sort_values('time')
+    total = len(files)
+    logging.info('{0}: {1} {2} files to backfill'.format(project, total, kind))
+    if dry_run or total == 0:
+        return 0
+
+    if kind == 'usage':
+        reader = read_usage_file
+        work = ['gs://{0}/{1}'.format(source_bucket.name, name) for name in files['name']]
+        schema = get_usage_schema(False)[0]
+    else:
+        reader = read_storage_file
+        work = [('gs://{0}/{1}'.format(source_bucket.name, name), report_time)
+                for name, report_time in zip(files['name'], files['time'])]
+        schema = get_storage_schema(False)[0]
+    job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_APPEND")
+    location = settings['INGEST_STORAGE_LOGS_LOCATION']
+    names = list(files['name'])
+
+    done = 0
+    rows = 0
+    batch = []
+    batch_names = []
+    batch_rows_so_far = 0
+    start = time.perf_counter()
+
+    def flush():
+        combined = pd.concat(batch, ignore_index=True)
+        if kind == 'storage':
+            combined = collapse_storage_reports(combined)
+        job_id = _batch_job_id(kind, full_table, batch_names)
+        # Recorded before the load is submitted, so a crash at any point leaves a job id to look up:
+        store.put_json(_state_key(project, kind), {'loaded': batch_names, 'job_id': job_id})
+        if not load_dataframe(bq_client, combined, full_table, job_config, location, {'project': project,
+                                                                                     'kind': kind}, job_id):
+            raise Exception('Backfill load of {0} {1} files failed'.format(len(batch_names), kind))
+        if kind == 'usage' and rollups_enabled():
+            rollups = RollupAccumulator(bq_client, full_table, location, {'project': project, 'kind': kind})
+            rollups.add(combined, job_id)
+            rollups.flush()
+        archive_blobs(storage_client, source_bucket, archive_bucket, batch_names)
+        store.delete(_state_key(project, kind))
+
+    # Spawn rather than fork, so each worker gets its own gcsfs/event loop state:
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for name, df in zip(names, pool.imap(reader, work, chunksize=4)):
+            batch.append(df)
+            batch_names.append(name)
+            batch_rows_so_far += len(df)
+            if batch_rows_so_far >= batch_rows:
+                flush()
+                done += len(batch_names)
+                rows += batch_rows_so_far
+                batch, batch_names, batch_rows_so_far = [], [], 0
+                elapsed = time.perf_counter() - start
+                logging.info('{0} {1}: finished {2} of {3} files, {4} rows, {5:.1f} files/sec'.format(
+                    project, kind, done, total, rows, done / elapsed))
+        if batch:
+            flush()
+            done += len(batch_names)
+            rows += batch_rows_so_far
+
+    logging.info('{0} {1}: backfilled {2} files, {3} rows in {4:.0f} secs'.format(project, kind, done, rows,
+                                                                                 time.perf_counter() - start))
+    return rows
+
+
+def backfill_project(project, tag, start_date=None, end_date=None, prefix=None, kinds=('usage', 'storage'),
+                     workers=4, batch_rows=DEFAULT_BATCH_ROWS, dry_run=False):
+
+    DEPLOY_PROJECT_ID = settings['DEPLOY_PROJECT_ID']
+    SOURCE_BUCKET = settings['INGEST_STORAGE_LOGS_SOURCE_BUCKET']
+    ARCHIVE_BUCKET = settings['INGEST_STORAGE_LOGS_ARCHIVE_BUCKET']
+
+    bq_client = bigquery.Client(project=DEPLOY_PROJECT_ID)
+    storage_client = storage.Client(project=DEPLOY_PROJECT_ID)
+    store = get_state_store()
+
+    full_usage_table, full_storage_table = ensure_ingest_tables(bq_client, DEPLOY_PROJECT_ID, tag, False)
+    source_bucket = storage_client.bucket(SOURCE_BUCKET.format(project))
+    archive_bucket = storage_client.bucket(ARCHIVE_BUCKET.format(project))
+
+    for kind in kinds:
+        _finish_pending(store, bq_client, storage_client, source_bucket, archive_bucket, project, kind,
+                        settings['INGEST_STORAGE_LOGS_LOCATION'])
+
+    with api_call('storage'):
+        names = [blob.name for blob in storage_client.list_blobs(source_bucket.name, prefix=prefix)]
+    listing = parse_log_file_names(names)
+    listing = listing[listing['name'].map(strip_codec_suffix).str.endswith('_v0') & listing['time'].notna()]
+    if start_date is not None:
+        listing = listing[listing['time'] >= pd.Timestamp(start_date, tz='UTC')]
+    if end_date is not None:
+        listing = listing[listing['time'] < pd.Timestamp(end_date, tz='UTC')]
+
+    tables = {'usage': full_usage_table, 'storage': full_storage_table}
+    for kind in kinds:
+        backfill_kind(project, kind, listing, bq_client, storage_client, source_bucket, archive_bucket, tables[kind],
+                      workers, batch_rows, dry_run, store)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill historical storage logs into BigQuery')
+    parser.add_argument('--project', required=True, help='Project whose log bucket to drain')
+    parser.add_argument('--tag', required=True, help='Dataset tag for the project')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='First day to load (UTC)')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='Day to stop before (UTC)')
+    parser.add_argument('--prefix', help='Only consider log objects with this name prefix')
+    parser.add_argument('--kind', choices=['usage', 'storage', 'both'], default='both')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_BATCH_ROWS, help='Rows per load job')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be loaded')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    kinds = ('usage', 'storage') if args.kind == 'both' else (args.kind,)
+    backfill_project(args.project, args.tag, args.start, args.end, args.prefix, kinds, args.workers,
+                     args.batch_rows, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,14 +17,32 @@ limitations under the License.
 """
 
 import re
+import json
 import datetime
+import hashlib
+import itertools
 import time
+import uuid
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
 from google.cloud import bigquery
 import pandas as pd
 import numpy as np
-from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import NotFound, Conflict
 from config import settings
+from google_helpers.limiter import api_call, classify_exception, CircuitOpenError, THROTTLED, SERVER_ERROR
+from google_helpers.metrics import metrics
+from google_helpers.state_store import get_state_store
+from tasks.sharding import shard_pairs
+from tasks.task_runtime import project_work
+from tasks.ip_regions import enrich_regions
+from tasks.log_codecs import read_log_csv, codec_from_name, strip_codec_suffix, recompress_blob, \
+    CodecUnavailableError
+from tasks.usage_rollups import RollupAccumulator, rollups_enabled
+from tasks.request_dedup import RequestDeduper, dedup_enabled
+from google_helpers.storage_write import StorageWriter, StorageWriteError
 import logging
 
 
@@ -42,7 +60,8 @@ def get_usage_schema(for_read):
                              description='The type of IP in the c_ip field:  A value of 1 indicates an IPV4 address. '
                                          'A value of 2 indicates an IPV6 address.'),
         bigquery.SchemaField("c_ip_region", "STRING", mode="NULLABLE",
-                             description='Reserved for future use.'),
+                             description='Region of c_ip from the IP range database '
+                                         '(INGEST_STORAGE_LOGS_IP_REGION_DB), if one is configured.'),
         bigquery.SchemaField("cs_method", "STRING", mode="NULLABLE",
                              description='The HTTP method of this request. The "cs" prefix indicates that this information '
                                          'was sent from the client to the server name'),
@@ -153,9 +172,8 @@ def get_storage_schema(for_read):
 def bq_table_exists(client, target_dataset, dest_table):
     table_ref = client.dataset(target_dataset).table(dest_table)
     try:
-        print(table_ref)
-        client.get_table(table_ref)
-        print("got it")
+        with api_call('bigquery'):
+            client.get_table(table_ref)
         return True
     except NotFound:
         return False
@@ -166,7 +184,8 @@ def bq_table_exists(client, target_dataset, dest_table):
 
 def bq_dataset_exists(client, target_dataset):
     try:
-        client.get_dataset(target_dataset)
+        with api_call('bigquery'):
+            client.get_dataset(target_dataset)
         return True
     except NotFound:
         return False
@@ -178,96 +197,654 @@ def bq_dataset_exists(client, target_dataset):
 def delete_table_bq(client, target_dataset, delete_table):
     table_ref = client.dataset(target_dataset).table(delete_table)
     try:
-        client.delete_table(table_ref)
-        print('Table {}:{} deleted'.format(target_dataset, delete_table))
+        with api_call('bigquery'):
+            client.delete_table(table_ref)
+        logging.info('Table {}:{} deleted'.format(target_dataset, delete_table))
     except NotFound as ex:
-        print('Table {}:{} was not present'.format(target_dataset, delete_table))
+        logging.info('Table {}:{} was not present'.format(target_dataset, delete_table))
     except Exception as ex:
-        print(ex)
+        logging.exception(ex)
         return False
 
     return True
 
 #
-# Write the dataframe to bigQuery and archive the file if successful
+# Load a dataframe into a BQ table and wait for the job. run_load_job raises LoadFailedError if the job
+# finished with an error; load_dataframe returns True if it worked.
+#
+# Every load gets a job id up front, so submitting it again is safe: if an earlier submit got through (the call
+# failed after BigQuery accepted it, or an earlier run died before archiving the file), BigQuery answers 409
+# Conflict and we wait on that job instead of loading the rows a second time. Pass a job_id derived from the
+# source files (load_job_id) to make that hold across runs; if the job under an id failed, the next attempt
+# uses <id>_2, <id>_3, ... Polls of the job are retried on their own.
 #
 
-def write_to_bucket(bq_client, df, source_bucket, archive_bucket, blob, job_config, location, full_table_name):
+class LoadFailedError(Exception):
+    """
+    A load job finished with an error result
+    """
+    def __init__(self, full_table_name, error_result):
+        super().__init__('Load into {0} failed: {1}'.format(full_table_name, error_result))
+        self.error_result = error_result
+        self.reason = (error_result or {}).get('reason')
 
-    write_job = bq_client.load_table_from_dataframe(df, full_table_name, location=location, job_config=job_config)
 
-    query_job = bq_client.get_job(write_job.job_id, location=location)
-    job_state = query_job.state
-    while job_state != 'DONE':
-        query_job = bq_client.get_job(write_job.job_id, location=location)
-        job_state = query_job.state
-        if job_state != 'DONE':
-            time.sleep(5)
+def load_job_id(kind, full_table_name, blobs):
+    """
+    A job id that is the same every time these files (name and generation) are loaded into this table
+    """
+    sources = sorted('{0}#{1}'.format(blob.name, blob.generation) for blob in blobs)
+    digest = hashlib.sha1('\n'.join([full_table_name] + sources).encode('utf-8')).hexdigest()
+    return 'ingest_{0}_{1}'.format(kind, digest[:32])
+
+
+def wait_for_job(bq_client, job_id, location, labels=None):
+    labels = labels or {}
+    poll_attempts = int(settings.get('INGEST_STORAGE_LOGS_LOAD_ATTEMPTS', 3))
+
+    def get_job():
+        with api_call('bigquery'):
+            return bq_client.get_job(job_id, location=location)
 
-    write_job = bq_client.get_job(write_job.job_id, location=location)
+    with metrics.span('ingest_load_wait', **labels):
+        job = with_retries(get_job, poll_attempts, labels, 'poll of {0}'.format(job_id))
+        while job.state != 'DONE':
+            time.sleep(5)
+            job = with_retries(get_job, poll_attempts, labels, 'poll of {0}'.format(job_id))
+    return job
+
+
+def run_load_job(bq_client, df, full_table_name, job_config, location, labels=None, job_id=None):
+
+    labels = labels or {}
+    base_id = job_id or 'ingest_{0}'.format(uuid.uuid4().hex)
+    submit_attempts = int(settings.get('INGEST_STORAGE_LOGS_LOAD_ATTEMPTS', 3))
+
+    for suffix in itertools.count(1):
+        attempt_id = base_id if suffix == 1 else '{0}_{1}'.format(base_id, suffix)
+
+        def submit():
+            with metrics.span('ingest_load', **labels), api_call('bigquery'):
+                return bq_client.load_table_from_dataframe(df, full_table_name, job_id=attempt_id,
+                                                           location=location, job_config=job_config)
+        try:
+            with_retries(submit, submit_attempts, labels, 'load into {0}'.format(full_table_name))
+        except Conflict:
+            # Submitted before, by an earlier attempt or run:
+            job = wait_for_job(bq_client, attempt_id, location, labels)
+            if job.error_result is None:
+                metrics.inc('ingest_loads_already_done', **labels)
+                logging.info('{0} was already loaded by job {1}'.format(full_table_name, attempt_id))
+                return
+            continue
+        break
+
+    write_job = wait_for_job(bq_client, attempt_id, location, labels)
     if write_job.error_result is not None:
-        print('Error result!! {}'.format(write_job.error_result))
+        metrics.inc('ingest_load_failures', **labels)
+        raise LoadFailedError(full_table_name, write_job.error_result)
+
+    metrics.inc('ingest_rows_loaded', len(df), **labels)
+
+
+def load_job_done(bq_client, job_id, location, labels=None):
+    """
+    Whether run_load_job with this job_id has loaded its rows: the job, or one of its numbered retries, succeeded
+    """
+    for suffix in itertools.count(1):
+        attempt_id = job_id if suffix == 1 else '{0}_{1}'.format(job_id, suffix)
+        try:
+            job = wait_for_job(bq_client, attempt_id, location, labels)
+        except NotFound:
+            return False
+        if job.error_result is None:
+            return True
+
+
+#
+# Ingest writes rows with a load job, or, with INGEST_STORAGE_LOGS_ENGINE=write_api, through the Storage Write
+# API (see google_helpers/storage_write.py), which makes them queryable without waiting on the load job queue.
+# Either way the rows are committed all at once or not at all. ingest_latency_secs is the time from a log file
+# being written to its rows being committed:
+#
+
+INGEST_ENGINES = ('load', 'write_api')
+LATENCY_BUCKETS = (60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 14400.0, 43200.0, 86400.0)
+
+
+def ingest_engine():
+    engine = settings.get('INGEST_STORAGE_LOGS_ENGINE', 'load')
+    if engine not in INGEST_ENGINES:
+        raise ValueError('INGEST_STORAGE_LOGS_ENGINE must be one of {0}, not {1}'.format(INGEST_ENGINES, engine))
+    return engine
+
+
+def write_rows(bq_client, writer, df, full_table_name, schema, location, labels, job_id=None):
+    """
+    Append df to the table with the writer if there is one, or a load job
+    """
+    if writer is not None:
+        # The job id marks the file, so a retry after a commit whose response was lost writes nothing:
+        writer.append(df, full_table_name, schema, labels, marker=job_id)
+        return
+    job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_APPEND")
+    run_load_job(bq_client, df, full_table_name, job_config, location, labels, job_id)
+
+
+def observe_latency(blob, writer, labels):
+    if blob.time_created is not None:
+        latency = (datetime.datetime.now(datetime.timezone.utc) - blob.time_created).total_seconds()
+        metrics.observe('ingest_latency_secs', latency, buckets=LATENCY_BUCKETS,
+                        engine='load' if writer is None else 'write_api', **labels)
+
+
+def load_dataframe(bq_client, df, full_table_name, job_config, location, labels=None, job_id=None):
+
+    try:
+        run_load_job(bq_client, df, full_table_name, job_config, location, labels, job_id)
+    except LoadFailedError as e:
+        logging.error('Error result!! {}'.format(e.error_result))
         return False
-    else:
-        source_bucket.copy_blob(blob, archive_bucket, blob.name)
+    return True
+
+#
+# Move a loaded file to the archive bucket, compressing it on the way if INGEST_STORAGE_LOGS_ARCHIVE_COMPRESSION
+# is set and it is not compressed already. archive_blobs does the same for many files at once:
+#
+
+def archive_blob(source_bucket, archive_bucket, blob, labels=None):
+
+    ARCHIVE_COMPRESSION = settings.get('INGEST_STORAGE_LOGS_ARCHIVE_COMPRESSION')
+
+    labels = labels or {}
+    with metrics.span('ingest_archive', **labels):
+        if ARCHIVE_COMPRESSION and codec_from_name(blob.name, blob.content_encoding) is None:
+            recompress_blob(blob, archive_bucket, ARCHIVE_COMPRESSION, labels)
+        else:
+            with api_call('storage'):
+                source_bucket.copy_blob(blob, archive_bucket, blob.name)
+        with api_call('storage'):
+            blob.delete()
+
+
+ARCHIVE_BATCH_SIZE = 100
+
+
+def archive_blobs(storage_client, source_bucket, archive_bucket, names, threads=16):
+    """
+    Copy the objects across in parallel (the shared storage limiter caps what is actually in flight), then
+    delete the copied ones ARCHIVE_BATCH_SIZE per batched request. Objects already gone are skipped.
+    """
+    compression = settings.get('INGEST_STORAGE_LOGS_ARCHIVE_COMPRESSION')
+
+    def copy_one(name):
+        try:
+            if compression and codec_from_name(name) is None:
+                blob = source_bucket.get_blob(name)
+                if blob is None:
+                    return None
+                recompress_blob(blob, archive_bucket, compression)
+            else:
+                with api_call('storage'):
+                    source_bucket.copy_blob(source_bucket.blob(name), archive_bucket, name)
+            return name
+        except NotFound:
+            return None
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        copied = [name for name in executor.map(metrics.bind(copy_one), names) if name is not None]
+
+    for start in range(0, len(copied), ARCHIVE_BATCH_SIZE):
+        with api_call('storage'):
+            with storage_client.batch():
+                for name in copied[start:start + ARCHIVE_BATCH_SIZE]:
+                    source_bucket.delete_blob(name)
+    return copied
+
+#
+# What to do when a file fails (failure_action):
+#   RETRY       throttling and backend errors. Retried up to INGEST_STORAGE_LOGS_LOAD_ATTEMPTS times with backoff,
+#               then the file is left in place for the next run, since there is nothing wrong with it.
+#   STOP        the service is down (open circuit) or we are not allowed to use it (401/403/404: bad credentials,
+#               missing permission, table or bucket). Every other file would fail the same way, so the project
+#               stops here and its files stay where they are.
+#   QUARANTINE  the file itself is bad: a bad name, a parse error, or a load BigQuery rejected as invalid. The
+#               file goes to <INGEST_STORAGE_LOGS_QUARANTINE_PREFIX><name> in the archive bucket (or
+#               INGEST_STORAGE_LOGS_QUARANTINE_BUCKET), next to a <name>.error.json record of what went wrong.
+#   SKIP        anything else, including a codec whose package is not installed. The file is left in place and the
+#               run goes on to the next one.
+#
+# Files left in place must not stall ingest. Each run lists from a cursor kept in the state store (list_blobs
+# start_offset, where the last run got to), so the next run carries on past whatever was left behind. When a
+# listing reaches the end of the bucket the cursor goes back to the start, so left files are tried again once per
+# pass over the bucket. A run that stops (STOP) leaves the cursor where it was.
+#
+
+RETRY = 'retry'
+STOP = 'stop'
+QUARANTINE = 'quarantine'
+SKIP = 'skip'
+
+TRANSIENT_LOAD_REASONS = ('backendError', 'internalError', 'rateLimitExceeded', 'timeout')
+SYSTEMIC_LOAD_REASONS = ('accessDenied', 'notFound', 'billingNotEnabled', 'quotaExceeded')
+INVALID_LOAD_REASONS = ('invalid',)
+SYSTEMIC_STATUSES = (401, 403, 404)
+PARSE_ERRORS = (ValueError, KeyError, EOFError, zlib.error)
+RETRY_BASE_SECS = 2.0
+RETRY_MAX_SECS = 30.0
+
+
+class BadLogFileError(Exception):
+    """
+    The file itself is unusable, e.g. it is not named like a log file
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def failure_action(e):
+    if isinstance(e, BadLogFileError):
+        return QUARANTINE
+    if isinstance(e, CircuitOpenError):
+        return STOP
+    if isinstance(e, LoadFailedError):
+        if e.reason in TRANSIENT_LOAD_REASONS:
+            return RETRY
+        if e.reason in SYSTEMIC_LOAD_REASONS:
+            return STOP
+        return QUARANTINE if e.reason in INVALID_LOAD_REASONS else SKIP
+    if isinstance(e, CodecUnavailableError):
+        # A missing package, which no retry fixes and which is not the file's fault:
+        return SKIP
+    status = getattr(e, 'code', None)
+    if status in SYSTEMIC_STATUSES:
+        return STOP
+    kind = classify_exception(e)
+    if kind in (THROTTLED, SERVER_ERROR):
+        return RETRY
+    if isinstance(e, StorageWriteError) and status == 400:
+        return QUARANTINE
+    if isinstance(e, PARSE_ERRORS):
+        return QUARANTINE
+    return SKIP
+
+
+def failure_reason(e):
+    if isinstance(e, BadLogFileError):
+        return e.reason
+    if isinstance(e, (LoadFailedError, StorageWriteError)):
+        return 'load_rejected'
+    return 'parse_error'
+
+
+def retry_delay(attempt):
+    return min(RETRY_BASE_SECS * 2 ** (attempt - 1), RETRY_MAX_SECS)
+
+
+def with_retries(func, attempts, labels, what):
+    """
+    func(), tried again with backoff while it fails with RETRY errors, up to attempts times
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if failure_action(e) != RETRY or attempt == attempts:
+                raise
+            metrics.inc('ingest_retries', **labels)
+            logging.warning('Retrying {0} after attempt {1}: {2}'.format(what, attempt, str(e)))
+            time.sleep(retry_delay(attempt))
+
+
+def quarantine_blob(storage_client, source_bucket, blob, project, reason, error, attempts, labels=None):
+
+    QUARANTINE_BUCKET = settings.get('INGEST_STORAGE_LOGS_QUARANTINE_BUCKET',
+                                     settings['INGEST_STORAGE_LOGS_ARCHIVE_BUCKET'])
+    QUARANTINE_PREFIX = settings.get('INGEST_STORAGE_LOGS_QUARANTINE_PREFIX', 'quarantine/')
+
+    labels = labels or {}
+    quarantine_bucket = storage_client.bucket(QUARANTINE_BUCKET.format(project))
+    quarantine_name = '{0}{1}'.format(QUARANTINE_PREFIX, blob.name)
+    record = {
+        'file': 'gs://{0}/{1}'.format(source_bucket.name, blob.name),
+        'quarantined_as': 'gs://{0}/{1}'.format(quarantine_bucket.name, quarantine_name),
+        'reason': reason,
+        'error_type': type(error).__name__,
+        'error': str(error),
+        'attempts': attempts,
+        'size': blob.size,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    with api_call('storage'):
+        source_bucket.copy_blob(blob, quarantine_bucket, quarantine_name)
+    with api_call('storage'):
+        quarantine_bucket.blob('{0}.error.json'.format(quarantine_name)).upload_from_string(
+            json.dumps(record, indent=2), content_type='application/json')
+    with api_call('storage'):
         blob.delete()
+    metrics.inc('ingest_quarantined', reason=reason, **labels)
+    logging.error('Quarantined {0} ({1}): {2}'.format(record['file'], reason, record['error']))
+
+
+def handle_failure(storage_client, source_bucket, blob, project, failure, attempts, failures, labels):
+    """
+    Count a file that could not be ingested and quarantine it if that is the action. Returns the action
+    """
+    action = failure_action(failure)
+    reason = failure_reason(failure) if action == QUARANTINE else action
+    failures[reason] += 1
+    metrics.inc('ingest_failures', reason=reason, **labels)
+    if action == QUARANTINE:
+        quarantine_blob(storage_client, source_bucket, blob, project, reason, failure, attempts, labels)
+    elif action == STOP:
+        # Not the file: the service is down or we may not use it, and the rest would fail the same way
+        logging.error('Stopping {0} at {1}: {2}'.format(project, blob.name, str(failure)))
+    else:
+        logging.error('Leaving {0} for the next run: {1}'.format(blob.name, str(failure)))
+    return action
 
-    return True
 #
-# Argument-free timestamp conversion function:
+# Usage logs carry a microsecond unix timestamp; swap it for a datetime column, converted in one vectorized pass:
 #
 
-def convert(timestamp):
-    return pd.to_datetime(timestamp, unit='us', utc=True)
+def usage_times_to_datetime(df):
+    df.insert(0, 'time', pd.to_datetime(df['time_micros'], unit='us', utc=True))
+    return df.drop('time_micros', axis=1)
+
+#
+# Log file names carry the time of the report, e.g. <bucket>_usage_2020_06_01_14_00_00_<id>_v0. Parse the
+# whole listing in one pass; names that do not match come back as NaT:
+#
 
+LOG_FILE_NAME_RE = r'_(?P<kind>usage|storage)_(?P<stamp>\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})_'
+
+
+def parse_log_file_names(names):
+    parsed = pd.Series(list(names), dtype=object).str.extract(LOG_FILE_NAME_RE)
+    parsed['time'] = pd.to_datetime(parsed['stamp'], format='%Y_%m_%d_%H_%M_%S', utc=True, errors='coerce')
+    parsed['name'] = list(names)
+    return parsed[['name', 'kind', 'time']]
+
+#
+# Layout of the ingest tables: day partitions on time, clustered on the columns we filter by, optionally with
+# partition expiration. Set per table in the config file, e.g.:
+#   INGEST_STORAGE_LOGS_USAGE_CLUSTERING=cs_bucket,cs_operation,c_ip
+#   INGEST_STORAGE_LOGS_USAGE_PARTITION_EXPIRATION_DAYS=400
+# An empty clustering setting means no clustering. tasks/relayout_tables.py moves existing tables to the layout.
+#
+
+DEFAULT_CLUSTERING = {
+    'USAGE': 'cs_bucket,cs_operation,c_ip',
+    'STORAGE': 'bucket',
+}
+
+
+def table_layout(kind):
+    clustering = settings.get('INGEST_STORAGE_LOGS_{0}_CLUSTERING'.format(kind), DEFAULT_CLUSTERING[kind])
+    clustering_fields = [field.strip() for field in clustering.split(',') if field.strip()] or None
+    expiration_days = settings.get('INGEST_STORAGE_LOGS_{0}_PARTITION_EXPIRATION_DAYS'.format(kind))
+    expiration_ms = int(float(expiration_days) * 86400000) if expiration_days else None
+    return clustering_fields, expiration_ms
+
+
+def apply_table_layout(table, kind):
+    clustering_fields, expiration_ms = table_layout(kind)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="time",
+                                                        expiration_ms=expiration_ms)
+    table.clustering_fields = clustering_fields
+    return table
 
 #
-# Do the work for a project
+# If tables do not exist, create them. Can also delete them first. Returns the full usage and storage table names:
 #
 
-def sink_from_bucket_to_table_for_project(project, tag, bq_client, storage_client, deploy_project):
+def ensure_ingest_tables(bq_client, deploy_project, tag, do_delete_first):
 
     DATASET_BASE = settings['INGEST_STORAGE_LOGS_DATASET_BASE']
     USAGE_TABLE = settings['INGEST_STORAGE_LOGS_USAGE_TABLE']
     STORAGE_TABLE = settings['INGEST_STORAGE_LOGS_STORAGE_TABLE']
-    SOURCE_BUCKET = settings['INGEST_STORAGE_LOGS_SOURCE_BUCKET']
-    ARCHIVE_BUCKET = settings['INGEST_STORAGE_LOGS_ARCHIVE_BUCKET']
     LOCATION = settings['INGEST_STORAGE_LOGS_LOCATION']
-    DO_DELETE_FIRST = (settings['INGEST_STORAGE_LOGS_DO_DELETE_FIRST'] == "True")
-    LOG_FILES_PER_RUN = int(settings['INGEST_STORAGE_LOGS_FILES_PER_RUN'])
-
-    #
-    # If tables do not exist, create them. Can also delete them first:
-    #
 
     full_dataset = "{}{}".format(DATASET_BASE, tag)
     proj_dataset = "{}.{}".format(deploy_project, full_dataset)
     if not bq_dataset_exists(bq_client, proj_dataset):
         dataset = bigquery.Dataset(proj_dataset)
         dataset.location = LOCATION
-        bq_client.create_dataset(dataset)
+        with api_call('bigquery'):
+            bq_client.create_dataset(dataset)
 
     full_usage_table = "{}.{}.{}".format(deploy_project, full_dataset, USAGE_TABLE)
 
-    if DO_DELETE_FIRST:
+    if do_delete_first:
         if bq_table_exists(bq_client, full_dataset, USAGE_TABLE):
             delete_table_bq(bq_client, full_dataset, USAGE_TABLE)
 
     if not bq_table_exists(bq_client, full_dataset, USAGE_TABLE):
         table = bigquery.Table(full_usage_table, schema=get_usage_schema(False)[0])
-        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="time")
-        bq_client.create_table(table)
+        apply_table_layout(table, 'USAGE')
+        with api_call('bigquery'):
+            bq_client.create_table(table)
 
     full_storage_table = "{}.{}.{}".format(deploy_project, full_dataset, STORAGE_TABLE)
 
-    if DO_DELETE_FIRST:
+    if do_delete_first:
         if bq_table_exists(bq_client, full_dataset, STORAGE_TABLE):
             delete_table_bq(bq_client, full_dataset, STORAGE_TABLE)
 
     if not bq_table_exists(bq_client, full_dataset, STORAGE_TABLE):
         table = bigquery.Table(full_storage_table, schema=get_storage_schema(False)[0])
-        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="time")
-        bq_client.create_table(table)
+        apply_table_layout(table, 'STORAGE')
+        with api_call('bigquery'):
+            bq_client.create_table(table)
+
+    return full_usage_table, full_storage_table
+
+#
+# Read and load one usage log. Raises if it cannot be ingested; returns the labels for the file, or None if it
+# is not a usage log. Storage reports are loaded together by ingest_storage_reports, so one reaching here has a
+# name we could not get a report time from:
+#
+
+def ingest_blob(blob, url, bq_client, full_usage_table, location, labels, rollups, dedup=None, writer=None):
+
+    if re.search("^.*_v0$", strip_codec_suffix(str(blob.name))) is None:
+        raise BadLogFileError('bad_name', 'Not a log file name: {}'.format(blob.name))
+
+    if "_usage_2" in blob.name:
+        usage_labels = dict(labels, kind='usage')
+        metrics.inc('ingest_files', **usage_labels)
+        metrics.inc('ingest_bytes_read', blob.size or 0, **usage_labels)
+        #
+        # Process usage files, which have a microsecond unix timestamp which we convert to a datetime:
+        #
+        with metrics.span('ingest_parse', **usage_labels):
+            df = read_log_csv(url, get_usage_schema(True)[1], usage_labels)
+            df = usage_times_to_datetime(df)
+        metrics.inc('ingest_rows_parsed', len(df), **usage_labels)
+        if dedup is not None:
+            df = dedup.drop_seen(df)
+            if df.empty:
+                # Every row was loaded before (we died between the load and the archive); just archive it:
+                dedup.commit()
+                return usage_labels
+        df = enrich_regions(df, usage_labels)
+
+        job_id = load_job_id('usage', full_usage_table, [blob])
+        write_rows(bq_client, writer, df, full_usage_table, get_usage_schema(False)[0], location, usage_labels,
+                   job_id)
+        observe_latency(blob, writer, usage_labels)
+        if rollups is not None:
+            # Staged before the file is archived, under the file's id, so staging it again changes nothing:
+            rollups.add(df, job_id)
+        if dedup is not None:
+            # Saved before the file is archived, so a rerun from here on drops the rows:
+            dedup.commit()
+        return usage_labels
+
+    elif "_storage_2" in blob.name:
+        raise BadLogFileError('bad_name', 'No report time in storage log name: {}'.format(blob.name))
+
+    raise BadLogFileError('bad_name', 'Neither a usage nor a storage log: {}'.format(blob.name))
+
+#
+# Storage reports are tiny (a row per bucket, a report a day), so rather than a load job per file, every report
+# in the listing is read (in parallel, with the storage dtypes), stamped with the report time from its name,
+# merged, and loaded in one write. Reports for the same bucket and day collapse to the latest one. The loaded
+# names are saved in the state store before the files are archived in bulk, and a later run that finds them
+# there archives them instead of loading them again.
+#
+
+STORAGE_REPORT_READ_THREADS = 8
+
+
+def read_storage_report(url, report_time, labels=None):
+    df = read_log_csv(url, get_storage_schema(True)[1], labels)
+    df.insert(0, 'time', pd.Timestamp(report_time))
+    return df
+
+
+def collapse_storage_reports(df):
+    """
+    One row per bucket per day, from the latest report of the day
+    """
+    day = df['time'].dt.floor('D')
+    latest = df.assign(day=day).sort_values('time', kind='stable').drop_duplicates(['day', 'bucket'], keep='last')
+    return latest.drop(columns='day').sort_values(['time', 'bucket']).reset_index(drop=True)
+
+
+def _storage_pending_key(project):
+    return 'ingest_storage_pending/{0}.json'.format(project)
+
+
+def _listing_cursor_key(project):
+    return 'ingest_cursor/{0}.json'.format(project)
+
+
+def ingest_storage_reports(reports, bq_client, storage_client, source_bucket, archive_bucket, full_storage_table,
+                           location, labels, writer=None, load_attempts=3, store=None):
+    """
+    reports is a list of (blob, report time). Returns a Counter of failed files by reason
+    """
+    project = labels['project']
+    storage_labels = dict(labels, kind='storage')
+    store = store or get_state_store()
+    failures = Counter()
+
+    pending = store.get_json(_storage_pending_key(project))
+    if pending:
+        archived = archive_blobs(storage_client, source_bucket, archive_bucket, pending['loaded'])
+        logging.info('Archived {0} storage reports loaded by an earlier run'.format(len(archived)))
+        store.delete(_storage_pending_key(project))
+        done = set(pending['loaded'])
+        reports = [(blob, report_time) for blob, report_time in reports if blob.name not in done]
+    if not reports:
+        return failures
+
+    def read_one(report):
+        blob, report_time = report
+        url = "gs://{}/{}".format(source_bucket.name, blob.name)
+        try:
+            return with_retries(lambda: read_storage_report(url, report_time, storage_labels), load_attempts, labels,
+                                'read of {0}'.format(blob.name)), None
+        except Exception as e:
+            return None, e
+
+    with metrics.span('ingest_parse', **storage_labels):
+        with ThreadPoolExecutor(max_workers=STORAGE_REPORT_READ_THREADS) as executor:
+            results = list(executor.map(metrics.bind(read_one), reports))
+
+    batch = []
+    for (blob, _), (df, error) in zip(reports, results):
+        metrics.inc('ingest_files', **storage_labels)
+        metrics.inc('ingest_bytes_read', blob.size or 0, **storage_labels)
+        if error is None:
+            batch.append((blob, df))
+            metrics.inc('ingest_rows_parsed', len(df), **storage_labels)
+        else:
+            attempts = load_attempts if failure_action(error) == RETRY else 1
+            if handle_failure(storage_client, source_bucket, blob, project, error, attempts, failures,
+                              labels) == STOP:
+                return failures
+    if not batch:
+        return failures
+
+    # One load for the whole batch. If BigQuery rejects it, the bad report is found by halving: each half is
+    # loaded on its own, until a rejected half is a single report, which is quarantined. The rest still load.
+    batches = [batch]
+    unarchived = []
+    while batches:
+        batch = batches.pop(0)
+        blobs = [blob for blob, _ in batch]
+        combined = pd.concat([df for _, df in batch], ignore_index=True)
+        merged = collapse_storage_reports(combined)
+        try:
+            with_retries(lambda: write_rows(bq_client, writer, merged, full_storage_table,
+                                            get_storage_schema(False)[0], location, storage_labels,
+                                            load_job_id('storage', full_storage_table, blobs)),
+                         load_attempts, labels, 'storage report load')
+        except Exception as failure:
+            action = failure_action(failure)
+            if action == QUARANTINE and len(batch) > 1:
+                metrics.inc('storage_report_batch_splits', **storage_labels)
+                logging.warning('{0}: load of {1} storage reports rejected, splitting it: {2}'.format(
+                    project, len(batch), str(failure)))
+                half = len(batch) // 2
+                batches[:0] = [batch[:half], batch[half:]]
+                continue
+            attempts = load_attempts if action == RETRY else 1
+            for blob in blobs:
+                if handle_failure(storage_client, source_bucket, blob, project, failure, attempts, failures,
+                                  labels) == STOP:
+                    return failures
+            continue
+
+        metrics.inc('storage_report_rows_collapsed', len(combined) - len(merged), **storage_labels)
+        for blob in blobs:
+            observe_latency(blob, writer, storage_labels)
+        names = [blob.name for blob in blobs]
+        unarchived.extend(names)
+        store.put_json(_storage_pending_key(project), {'loaded': unarchived})
+        try:
+            with metrics.span('ingest_archive', **storage_labels):
+                with_retries(lambda: archive_blobs(storage_client, source_bucket, archive_bucket, names),
+                             load_attempts, labels, 'archive of storage reports')
+        except Exception as e:
+            # The pending record stays, so the next run archives these before loading anything:
+            failures['archive'] += len(names)
+            metrics.inc('ingest_failures', len(names), reason='archive', **labels)
+            logging.error('{0}: could not archive {1} storage reports: {2}'.format(project, len(names), str(e)))
+            if failure_action(e) == STOP:
+                failures[STOP] += 1
+                return failures
+            continue
+        if writer is not None:
+            writer.forget(load_job_id('storage', full_storage_table, blobs))
+        unarchived = unarchived[:-len(names)]
+        if unarchived:
+            store.put_json(_storage_pending_key(project), {'loaded': unarchived})
+        else:
+            store.delete(_storage_pending_key(project))
+        logging.info('{0}: loaded {1} storage reports as {2} rows'.format(project, len(names), len(merged)))
+    return failures
+
+#
+# Do the work for a project. Each archived blob is a safe point: once a file is loaded it is moved out of the
+# source bucket, so stopping between files loses nothing. A file that fails is retried if the failure looks
+# transient and quarantined otherwise; either way the run goes on to the next file. Storage reports go first, all
+# in one batch (ingest_storage_reports). Returns False if we stopped because the run is out of time:
+#
+
+def sink_from_bucket_to_table_for_project(project, tag, bq_client, storage_client, deploy_project, run=None):
+
+    SOURCE_BUCKET = settings['INGEST_STORAGE_LOGS_SOURCE_BUCKET']
+    ARCHIVE_BUCKET = settings['INGEST_STORAGE_LOGS_ARCHIVE_BUCKET']
+    LOCATION = settings['INGEST_STORAGE_LOGS_LOCATION']
+    DO_DELETE_FIRST = (settings['INGEST_STORAGE_LOGS_DO_DELETE_FIRST'] == "True")
+    LOG_FILES_PER_RUN = int(settings['INGEST_STORAGE_LOGS_FILES_PER_RUN'])
+    LOAD_ATTEMPTS = int(settings.get('INGEST_STORAGE_LOGS_LOAD_ATTEMPTS', 3))
+
+    full_usage_table, full_storage_table = ensure_ingest_tables(bq_client, deploy_project, tag, DO_DELETE_FIRST)
 
     ##
     ## Get a listing of files. Then, loop through the files, read each into a dataframe, massage the timestamps,
@@ -279,77 +856,95 @@ def sink_from_bucket_to_table_for_project(project, tag, bq_client, storage_clien
 
     source_bucket = storage_client.bucket(full_source_bucket)
     archive_bucket = storage_client.bucket(full_archive_bucket)
-    blobs = storage_client.list_blobs(full_source_bucket)
-    file_count = 0
-    for blob in blobs:
-        if file_count > LOG_FILES_PER_RUN:
-            break
-        file_count += 1
-        if re.search("^.*_v0$", str(blob.name)) is None:
-            raise Exception()
-        url = "gs://{}/{}".format(full_source_bucket, blob.name)
-
-        if "_usage_2" in blob.name:
-            #
-            # Process usage files, which have a microsecond unix timestamp which we convert to a datetime:
-            #
-            df = pd.read_csv(url, dtype=get_usage_schema(True)[1])
-            #
-            # Yeah, newlbie pandas adding a column, writing into it, and deleting the orginal:
-            #
-            df = df.reindex(columns=['time'] + df.columns.tolist())
-            df['time']= pd.to_datetime(df['time'])
-            print(df.info())
-            df['time'] = df['time_micros'].apply(convert)
-            df = df.drop('time_micros', axis=1)
-
-            job_config = bigquery.LoadJobConfig(
-                schema=get_usage_schema(False)[0],
-                write_disposition="WRITE_APPEND"
-            )
-
-            if not write_to_bucket(bq_client, df, source_bucket, archive_bucket, blob, job_config, LOCATION, full_usage_table):
-                raise Exception()
-
-            df = None
-
-        elif "_storage_2" in blob.name:
-            #
-            # Process storage files, which have the date of the file in the filename (!?!?!):
-            parse_it = blob.name.split("_storage_2")
-            parse_it = parse_it[1].split("_")
-            year = int("2{}".format(parse_it[0]))
-            month =  int(parse_it[1])
-            day = int(parse_it[2])
-            hour = int(parse_it[3])
-            minute = int(parse_it[4])
-            second = int(parse_it[5])
-            time_o_day = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc)
-            df = pd.read_csv(url, dtype=get_usage_schema(True)[1])
-            #
-            # Add a column with the datetime:
-            #
-            df = df.reindex(columns=['time'] + df.columns.tolist())
-            df['time'] = pd.to_datetime(df['time'])
-            df['time'] = time_o_day
-            print(df.info())
-            print(df)
-
-            job_config = bigquery.LoadJobConfig(
-                schema=get_storage_schema(False)[0],
-                write_disposition="WRITE_APPEND"
-            )
-
-            if not write_to_bucket(bq_client, df, source_bucket, archive_bucket, blob, job_config, LOCATION, full_storage_table):
-                raise Exception()
-
-            df = None
+    labels = {'project': project, 'tag': tag}
+    store = get_state_store()
+    start_offset = (store.get_json(_listing_cursor_key(project)) or {}).get('start_offset', '')
+    with metrics.span('ingest_list', **labels), api_call('storage'):
+        blobs = list(storage_client.list_blobs(full_source_bucket, max_results=LOG_FILES_PER_RUN + 1,
+                                               start_offset=start_offset or None))
+    # Where the next run lists from: after a full listing its last file (start_offset is inclusive), else the start:
+    resume_at = blobs[-1].name if len(blobs) > LOG_FILES_PER_RUN else ''
+    rollups = RollupAccumulator(bq_client, full_usage_table, LOCATION, labels) if rollups_enabled() else None
+    dedup = RequestDeduper(project, labels=labels) if dedup_enabled() else None
+    writer = StorageWriter() if ingest_engine() == 'write_api' else None
+
+    # Report times for the whole listing in one pass; the storage reports among them are loaded as one batch:
+    listing = parse_log_file_names([blob.name for blob in blobs])
+    is_report = (listing['kind'] == 'storage') & listing['time'].notna() & \
+        pd.Series([strip_codec_suffix(blob.name).endswith('_v0') for blob in blobs], dtype=bool)
+    reports = [(blob, report_time) for blob, report_time, report in zip(blobs, listing['time'], is_report) if report]
+    blobs = [blob for blob, report in zip(blobs, is_report) if not report]
+
+    failures = Counter()
+    stopped = False
+    try:
+        failures.update(ingest_storage_reports(reports, bq_client, storage_client, source_bucket, archive_bucket,
+                                               full_storage_table, LOCATION, labels, writer, LOAD_ATTEMPTS,
+                                               store))
+        file_count = len(reports)
+        for blob in (blobs if not failures[STOP] else []):
+            if file_count > LOG_FILES_PER_RUN:
+                resume_at = blob.name
+                break
+            if run is not None and run.out_of_time():
+                store.put_json(_listing_cursor_key(project), {'start_offset': blob.name})
+                return False
+            file_count += 1
+            url = "gs://{}/{}".format(full_source_bucket, blob.name)
+
+            failure = None
+            for attempt in range(1, LOAD_ATTEMPTS + 1):
+                try:
+                    file_labels = ingest_blob(blob, url, bq_client, full_usage_table, LOCATION, labels, rollups,
+                                              dedup, writer)
+                    failure = None
+                    break
+                except Exception as e:
+                    failure = e
+                    if failure_action(e) != RETRY or attempt == LOAD_ATTEMPTS:
+                        break
+                    metrics.inc('ingest_retries', **labels)
+                    logging.warning('Retrying {0} after attempt {1}: {2}'.format(blob.name, attempt, str(e)))
+                    time.sleep(retry_delay(attempt))
+
+            if failure is not None:
+                if handle_failure(storage_client, source_bucket, blob, project, failure, attempt, failures,
+                                  labels) == STOP:
+                    break
+                continue
+
+            # Retried on its own, not by loading the file again. If it still fails the file stays, and the
+            # next run finds its load job already done (load_job_id) instead of loading it twice:
+            try:
+                with_retries(lambda: archive_blob(source_bucket, archive_bucket, blob, file_labels),
+                             LOAD_ATTEMPTS, labels, 'archive of {0}'.format(blob.name))
+                if writer is not None:
+                    writer.forget(load_job_id('usage', full_usage_table, [blob]))
+            except Exception as e:
+                failures['archive'] += 1
+                metrics.inc('ingest_failures', reason='archive', **labels)
+                logging.error('Could not archive {0}: {1}'.format(blob.name, str(e)))
+                if failure_action(e) == STOP:
+                    stopped = True
+                    break
+
+        if not (stopped or failures[STOP]) and resume_at != start_offset:
+            store.put_json(_listing_cursor_key(project), {'start_offset': resume_at})
+    finally:
+        # Everything added is staged, so this only brings the rollup tables up to date, and does not raise:
+        if rollups is not None:
+            rollups.flush()
+        if failures:
+            logging.warning('{0}: {1} files failed this run: {2}'.format(project, sum(failures.values()),
+                                                                        dict(failures)))
+
+    return True
 
 #
 # Main access point
 #
 
-def sink_from_bucket_to_table():
+def sink_from_bucket_to_table(run=None, shard=None):
 
     DEPLOY_PROJECT_ID = settings['DEPLOY_PROJECT_ID']
     PROJECT_IDS=settings['INGEST_STORAGE_LOGS_PROJECT_IDS']
@@ -366,8 +961,23 @@ def sink_from_bucket_to_table():
     project_list = PROJECT_IDS.split(',')
     tag_list = PROJECT_TAGS.split(',')
 
-    for project, tag in zip(project_list, tag_list):
-        sink_from_bucket_to_table_for_project(project, tag, bq_client, storage_client, DEPLOY_PROJECT_ID)
+    for project, tag, _ in project_work(run, shard_pairs(project_list, tag_list, shard)):
+        try:
+            finished = sink_from_bucket_to_table_for_project(project, tag, bq_client, storage_client,
+                                                             DEPLOY_PROJECT_ID, run)
+        except Exception as e:
+            # Keep going with the other projects; this one is picked up again next run:
+            logging.error('Ingest for {0} failed'.format(project))
+            logging.exception(e)
+            metrics.inc('ingest_project_failures', project=project, tag=tag)
+            continue
+        if not finished:
+            # Files are archived as they load, so there is nothing else to remember:
+            return run.stop({})
+
+    if run is not None:
+        return run.complete()
+    return True
 
 
 if __name__ == '__main__':
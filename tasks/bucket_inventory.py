@@ -0,0 +1,218 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import datetime
+from google.cloud import storage
+from google.cloud import bigquery
+import pandas as pd
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from tasks.bucket_access_to_bq import bq_table_exists, load_dataframe
+from tasks.sharding import shard_pairs
+from tasks.task_runtime import project_work
+from config import settings
+import logging
+
+#
+# Bucket inventory, replacing scripts/calc_buck_bytes.sh. For each ingest project, one paged list_buckets call
+# gives us every bucket's metadata (requester-pays, uniform access, storage class, location). That is joined
+# with the latest storage_byte_hours loaded by sink_from_bucket_to_table. Storage reports arrive daily, so only
+# the last INVENTORY_STORAGE_WINDOW_DAYS (default 2) of the day-partitioned storage table are read, once per table
+# per run; a bucket with no report in that window gets null storage columns. The snapshots of all projects are
+# appended to each inventory table in one load job at the end of the run (or when it runs out of time). A run
+# that dies before that loses only its own snapshot, and the next run takes a new one.
+#
+
+
+def get_inventory_schema():
+    inventory_schema = [
+        bigquery.SchemaField("snapshot_time", "TIMESTAMP", mode="REQUIRED",
+                             description='When the inventory was taken'),
+        bigquery.SchemaField("project", "STRING", mode="REQUIRED",
+                             description='The project owning the bucket.'),
+        bigquery.SchemaField("bucket", "STRING", mode="REQUIRED",
+                             description='The name of the bucket.'),
+        bigquery.SchemaField("requester_pays", "BOOLEAN", mode="NULLABLE",
+                             description='True if requester pays is enabled on the bucket.'),
+        bigquery.SchemaField("uniform_bucket_level_access", "BOOLEAN", mode="NULLABLE",
+                             description='True if the bucket uses uniform bucket-level access (no ACLs).'),
+        bigquery.SchemaField("storage_class", "STRING", mode="NULLABLE",
+                             description='The default storage class of the bucket.'),
+        bigquery.SchemaField("location", "STRING", mode="NULLABLE",
+                             description='The location of the bucket.'),
+        bigquery.SchemaField("location_type", "STRING", mode="NULLABLE",
+                             description='region, dual-region or multi-region.'),
+        bigquery.SchemaField("time_created", "TIMESTAMP", mode="NULLABLE",
+                             description='When the bucket was created.'),
+        bigquery.SchemaField("storage_report_time", "TIMESTAMP", mode="NULLABLE",
+                             description='Time of the latest storage report for the bucket.'),
+        bigquery.SchemaField("storage_byte_hours", "INTEGER", mode="NULLABLE",
+                             description='storage_byte_hours from the latest storage report.'),
+        bigquery.SchemaField("storage_bytes", "INTEGER", mode="NULLABLE",
+                             description='Average size of the bucket in bytes (storage_byte_hours / 24).'),
+    ]
+    return inventory_schema
+
+#
+# Latest storage report per bucket:
+#
+
+def latest_storage_sql(storage_table, window_days):
+
+    return '''
+        SELECT
+            latest.bucket,
+            latest.time AS storage_report_time,
+            latest.storage_byte_hours
+        FROM (
+            SELECT ARRAY_AGG(a ORDER BY a.time DESC LIMIT 1)[OFFSET(0)] AS latest
+            FROM `{0}` AS a
+            WHERE a.time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {1} DAY)
+            GROUP BY a.bucket
+        )
+        '''.format(storage_table, int(window_days))
+
+#
+# One row per bucket, from a single paged listing:
+#
+
+def list_bucket_metadata(storage_client, project):
+    rows = []
+    with api_call('storage'):
+        buckets = list(storage_client.list_buckets(project=project))
+    for bucket in buckets:
+        iam_config = bucket.iam_configuration
+        rows.append({
+            'project': project,
+            'bucket': bucket.name,
+            'requester_pays': bool(bucket.requester_pays),
+            'uniform_bucket_level_access': bool(iam_config.uniform_bucket_level_access_enabled),
+            'storage_class': bucket.storage_class,
+            'location': bucket.location,
+            'location_type': bucket.location_type,
+            'time_created': bucket.time_created,
+        })
+    return pd.DataFrame(rows, columns=['project', 'bucket', 'requester_pays', 'uniform_bucket_level_access',
+                                       'storage_class', 'location', 'location_type', 'time_created'])
+
+
+def inventory_for_project(project, tag, bq_client, storage_client, deploy_project, snapshot_time, latest_storage):
+    """
+    The inventory snapshot of one project, as (inventory table, frame). latest_storage caches the latest storage
+    reports by storage table for the run
+    """
+    DATASET_BASE = settings['INGEST_STORAGE_LOGS_DATASET_BASE']
+    STORAGE_TABLE = settings['INGEST_STORAGE_LOGS_STORAGE_TABLE']
+    INVENTORY_TABLE = settings.get('INGEST_STORAGE_LOGS_INVENTORY_TABLE', 'bucket_inventory')
+    WINDOW_DAYS = int(settings.get('INVENTORY_STORAGE_WINDOW_DAYS', 2))
+    LOCATION = settings['INGEST_STORAGE_LOGS_LOCATION']
+
+    labels = {'project': project, 'tag': tag}
+    full_dataset = "{}{}".format(DATASET_BASE, tag)
+    full_storage_table = "{}.{}.{}".format(deploy_project, full_dataset, STORAGE_TABLE)
+    full_inventory_table = "{}.{}.{}".format(deploy_project, full_dataset, INVENTORY_TABLE)
+
+    with metrics.span('inventory_list', **labels):
+        df = list_bucket_metadata(storage_client, project)
+    metrics.inc('inventory_buckets', len(df), **labels)
+
+    if full_storage_table not in latest_storage:
+        if bq_table_exists(bq_client, full_dataset, STORAGE_TABLE):
+            with metrics.span('inventory_storage_query', **labels), api_call('bigquery'):
+                latest_storage[full_storage_table] = bq_client.query(
+                    latest_storage_sql(full_storage_table, WINDOW_DAYS), location=LOCATION).to_dataframe()
+        else:
+            latest_storage[full_storage_table] = pd.DataFrame(
+                columns=['bucket', 'storage_report_time', 'storage_byte_hours'])
+
+    df = df.merge(latest_storage[full_storage_table], on='bucket', how='left')
+    df['storage_byte_hours'] = df['storage_byte_hours'].astype('Int64')
+    df['storage_bytes'] = (df['storage_byte_hours'] // 24).astype('Int64')
+    df.insert(0, 'snapshot_time', snapshot_time)
+
+    requester_pays = df.loc[df['requester_pays'], 'bucket'].tolist()
+    logging.info('{0}: {1} buckets, {2} requester pays: {3}'.format(project, len(df), len(requester_pays),
+                                                                   ', '.join(requester_pays)))
+    return full_inventory_table, df
+
+
+def load_inventory(bq_client, snapshots):
+    """
+    Append the collected snapshots, a list of frames by inventory table, with one load job per table
+    """
+    LOCATION = settings['INGEST_STORAGE_LOGS_LOCATION']
+
+    all_loaded = True
+    for full_inventory_table, frames in snapshots.items():
+        project, dataset, table_name = full_inventory_table.split('.')
+        if not bq_table_exists(bq_client, dataset, table_name):
+            table = bigquery.Table(full_inventory_table, schema=get_inventory_schema())
+            table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+                                                                field="snapshot_time")
+            with api_call('bigquery'):
+                bq_client.create_table(table)
+
+        df = pd.concat(frames, ignore_index=True)
+        job_config = bigquery.LoadJobConfig(schema=get_inventory_schema(), write_disposition="WRITE_APPEND")
+        if not load_dataframe(bq_client, df, full_inventory_table, job_config, LOCATION, {'table': table_name}):
+            logging.error('Bucket inventory load into {} failed'.format(full_inventory_table))
+            all_loaded = False
+    snapshots.clear()
+    return all_loaded
+
+#
+# Main access point
+#
+
+def take_inventory(run=None, shard=None):
+
+    DEPLOY_PROJECT_ID = settings['DEPLOY_PROJECT_ID']
+    PROJECT_IDS = settings['INGEST_STORAGE_LOGS_PROJECT_IDS']
+    PROJECT_TAGS = settings['INGEST_STORAGE_LOGS_PROJECT_TAGS']
+
+    try:
+        bq_client = bigquery.Client(project=DEPLOY_PROJECT_ID)
+        storage_client = storage.Client(project=DEPLOY_PROJECT_ID)
+    except Exception as e:
+        logging.error("Exception while building clients")
+        logging.exception(e)
+        raise e
+
+    snapshot_time = pd.Timestamp(datetime.datetime.now(datetime.timezone.utc))
+    latest_storage = {}
+    snapshots = {}
+    pairs = shard_pairs(PROJECT_IDS.split(','), PROJECT_TAGS.split(','), shard)
+    try:
+        for project, tag, _ in project_work(run, pairs):
+            if run is not None and run.out_of_time():
+                return run.stop({})
+            full_inventory_table, df = inventory_for_project(project, tag, bq_client, storage_client,
+                                                             DEPLOY_PROJECT_ID, snapshot_time, latest_storage)
+            snapshots.setdefault(full_inventory_table, []).append(df)
+    finally:
+        # Whatever was collected, also when the run stops early or a project fails:
+        load_inventory(bq_client, snapshots)
+
+    if run is not None:
+        return run.complete()
+    return True
+
+
+if __name__ == '__main__':
+    # This is used when running locally only during test:
+    take_inventory()
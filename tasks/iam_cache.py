@@ -0,0 +1,124 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+from google_helpers.metrics import metrics
+from google_helpers.state_store import get_state_store
+from config import settings
+import logging
+
+#
+# IAM policies almost never change, so collect_iam_for_project keeps what it derived from each one (the log
+# rows and the object-owner entities) in the state store, keyed by etag, and reuses it while the etag matches:
+#
+#   - The project policy still has to be fetched to learn its etag, but an unchanged one is not walked again.
+#   - For buckets, the bucket listing we already do carries each bucket's metadata etag and metageneration,
+#     which change along with the bucket's IAM policy. An unchanged bucket skips get_iam_policy altogether.
+#
+# Entries older than MONITOR_IAM_CACHE_MAX_AGE_SECS (a day by default) are refreshed regardless, which bounds
+# how long a change we failed to notice could go unlogged. MONITOR_IAM_CACHE=False turns the cache off. Hits
+# and misses are counted in the iam_cache_hits / iam_cache_misses metrics.
+#
+
+DEFAULT_MAX_AGE_SECS = 86400
+
+
+def _cache_key(project, bucket_shard):
+    suffix = bucket_shard.suffix() if bucket_shard is not None else 'all'
+    return 'iam_cache/{0}/{1}.json'.format(project, suffix)
+
+
+class PolicyCache(object):
+    """
+    Derived IAM data for one project (and the buckets this shard audits), loaded from and saved to the
+    state store as a whole
+    """
+    def __init__(self, project, bucket_shard=None, store=None, clock=time.time):
+        self.project = project
+        self.enabled = settings.get('MONITOR_IAM_CACHE', 'True') == 'True'
+        self.max_age = float(settings.get('MONITOR_IAM_CACHE_MAX_AGE_SECS', DEFAULT_MAX_AGE_SECS))
+        self.store = store or get_state_store()
+        self.key = _cache_key(project, bucket_shard)
+        self.clock = clock
+        self.labels = {'project': project}
+        self.hits = 0
+        self.misses = 0
+        cached = self.store.get_json(self.key) if self.enabled else None
+        self.entries = cached or {'project': None, 'buckets': {}}
+        self.seen_buckets = set()
+
+    def _fresh(self, entry, etag):
+        return entry is not None and etag is not None and entry['etag'] == etag and \
+               self.clock() - entry['cached_at'] < self.max_age
+
+    def _count(self, hit, resource):
+        if hit:
+            self.hits += 1
+            metrics.inc('iam_cache_hits', resource=resource, **self.labels)
+        else:
+            self.misses += 1
+            metrics.inc('iam_cache_misses', resource=resource, **self.labels)
+
+    @staticmethod
+    def _entry(etag, rows, entities, cached_at):
+        return {'etag': etag, 'rows': rows, 'entities': sorted(list(pair) for pair in entities),
+                'cached_at': cached_at}
+
+    @staticmethod
+    def _unpack(entry):
+        return entry['rows'], set(tuple(pair) for pair in entry['entities'])
+
+    def project_policy(self, etag):
+        """
+        (rows, entities) derived from the project policy with this etag, or None
+        """
+        entry = self.entries['project']
+        hit = self.enabled and self._fresh(entry, etag)
+        self._count(hit, 'project')
+        return self._unpack(entry) if hit else None
+
+    def put_project_policy(self, etag, rows, entities):
+        self.entries['project'] = self._entry(etag, rows, entities, self.clock())
+
+    def bucket_policy(self, bucket_name, etag):
+        """
+        (rows, entities) derived from the policy of a bucket whose metadata has this etag, or None
+        """
+        self.seen_buckets.add(bucket_name)
+        entry = self.entries['buckets'].get(bucket_name)
+        hit = self.enabled and self._fresh(entry, etag)
+        self._count(hit, 'bucket')
+        return self._unpack(entry) if hit else None
+
+    def put_bucket_policy(self, bucket_name, etag, rows, entities):
+        self.entries['buckets'][bucket_name] = self._entry(etag, rows, entities, self.clock())
+
+    def save(self):
+        if not self.enabled:
+            return
+        # Drop buckets that are gone:
+        self.entries['buckets'] = {name: entry for name, entry in self.entries['buckets'].items()
+                                   if name in self.seen_buckets}
+        try:
+            self.store.put_json(self.key, self.entries)
+        except Exception as e:
+            logging.error('Could not save IAM cache for {0}: {1}'.format(self.project, str(e)))
+        total = self.hits + self.misses
+        if total:
+            logging.info('IAM cache for {0}: {1} hits, {2} misses ({3:.0%} hit rate)'.format(
+                self.project, self.hits, self.misses, self.hits / total))
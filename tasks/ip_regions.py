@@ -0,0 +1,168 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import ipaddress
+import threading
+from functools import lru_cache
+import pandas as pd
+import numpy as np
+from google_helpers.metrics import metrics
+from config import settings
+import logging
+
+#
+# Fills in c_ip_region on usage rows from a local IP range database, set with INGEST_STORAGE_LOGS_IP_REGION_DB
+# (a local path or gs:// URL). The database is a CSV with start_ip,end_ip,region columns, one row per range,
+# e.g. the free DB-IP or IP2Location country lite files; ranges must not overlap.
+#
+# It is loaded once per process into sorted numpy arrays, one index for IPv4 (as uint32) and one for IPv6 (the
+# top 64 bits as uint64; country and region databases do not split ranges below a /64). Each usage frame is
+# factorized to its distinct IPs, those are parsed (through an LRU cache, since the same clients show up file
+# after file) and looked up with one np.searchsorted per address family, and the result is mapped back to the
+# rows. Rows with no matching range keep a null region.
+#
+
+IP_PARSE_CACHE_SIZE = 1 << 18
+
+
+@lru_cache(maxsize=IP_PARSE_CACHE_SIZE)
+def parse_ip(ip):
+    """
+    (4, uint32 value) or (6, top 64 bits), or (0, 0) if it does not parse
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return 0, 0
+    if address.version == 4:
+        return 4, int(address)
+    return 6, int(address) >> 64
+
+
+class RangeIndex(object):
+    """
+    Sorted, non-overlapping [start, end] ranges for one address family, each mapped to a region code
+    """
+    def __init__(self, starts, ends, codes, dtype):
+        order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype=dtype)[order]
+        self.ends = np.asarray(ends, dtype=dtype)[order]
+        self.codes = np.asarray(codes, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, keys):
+        """
+        Region code for each key, -1 where no range holds it
+        """
+        out = np.full(len(keys), -1, dtype=np.int32)
+        if len(self.starts) == 0 or len(keys) == 0:
+            return out
+        pos = np.searchsorted(self.starts, keys, side='right') - 1
+        found = pos >= 0
+        hit = found.copy()
+        hit[found] = keys[found] <= self.ends[pos[found]]
+        out[hit] = self.codes[pos[hit]]
+        return out
+
+
+class IpRegionIndex(object):
+
+    def __init__(self, v4, v6, regions):
+        self.v4 = v4
+        self.v6 = v6
+        self.regions = regions
+
+    @classmethod
+    def from_frame(cls, ranges):
+        regions, codes = np.unique(ranges['region'].astype(str).to_numpy(), return_inverse=True)
+        starts = [parse_ip.__wrapped__(ip) for ip in ranges['start_ip']]
+        ends = [parse_ip.__wrapped__(ip) for ip in ranges['end_ip']]
+        families = {4: ([], [], []), 6: ([], [], [])}
+        for (start_family, start), (end_family, end), code in zip(starts, ends, codes):
+            if start_family != 0 and start_family == end_family:
+                bucket = families[start_family]
+                bucket[0].append(start)
+                bucket[1].append(end)
+                bucket[2].append(code)
+        v4 = RangeIndex(*families[4], dtype=np.uint32)
+        v6 = RangeIndex(*families[6], dtype=np.uint64)
+        return cls(v4, v6, regions)
+
+    @classmethod
+    def from_csv(cls, path):
+        ranges = pd.read_csv(path, header=None, names=['start_ip', 'end_ip', 'region'], usecols=[0, 1, 2],
+                             dtype=str, comment='#')
+        return cls.from_frame(ranges)
+
+    def lookup(self, ips):
+        """
+        Region for each IP in a Series, with None where unknown
+        """
+        codes, uniques = pd.factorize(ips)
+        parsed = [parse_ip(ip) for ip in uniques]
+        families = np.fromiter((family for family, _ in parsed), dtype=np.int8, count=len(parsed))
+        keys = [key for _, key in parsed]
+        unique_codes = np.full(len(uniques), -1, dtype=np.int32)
+        for family, index, dtype in ((4, self.v4, np.uint32), (6, self.v6, np.uint64)):
+            mask = families == family
+            if mask.any():
+                family_keys = np.fromiter((key for key, is_family in zip(keys, mask) if is_family), dtype=dtype)
+                unique_codes[mask] = index.lookup(family_keys)
+        region_names = np.append(self.regions.astype(object), None)
+        # -1 (no range, or a null IP) picks the trailing None:
+        row_codes = np.full(len(codes), -1, dtype=np.int32)
+        valid = codes >= 0
+        row_codes[valid] = unique_codes[codes[valid]]
+        return pd.Series(region_names[row_codes], index=ips.index, dtype=object)
+
+
+#
+# One index per process, loaded the first time it is needed:
+#
+
+_index = None
+_index_path = None
+_index_lock = threading.Lock()
+
+
+def get_ip_region_index():
+    global _index, _index_path
+    path = settings.get('INGEST_STORAGE_LOGS_IP_REGION_DB')
+    if not path:
+        return None
+    with _index_lock:
+        if _index is None or _index_path != path:
+            with metrics.span('ip_region_db_load'):
+                _index = IpRegionIndex.from_csv(path)
+            _index_path = path
+            logging.info('Loaded IP region database {0}: {1} IPv4 and {2} IPv6 ranges'.format(
+                path, len(_index.v4), len(_index.v6)))
+        return _index
+
+
+def enrich_regions(df, labels=None):
+    index = get_ip_region_index()
+    if index is None:
+        return df
+    labels = labels or {}
+    with metrics.span('ingest_enrich', **labels):
+        df['c_ip_region'] = index.lookup(df['c_ip'])
+    metrics.inc('ip_region_misses', int(df['c_ip_region'].isna().sum()), **labels)
+    return df
@@ -20,40 +20,90 @@ from google.cloud import storage
 from oauth2client.client import GoogleCredentials
 from google_helpers.utils import execute_with_retries
 from google_helpers.utils import build_with_retries
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from tasks.sharding import shard_pairs
+from tasks.task_runtime import project_work
+from tasks.iam_cache import PolicyCache
+from tasks.principal_index import AllowedSets, MemberIndex, save_member_index
 from config import settings
 import logging
 
 #
-# Do the work:
+# Do the work. With a TaskRun, each project (and, within a project, each bucket ACL walk) is a safe point
+# where we can stop and leave a continuation token for the next invocation.
+#
+# With a shard, we only do the projects hashed to it. If MONITOR_SHARD_BUCKETS is True we instead visit every
+# project but only audit the buckets hashed to this shard, and the project-level IAM is logged by the shard
+# that owns the project. Each shard then logs its own entries for its slice of the buckets.
 #
 
-def logit(client):
+def logit(client, run=None, shard=None):
 
     MONITOR_PROJECT_IDS = settings['MONITOR_PROJECT_IDS']
     MONITOR_PROJECT_TAGS = settings['MONITOR_PROJECT_TAGS']
+    SHARD_BUCKETS = (settings.get('MONITOR_SHARD_BUCKETS', 'False') == 'True')
 
     project_list = MONITOR_PROJECT_IDS.split(',')
     tag_list = MONITOR_PROJECT_TAGS.split(',')
-
-    for project, tag in zip(project_list, tag_list):
-        logit_for_project(project, tag, client)
-
+    bucket_shard = shard if SHARD_BUCKETS else None
+    pairs = shard_pairs(project_list, tag_list, None if SHARD_BUCKETS else shard)
+
+    # With bucket sharding every shard visits every project, so each claims only its slice of it:
+    key = None if bucket_shard is None else (lambda project: '{0}-{1}'.format(project, bucket_shard.suffix()))
+    for project, tag, resume in project_work(run, pairs, key):
+        project_state = logit_for_project(project, tag, client, run, resume, bucket_shard)
+        if project_state is not None:
+            return run.stop(project_state)
+
+    if run is not None:
+        return run.complete()
     return
 
 
 #
-# Do the work:
+# Roles whose members own the objects they write, so show up as OWNER on object ACLs:
 #
 
-def logit_for_project(targ_proj, targ_tag, client):
+OBJECT_OWNER_ROLES = ("roles/cloudbuild.builds.builder", "roles/storage.admin", "roles/storage.objectAdmin",
+                      "roles/storage.objectCreator", "roles/editor", "roles/owner")
 
-    logging.info('Into logit()')
 
-    bucket_acl_logger = client.logger(settings['BUCKET_ACL_LOG_NAME'].format(targ_tag))
-    bucket_def_acl_logger = client.logger(settings['BUCKET_DEFAULT_ACL_LOG_NAME'].format(targ_tag))
-    file_unique_acl_logger = client.logger(settings["FILE_UNIQUE_ACL_LOG_NAME"].format(targ_tag))
-    bucket_iam_logger = client.logger(settings['BUCKET_IAM_LOG_NAME'].format(targ_tag))
-    project_iam_logger = client.logger(settings['PROJECT_IAM_LOG_NAME'].format(targ_tag))
+def owner_entity(member):
+    if member.startswith("user:"):
+        return (member.replace("user:", "user-", 1), "OWNER")
+    elif member.startswith("serviceAccount:"):
+        return (member.replace("serviceAccount:", "user-", 1), "OWNER")
+    return None
+
+
+def policy_rows(bindings, base_entry):
+    """
+    The log rows for a policy's bindings, and the object-owner entities they imply
+    """
+    rows = []
+    entities = set()
+    for bind in bindings:
+        for member in bind['members']:
+            entry = dict(base_entry, role=bind["role"], member=member)
+            rows.append(entry)
+            if bind["role"] in OBJECT_OWNER_ROLES:
+                entity = owner_entity(member)
+                if entity is not None:
+                    entities.add(entity)
+    return rows, entities
+
+
+#
+# Get the project IAM policy and the IAM policy of every bucket. Returns the log entries for both, the buckets
+# that still use ACLs, and the AllowedSets of (entity, role) pairs we expect to see on each bucket's object ACLs.
+# Policies that have not changed since the last run come from the PolicyCache:
+#
+
+def collect_iam_for_project(targ_proj, storage_client2, bucket_shard=None, cache=None):
+
+    if cache is None:
+        cache = PolicyCache(targ_proj, bucket_shard)
 
     credentials = GoogleCredentials.get_application_default()
 
@@ -65,51 +115,28 @@ def logit_for_project(targ_proj, targ_tag, client):
     ## WJRL 5/25/20: Quick Google check seems to indicate that this is still the way to go.
     ##
 
-    iam_array = []
     try:
         crm_client = build_with_retries('cloudresourcemanager', 'v1beta1', credentials, 2)
 
         body = {}
         req = crm_client.projects().getIamPolicy(resource=targ_proj, body=body)
         iam_policy = execute_with_retries(req, 'GET_IAM', 2)
-        entities = set()
-
-        object_owners = ("roles/cloudbuild.builds.builder", "roles/storage.admin", "roles/storage.objectAdmin",
-                         "roles/storage.objectCreator", "roles/editor", "roles/owner")
-
-        for bind in iam_policy["bindings"]:
-            for member in bind['members']:
-                entry = {
-                  'project': targ_proj,
-                  'role': bind["role"],
-                  'member': member
-                }
-                iam_array.append(entry)
-                if bind["role"] in object_owners:
-                    if member.startswith("user:"):
-                        entities.add((member.replace("user:", "user-", 1), "OWNER"))
-                    elif member.startswith("serviceAccount:"):
-                        entities.add((member.replace("serviceAccount:", "user-", 1), "OWNER"))
 
-    except Exception as e:
-        logging.error("Exception while getting PIAM")
-        logging.exception(e)
-        raise e
-
-    #
-    # IAM policy is not available in the V1 interface, and ACLs not available in the V2 interface??
-    # So use both:
-    #
+        cached = cache.project_policy(iam_policy.get("etag"))
+        if cached is not None:
+            iam_array, entities = cached
+        else:
+            iam_array, entities = policy_rows(iam_policy["bindings"], {'project': targ_proj})
+            cache.put_project_policy(iam_policy.get("etag"), iam_array, entities)
 
-    try:
-        storage_client2 = storage.Client(project=targ_proj)
     except Exception as e:
-        logging.error("Exception while building SC2")
+        logging.error("Exception while getting PIAM")
         logging.exception(e)
         raise e
 
     buck_acl_check = []
-    per_buck_entities = {}
+    allowed = AllowedSets()
+    allowed.set_project_entities(entities)
 
     #
     # It is an error to try and access the acl when the bucket is using bucket-level IAM. So we need to do that
@@ -117,124 +144,218 @@ def logit_for_project(targ_proj, targ_tag, client):
     #
 
     buck_iam_array = []
-    for a_buck in storage_client2.list_buckets():
+    with api_call('storage'):
+        all_bucks = list(storage_client2.list_buckets())
+    if bucket_shard is not None:
+        all_bucks = [a_buck for a_buck in all_bucks if bucket_shard.owns('{0}/{1}'.format(targ_proj, a_buck.name))]
+    for a_buck in all_bucks:
         try:
-            this_buck_entities = entities.copy()
-            per_buck_entities[a_buck.name] = this_buck_entities
-            # Bucket needs this property set to handle requester-pays:
-            use_bucket = storage_client2.bucket(a_buck.name, user_project = targ_proj)
-            buck_iam = use_bucket.get_iam_policy(requested_policy_version=3)
+            # The bucket metadata etag and metageneration change when its IAM policy does:
+            bucket_etag = '{0}:{1}'.format(a_buck.etag, a_buck.metageneration) if a_buck.etag else None
+            cached = cache.bucket_policy(a_buck.name, bucket_etag)
+            if cached is not None:
+                buck_rows, buck_entities = cached
+            else:
+                # Bucket needs this property set to handle requester-pays:
+                use_bucket = storage_client2.bucket(a_buck.name, user_project = targ_proj)
+                with api_call('storage'):
+                    buck_iam = use_bucket.get_iam_policy(requested_policy_version=3)
+
+                # Transform the IAM Policy object into a dictionary that we can serialize:
+                buck_rows, buck_entities = policy_rows(buck_iam.to_api_repr()["bindings"],
+                                                       {'project': targ_proj, 'bucket': use_bucket.name})
+                cache.put_bucket_policy(a_buck.name, bucket_etag, buck_rows, buck_entities)
+
             #if not buck_iam.uniform_bucket_level_access_enabled:
             if not a_buck.iam_configuration['uniformBucketLevelAccess']['enabled']:
                 buck_acl_check.append(a_buck.name)
-
-            # Transform the IAM Policy object into a dictionary that we can serialize:
-
-            for bind in buck_iam.to_api_repr()["bindings"]:
-                for member in bind['members']:
-                    entry = {
-                        'project': targ_proj,
-                        'bucket': use_bucket.name,
-                        'role': bind["role"],
-                        'member': member
-                    }
-                    if bind["role"] in object_owners:
-                        if member.startswith("user:"):
-                            this_buck_entities.add((member.replace("user:", "user-", 1), "OWNER"))
-                        elif member.startswith("serviceAccount:"):
-                            this_buck_entities.add((member.replace("serviceAccount:", "user-", 1), "OWNER"))
-
-                    buck_iam_array.append(entry)
+            allowed.add_bucket_entities(a_buck.name, buck_entities)
+            buck_iam_array.extend(buck_rows)
 
         except Exception as e:
             logging.error("Exception while getting BIAM")
             logging.exception(e)
 
+    cache.save()
+    return iam_array, buck_iam_array, buck_acl_check, allowed
 
-    #
-    # Note: Experimented with bucket ACLs. If I made a *folder* public, then the bucket was made public as well.
-    # However, objects could be made public individually 5/25/20
-    #
 
-    acl_array = []
-    def_acl_array = []
-    object_acl_array = []
-
-
-    for buck_name in buck_acl_check:
-        try:
-            this_buck_entities = per_buck_entities[buck_name]
-            bucket = storage_client2.bucket(buck_name, user_project = targ_proj)
-            for item in bucket.acl:
-                entry = {
-                    'project': targ_proj,
-                    'bucket': buck_name,
-                    'role': item["role"],
-                    'entity': item["entity"]
-                }
-                this_buck_entities.add((item["entity"], item["role"]))
-                acl_array.append(entry)
-
-            for item in bucket.default_object_acl:
-                entry = {
-                    'project': targ_proj,
-                    'bucket': buck_name,
-                    'role': item["role"],
-                    'entity': item["entity"]
-                }
-                def_acl_array.append(entry)
-
-            #
-            # We should be making all buckets in our projects have uniform bucket level access. But if
-            # we don't, we want to know if there are any weird acl entries that we do not expect
-            #
-
-            for blob in bucket.list_blobs():
-                for acl_entry in blob.acl:
-                    acl_tup = (acl_entry["entity"], acl_entry["role"])
-                    if acl_tup not in this_buck_entities:
-                        entry = {
-                            'project': targ_proj,
-                            'bucket': buck_name,
-                            'file_name': blob.name,
-                            'role': acl_entry["role"],
-                            'entity': acl_entry["entity"]
-                        }
-                        object_acl_array.append(entry)
+#
+# Log the bucket ACL, default ACL and unexpected object ACL rows gathered so far:
+#
 
+def log_acl_rows(client, targ_tag, acl_array, def_acl_array, object_acl_array):
 
-        except Exception as e:
-            logging.error("Exception while getting BAC")
-            logging.exception(e)
+    bucket_acl_logger = client.logger(settings['BUCKET_ACL_LOG_NAME'].format(targ_tag))
+    bucket_def_acl_logger = client.logger(settings['BUCKET_DEFAULT_ACL_LOG_NAME'].format(targ_tag))
+    file_unique_acl_logger = client.logger(settings["FILE_UNIQUE_ACL_LOG_NAME"].format(targ_tag))
 
     try:
-        bucket_acl_logger.log_struct({'bucket_acls': acl_array})
+        with api_call('logging'):
+            bucket_acl_logger.log_struct({'bucket_acls': acl_array})
     except Exception as e:
         logging.error("Exception while logging ACL.")
         logging.exception(e)
 
     try:
-        bucket_def_acl_logger.log_struct({'bucket_def_acls': def_acl_array})
+        with api_call('logging'):
+            bucket_def_acl_logger.log_struct({'bucket_def_acls': def_acl_array})
     except Exception as e:
         logging.error("Exception while logging default ACL.")
         logging.exception(e)
 
     try:
-        file_unique_acl_logger.log_struct({'bucket_unique_obj_acls': object_acl_array})
+        with api_call('logging'):
+            file_unique_acl_logger.log_struct({'bucket_unique_obj_acls': object_acl_array})
     except Exception as e:
         logging.error("Exception while logging file uniqe ACL.")
         logging.exception(e)
 
+
+def bucket_acl_rows(bucket, targ_proj):
+    """
+    The rows for a bucket's ACL and default object ACL. Both are fetched on first use, so call it under api_call
+    """
+    acl_rows = [{'project': targ_proj, 'bucket': bucket.name, 'role': item["role"], 'entity': item["entity"]}
+                for item in bucket.acl]
+    def_acl_rows = [{'project': targ_proj, 'bucket': bucket.name, 'role': item["role"], 'entity': item["entity"]}
+                    for item in bucket.default_object_acl]
+    return acl_rows, def_acl_rows
+
+
+#
+# Do the work for one project. Returns None when the project is done, or the state needed to resume it if
+# the run ran out of time part way through the bucket ACL walk. That state is only the name of the next bucket
+# to walk: the ACL rows gathered so far are logged before stopping, and a resumed run fetches the IAM policies
+# again (mostly from the PolicyCache) and reloads the ACLs of the buckets already walked, without walking their
+# objects, to rebuild the allowed sets and the member index.
+#
+
+def logit_for_project(targ_proj, targ_tag, client, run=None, resume=None, bucket_shard=None):
+
+    logging.info('Into logit()')
+
+    bucket_iam_logger = client.logger(settings['BUCKET_IAM_LOG_NAME'].format(targ_tag))
+    project_iam_logger = client.logger(settings['PROJECT_IAM_LOG_NAME'].format(targ_tag))
+
+    #
+    # IAM policy is not available in the V1 interface, and ACLs not available in the V2 interface??
+    # So use both:
+    #
+
+    try:
+        storage_client2 = storage.Client(project=targ_proj)
+    except Exception as e:
+        logging.error("Exception while building SC2")
+        logging.exception(e)
+        raise e
+
+    labels = {'project': targ_proj, 'tag': targ_tag}
+    with metrics.span('iam_fetch', **labels):
+        iam_array, buck_iam_array, buck_acl_check, allowed = \
+            collect_iam_for_project(targ_proj, storage_client2, bucket_shard)
+    if resume is None:
+        metrics.inc('iam_buckets', len(allowed.bucket_codes), **labels)
+        metrics.inc('iam_bindings', len(iam_array) + len(buck_iam_array), **labels)
+
+    acl_array = []
+    def_acl_array = []
+    object_acl_array = []
+    # Rows of buckets walked by an earlier invocation; already logged, but needed for the member index:
+    earlier_acl_array = []
+    earlier_def_acl_array = []
+    next_bucket = 0
+    if resume is not None:
+        cursor = resume['next_bucket']
+        # Bucket names are listed in order, so everything before the cursor was walked already:
+        next_bucket = len(buck_acl_check) if cursor is None else \
+            len([buck_name for buck_name in buck_acl_check if buck_name < cursor])
+        for buck_name in buck_acl_check[:next_bucket]:
+            try:
+                bucket = storage_client2.bucket(buck_name, user_project = targ_proj)
+                with api_call('storage'):
+                    acl_rows, def_acl_rows = bucket_acl_rows(bucket, targ_proj)
+                earlier_acl_array.extend(acl_rows)
+                earlier_def_acl_array.extend(def_acl_rows)
+                allowed.add_bucket_entities(buck_name, [(row['entity'], row['role']) for row in acl_rows])
+            except Exception as e:
+                logging.error("Exception while reloading BAC")
+                logging.exception(e)
+
+    #
+    # Note: Experimented with bucket ACLs. If I made a *folder* public, then the bucket was made public as well.
+    # However, objects could be made public individually 5/25/20
+    #
+
+    for buck_index, buck_name in enumerate(buck_acl_check):
+        if buck_index < next_bucket:
+            continue
+        if run is not None and run.out_of_time():
+            log_acl_rows(client, targ_tag, acl_array, def_acl_array, object_acl_array)
+            return {'next_bucket': buck_name}
+        try:
+            with metrics.span('acl_walk', **labels):
+                bucket = storage_client2.bucket(buck_name, user_project = targ_proj)
+                with api_call('storage'):
+                    acl_rows, def_acl_rows = bucket_acl_rows(bucket, targ_proj)
+                acl_array.extend(acl_rows)
+                def_acl_array.extend(def_acl_rows)
+                allowed.add_bucket_entities(buck_name, [(row['entity'], row['role']) for row in acl_rows])
+
+                #
+                # We should be making all buckets in our projects have uniform bucket level access. But if
+                # we don't, we want to know if there are any weird acl entries that we do not expect
+                #
+
+                object_count = 0
+                for blob in bucket.list_blobs():
+                    object_count += 1
+                    for acl_entry in blob.acl:
+                        if not allowed.allows(buck_name, acl_entry["entity"], acl_entry["role"]):
+                            entry = {
+                                'project': targ_proj,
+                                'bucket': buck_name,
+                                'file_name': blob.name,
+                                'role': acl_entry["role"],
+                                'entity': acl_entry["entity"]
+                            }
+                            object_acl_array.append(entry)
+                            metrics.inc('acl_unexpected_object_entries', **labels)
+                metrics.inc('acl_objects_scanned', object_count, **labels)
+
+        except Exception as e:
+            logging.error("Exception while getting BAC")
+            logging.exception(e)
+
+    log_acl_rows(client, targ_tag, acl_array, def_acl_array, object_acl_array)
+
     try:
-        bucket_iam_logger.log_struct({'bucket_iam': buck_iam_array})
+        with api_call('logging'):
+            bucket_iam_logger.log_struct({'bucket_iam': buck_iam_array})
     except Exception as e:
         logging.error("Exception while logging bucket IAM.")
         logging.exception(e)
 
+    if bucket_shard is None or bucket_shard.owns(targ_proj):
+        try:
+            with api_call('logging'):
+                project_iam_logger.log_struct({'project_iam': iam_array})
+        except Exception as e:
+            logging.error("Exception while logging project IAM.")
+            logging.exception(e)
+
+    #
+    # Save the member -> grants index for "what can X reach" queries (see tasks/principal_index.py):
+    #
+
     try:
-        project_iam_logger.log_struct({'project_iam': iam_array})
+        project_rows = iam_array if bucket_shard is None or bucket_shard.owns(targ_proj) else []
+        with metrics.span('member_index', **labels):
+            member_index = MemberIndex.build(project_rows, buck_iam_array, earlier_acl_array + acl_array,
+                                             earlier_def_acl_array + def_acl_array)
+            save_member_index(member_index, targ_proj, bucket_shard)
     except Exception as e:
-        logging.error("Exception while logging project IAM.")
+        logging.error("Exception while saving member index.")
         logging.exception(e)
 
-    return
+    return None
@@ -0,0 +1,222 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import gzip
+import io
+import shutil
+import time
+from contextlib import contextmanager
+import pandas as pd
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+
+#
+# Compressed log objects. Readers stream the object through gcsfs and decompress on the fly into the CSV parser,
+# with no temporary files. The codec is taken from the first bytes of the object (gzip and zstd both have magic
+# numbers), which also covers objects stored with Content-Encoding: gzip whether or not GCS transcodes them on
+# the way out; the name suffix (.gz, .zst) and the content encoding are used for naming and archiving. zstd needs
+# the optional zstandard package, which is only imported when a zstd object shows up.
+#
+# Optionally, uncompressed files are recompressed on their way to the archive bucket
+# (INGEST_STORAGE_LOGS_ARCHIVE_COMPRESSION=gzip or zstd), again streamed object to object.
+#
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CODEC_SUFFIXES = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+ARCHIVE_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+CHUNK_SIZE = 1 << 20
+# Parse cost is a few microseconds a row, so the histogram is in microseconds, not the seconds of DURATION_BUCKETS:
+US_PER_ROW_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 250.0, 1000.0)
+
+
+class CodecUnavailableError(Exception):
+    """
+    The object needs a codec this instance does not have installed
+    """
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CodecUnavailableError('zstd-compressed log found but the zstandard package is not installed')
+    return zstandard
+
+
+def codec_from_name(name, content_encoding=None):
+    if content_encoding in ('gzip', 'zstd'):
+        return content_encoding
+    for suffix, codec in CODEC_SUFFIXES.items():
+        if name.endswith(suffix):
+            return codec
+    return None
+
+
+def strip_codec_suffix(name):
+    for suffix in CODEC_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def sniff_codec(head):
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+class CountingReader(io.RawIOBase):
+    """
+    Passes reads through to a binary file, counting the bytes. With a service, each read is an api_call to it,
+    so the limiter sees the fetches from storage and not the time spent parsing between them
+    """
+    def __init__(self, raw, service=None):
+        self.raw = raw
+        self.service = service
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.service is not None:
+            with api_call(self.service):
+                data = self.raw.read(len(b))
+        else:
+            data = self.raw.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.count += n
+        return n
+
+
+class CountingSink(io.RawIOBase):
+    """
+    Passes writes through to a binary file, counting the bytes. With a service, each write is an api_call to it
+    """
+    def __init__(self, raw, service=None):
+        self.raw = raw
+        self.service = service
+        self.count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.service is not None:
+            with api_call(self.service):
+                n = self.raw.write(b)
+        else:
+            n = self.raw.write(b)
+        n = len(b) if n is None else n
+        self.count += n
+        return n
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def open_log(url, labels=None):
+    """
+    Decompressed binary stream of the log object (or local file) at url
+    """
+    import fsspec
+    labels = labels or {}
+    # Only the open and the reads from storage go through the limiter, not the caller's parsing:
+    service = 'storage' if url.startswith('gs://') else None
+    opened = fsspec.open(url, 'rb')
+    if service is not None:
+        with api_call(service):
+            raw = opened.open()
+    else:
+        raw = opened.open()
+    with raw:
+        transferred = CountingReader(raw, service)
+        buffered = io.BufferedReader(transferred, CHUNK_SIZE)
+        codec = sniff_codec(buffered.peek(4)[:4])
+        if codec == 'gzip':
+            stream = gzip.GzipFile(fileobj=buffered, mode='rb')
+        elif codec == 'zstd':
+            stream = _zstandard().ZstdDecompressor().stream_reader(buffered, read_size=CHUNK_SIZE,
+                                                                   read_across_frames=True)
+        else:
+            stream = buffered
+        decompressed = CountingReader(stream)
+        try:
+            yield io.BufferedReader(decompressed, CHUNK_SIZE)
+        finally:
+            codec_labels = dict(labels, codec=codec or 'none')
+            metrics.inc('ingest_bytes_transferred', transferred.count, **codec_labels)
+            metrics.inc('ingest_bytes_decompressed', decompressed.count, **codec_labels)
+
+
+def read_log_csv(url, dtype, labels=None):
+    """
+    pd.read_csv of a possibly compressed log, recording the CPU time spent per row
+    """
+    labels = labels or {}
+    # This thread's CPU time only: reports are read in parallel, and other requests share the process
+    cpu_start = time.thread_time()
+    with open_log(url, labels) as stream:
+        df = pd.read_csv(stream, dtype=dtype)
+    cpu_secs = time.thread_time() - cpu_start
+    metrics.inc('ingest_parse_cpu_seconds', cpu_secs, **labels)
+    if len(df):
+        metrics.observe('ingest_parse_cpu_us_per_row', cpu_secs * 1e6 / len(df), buckets=US_PER_ROW_BUCKETS,
+                        **labels)
+    return df
+
+#
+# Stream an uncompressed object into the archive bucket, compressed. Returns the archived name:
+#
+
+def recompress_blob(blob, archive_bucket, codec, labels=None):
+    labels = labels or {}
+    archive_name = '{0}{1}'.format(blob.name, ARCHIVE_SUFFIXES[codec])
+    target = archive_bucket.blob(archive_name)
+    # Each chunk read or written is its own api_call, so compression time is not counted as storage latency:
+    with blob.open('rb', chunk_size=CHUNK_SIZE) as source_file, \
+            target.open('wb', chunk_size=CHUNK_SIZE * 8, ignore_flush=True,
+                        content_type='application/octet-stream') as sink:
+        source = io.BufferedReader(CountingReader(source_file, 'storage'), CHUNK_SIZE)
+        written = CountingSink(sink, 'storage')
+        buffered = io.BufferedWriter(written, CHUNK_SIZE)
+        if codec == 'gzip':
+            with gzip.GzipFile(fileobj=buffered, mode='wb', compresslevel=6) as compressor:
+                shutil.copyfileobj(source, compressor, CHUNK_SIZE)
+        else:
+            compressor = _zstandard().ZstdCompressor(level=3).stream_writer(buffered, closefd=False)
+            shutil.copyfileobj(source, compressor, CHUNK_SIZE)
+            compressor.close()
+        buffered.flush()
+    metrics.inc('archive_bytes_in', blob.size or 0, codec=codec, **labels)
+    metrics.inc('archive_bytes_out', written.count, codec=codec, **labels)
+    return archive_name
+
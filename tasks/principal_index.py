@@ -0,0 +1,207 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import io
+import numpy as np
+from google_helpers.state_store import get_state_store
+import logging
+
+#
+# Compact forms of the principals the bucket audit works with:
+#
+#  - AllowedSets: the (entity, role) pairs we expect on object ACLs, interned to integers. Each pair is one
+#    int64 code (entity id << ROLE_BITS | role id). The pairs implied by the project policy are kept once, and
+#    each bucket only adds a sorted array of its own, instead of every bucket holding a copy of the project's.
+#
+#  - MemberIndex: an inverted index from member to the (project, bucket, role, source) grants it has, built from
+#    the rows we log. Rows are sorted by member with an offsets array into them, so a lookup is one dict probe
+#    and a slice. It is saved to the state store as a compressed .npz under principal_index/, one per project
+#    (and shard), and can be queried from the command line:
+#
+#      python -m tasks.principal_index --project <id> --member user:someone@example.com
+#
+# ACL entities (user-x@y.org) are stored under the IAM member spelling (user:x@y.org) so one lookup finds both.
+#
+
+ROLE_BITS = 16
+SOURCES = ('project_iam', 'bucket_iam', 'bucket_acl', 'default_object_acl')
+ACL_ENTITY_PREFIXES = ('user-', 'group-', 'domain-')
+
+
+class Interner(object):
+    """
+    Maps strings to dense integer ids
+    """
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.ids = {name: index for index, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        index = self.ids.get(name)
+        if index is None:
+            index = len(self.names)
+            self.ids[name] = index
+            self.names.append(name)
+        return index
+
+    def lookup(self, name):
+        return self.ids.get(name, -1)
+
+
+class AllowedSets(object):
+
+    def __init__(self, entities=None, roles=None, project_codes=None, bucket_codes=None):
+        self.entities = entities or Interner()
+        self.roles = roles or Interner()
+        self.project_codes = project_codes if project_codes is not None else np.empty(0, dtype=np.int64)
+        self.bucket_codes = bucket_codes or {}
+
+    def _codes(self, pairs):
+        codes = [(self.entities.intern(entity) << ROLE_BITS) | self.roles.intern(role) for entity, role in pairs]
+        return np.unique(np.asarray(codes, dtype=np.int64))
+
+    def set_project_entities(self, pairs):
+        self.project_codes = self._codes(pairs)
+
+    def add_bucket_entities(self, bucket_name, pairs):
+        codes = self._codes(pairs)
+        existing = self.bucket_codes.get(bucket_name)
+        if existing is not None:
+            codes = np.union1d(existing, codes)
+        self.bucket_codes[bucket_name] = np.setdiff1d(codes, self.project_codes, assume_unique=True)
+
+    def allows(self, bucket_name, entity, role):
+        entity_id = self.entities.lookup(entity)
+        role_id = self.roles.lookup(role)
+        if entity_id < 0 or role_id < 0:
+            return False
+        code = (entity_id << ROLE_BITS) | role_id
+        for codes in (self.project_codes, self.bucket_codes.get(bucket_name)):
+            if codes is not None and len(codes):
+                pos = np.searchsorted(codes, code)
+                if pos < len(codes) and codes[pos] == code:
+                    return True
+        return False
+
+
+def member_key(entity):
+    """
+    IAM spelling of an ACL entity, e.g. user-a@b.org -> user:a@b.org
+    """
+    for prefix in ACL_ENTITY_PREFIXES:
+        if entity.startswith(prefix):
+            return '{0}:{1}'.format(prefix[:-1], entity[len(prefix):])
+    return entity
+
+
+class MemberIndex(object):
+
+    def __init__(self, members, projects, buckets, roles, grants, offsets):
+        self.members = members
+        self.projects = projects
+        self.buckets = buckets
+        self.roles = roles
+        self.grants = grants
+        self.offsets = offsets
+        self.member_ids = {name: index for index, name in enumerate(members)}
+
+    @classmethod
+    def build(cls, project_iam=(), bucket_iam=(), bucket_acl=(), default_object_acl=()):
+        """
+        From the rows logged by logit_for_project
+        """
+        members, projects, buckets, roles = Interner(), Interner(), Interner(['']), Interner()
+        rows = []
+        for source_id, source_rows in enumerate((project_iam, bucket_iam, bucket_acl, default_object_acl)):
+            for row in source_rows:
+                member = row['member'] if 'member' in row else member_key(row['entity'])
+                rows.append((members.intern(member), projects.intern(row['project']),
+                             buckets.intern(row.get('bucket', '')), roles.intern(row['role']), source_id))
+        grants = np.asarray(rows, dtype=np.int32).reshape(-1, 5)
+        grants = np.unique(grants, axis=0)
+        counts = np.bincount(grants[:, 0], minlength=len(members)) if len(grants) else np.zeros(len(members),
+                                                                                                 dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(members.names, projects.names, buckets.names, roles.names, grants, offsets)
+
+    def lookup(self, member):
+        """
+        (project, bucket, role, source) tuples for a member; bucket is '' for project-level grants
+        """
+        member_id = self.member_ids.get(member_key(member))
+        if member_id is None:
+            return []
+        rows = self.grants[self.offsets[member_id]:self.offsets[member_id + 1]]
+        return [(self.projects[p], self.buckets[b], self.roles[r], SOURCES[s]) for _, p, b, r, s in rows.tolist()]
+
+    def to_bytes(self):
+        out = io.BytesIO()
+        np.savez_compressed(out, members=np.asarray(self.members, dtype=str),
+                            projects=np.asarray(self.projects, dtype=str), buckets=np.asarray(self.buckets, dtype=str),
+                            roles=np.asarray(self.roles, dtype=str), grants=self.grants, offsets=self.offsets)
+        return out.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(arrays['members'].tolist(), arrays['projects'].tolist(), arrays['buckets'].tolist(),
+                       arrays['roles'].tolist(), arrays['grants'], arrays['offsets'])
+
+
+def index_key(project, bucket_shard=None):
+    suffix = bucket_shard.suffix() if bucket_shard is not None else 'all'
+    return 'principal_index/{0}/{1}.npz'.format(project, suffix)
+
+
+def save_member_index(index, project, bucket_shard=None, store=None):
+    store = store or get_state_store()
+    store.put_bytes(index_key(project, bucket_shard), index.to_bytes())
+
+
+def load_member_index(project, bucket_shard=None, store=None):
+    store = store or get_state_store()
+    data = store.get_bytes(index_key(project, bucket_shard))
+    return None if data is None else MemberIndex.from_bytes(data)
+
+
+def main():
+    from tasks.sharding import ShardSpec
+    parser = argparse.ArgumentParser(description='What can a member reach, from the last bucket audit')
+    parser.add_argument('--project', required=True, action='append', help='Audited project (repeatable)')
+    parser.add_argument('--member', required=True, help='e.g. user:someone@example.com or group-x@example.com')
+    parser.add_argument('--shards', type=int, default=0, help='Shard count, if MONITOR_SHARD_BUCKETS was used')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    shards = [ShardSpec(index, args.shards) for index in range(args.shards)] if args.shards else [None]
+    for project in args.project:
+        for shard in shards:
+            index = load_member_index(project, shard)
+            if index is None:
+                logging.info('No index for {0} {1}'.format(project, shard.suffix() if shard else ''))
+                continue
+            for grant in index.lookup(args.member):
+                print('\t'.join(grant))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,13 +19,23 @@ limitations under the License.
 import time
 from google.cloud import bigquery
 from config import settings
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from google_helpers.local_sql import LocalSqlClient
+from tasks.sharding import shard_pairs
+from tasks.task_runtime import project_work
 import logging
 
 
 def generic_bq_harness(client, sql, target_dataset, dest_table, do_batch, write_depo):
     """
-    Handles all the boilerplate for running a BQ job
+    Handles all the boilerplate for running a BQ job. With a LocalSqlClient the query runs locally instead
     """
+    if isinstance(client, LocalSqlClient):
+        with metrics.span('bq_query', dataset=target_dataset, table=dest_table, engine='local'):
+            client.run_query(sql, target_dataset, dest_table, write_depo)
+        return True
+
     job_config = bigquery.QueryJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
@@ -34,28 +44,34 @@ def generic_bq_harness(client, sql, target_dataset, dest_table, do_batch, write_
 
     target_ref = client.dataset(target_dataset).table(dest_table)
     job_config.destination = target_ref
-    print(target_ref)
     location = 'US'
+    labels = {'dataset': target_dataset, 'table': dest_table}
 
-    # API request - starts the query
-    query_job = client.query(sql, location=location, job_config=job_config)
-
-    # Query
-    query_job = client.get_job(query_job.job_id, location=location)
-    job_state = query_job.state
+    with metrics.span('bq_query', **labels):
+        # API request - starts the query
+        with api_call('bigquery'):
+            query_job = client.query(sql, location=location, job_config=job_config)
 
-    while job_state != 'DONE':
-        query_job = client.get_job(query_job.job_id, location=location)
-        print('Job {} is currently in state {}'.format(query_job.job_id, query_job.state))
+        # Query
+        with api_call('bigquery'):
+            query_job = client.get_job(query_job.job_id, location=location)
         job_state = query_job.state
-        if job_state != 'DONE':
-            time.sleep(5)
-    print('Job {} is done'.format(query_job.job_id))
 
-    query_job = client.get_job(query_job.job_id, location=location)
+        while job_state != 'DONE':
+            with api_call('bigquery'):
+                query_job = client.get_job(query_job.job_id, location=location)
+            job_state = query_job.state
+            if job_state != 'DONE':
+                time.sleep(5)
+
+        with api_call('bigquery'):
+            query_job = client.get_job(query_job.job_id, location=location)
+
     if query_job.error_result is not None:
-        print('Error result!! {}'.format(query_job.error_result))
+        logging.error('Job {} into {} failed: {}'.format(query_job.job_id, target_ref, query_job.error_result))
+        metrics.inc('bq_query_failures', **labels)
         return False
+    metrics.inc('bq_bytes_processed', query_job.total_bytes_processed or 0, **labels)
     return True
 
 '''
@@ -154,9 +170,9 @@ def daily_user_and_largest_sql(table):
 
 '''
 ----------------------------------------------------------------------------------------------
-Do the work
+Do the work. With a TaskRun, every finished pipeline stage is a safe point we can resume from
 '''
-def process_logs():
+def process_logs(run=None, shard=None):
 
     DEPLOY_PROJECT = settings['DEPLOY_PROJECT_ID']
     PROXY_PROJECT_IDS = settings['PROXY_PROJECT_IDS']
@@ -172,46 +188,51 @@ def process_logs():
     project_list = PROXY_PROJECT_IDS.split(',')
     tag_list = PROXY_PROJECT_TAGS.split(',')
 
-    for project, tag in zip(project_list, tag_list):
-        process_raw_logs_for_project(DEPLOY_PROJECT, project, tag, bqclient)
+    for project, tag, resume in project_work(run, shard_pairs(project_list, tag_list, shard)):
+        start_stage = resume['stage'] if resume else 0
+        next_stage = process_raw_logs_for_project(DEPLOY_PROJECT, project, tag, bqclient, run, start_stage)
+        if next_stage is not None:
+            return run.stop({'stage': next_stage})
 
+    if run is not None:
+        return run.complete()
     return
 
 
 '''
 ----------------------------------------------------------------------------------------------
-Do the work
+The three stages of the pipeline, each reading the table written by the one before
+'''
+PIPELINE_STAGES = [
+    (extract_log_fields, "PROXY_RAW_DATASET_BASE", "PROXY_RAW_TABLES", "PROXY_PROCESSED_TABLE"),
+    (daily_byte_max, "PROXY_STATS_DATASET_BASE", "PROXY_PROCESSED_TABLE", "PROXY_BYTES_TABLE"),
+    (daily_user_and_largest, "PROXY_STATS_DATASET_BASE", "PROXY_BYTES_TABLE", "PROXY_MAX_TABLE"),
+]
+
+'''
+----------------------------------------------------------------------------------------------
+Do the work, starting at start_stage. Returns None when finished (or on a failed stage, which is logged),
+or the index of the next stage to run if the run is out of time
 '''
-def process_raw_logs_for_project(deploy_project, project, tag, bqclient):
+def process_raw_logs_for_project(deploy_project, project, tag, bqclient, run=None, start_stage=0):
 
     logging.info('Processing proxy logs for {}'.format(project))
-    full_dataset_raw = "{}{}".format(settings["PROXY_RAW_DATASET_BASE"], tag)
     full_dataset_stats = "{}{}".format(settings["PROXY_STATS_DATASET_BASE"], tag)
 
-    input_table = "{}.{}.{}".format(deploy_project, full_dataset_raw, settings["PROXY_RAW_TABLES"])
-    output_table = settings["PROXY_PROCESSED_TABLE"]
-    success = extract_log_fields(bqclient, input_table, full_dataset_stats, output_table, False)
-    if not success:
-        logging.error("{} extract_log_fields job failed".format(input_table))
-        return False
-
-    input_table = "{}.{}.{}".format(deploy_project, full_dataset_stats, settings["PROXY_PROCESSED_TABLE"])
-    output_table = settings["PROXY_BYTES_TABLE"]
-    success = daily_byte_max(bqclient, input_table, full_dataset_stats, output_table, False)
-    if not success:
-        logging.error("{} daily_byte_max job failed".format(input_table))
-        return False
-
-    input_table = "{}.{}.{}".format(deploy_project, full_dataset_stats, settings["PROXY_BYTES_TABLE"])
-    output_table = settings["PROXY_MAX_TABLE"]
-
-    success = daily_user_and_largest(bqclient, input_table, full_dataset_stats, output_table, False)
-    if not success:
-        logging.error("{} daily_user_and_largest job failed".format(input_table))
-        return False
+    for stage in range(start_stage, len(PIPELINE_STAGES)):
+        if run is not None and run.out_of_time():
+            return stage
+        stage_func, input_dataset_base, input_table_key, output_table_key = PIPELINE_STAGES[stage]
+        input_dataset = "{}{}".format(settings[input_dataset_base], tag)
+        input_table = "{}.{}.{}".format(deploy_project, input_dataset, settings[input_table_key])
+        output_table = settings[output_table_key]
+        success = stage_func(bqclient, input_table, full_dataset_stats, output_table, False)
+        if not success:
+            logging.error("{} {} job failed".format(input_table, stage_func.__name__))
+            return None
 
     logging.info('Finished processing proxy logs for {}'.format(project))
-    return True
+    return None
 
 if __name__ == '__main__':
     # This is used when running locally only during test:
@@ -0,0 +1,224 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import datetime
+from google.cloud import bigquery
+from google.cloud.exceptions import GoogleCloudError
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from google_helpers.state_store import get_state_store
+from tasks.bucket_access_to_bq import table_layout
+from config import settings
+import logging
+
+#
+# Move existing usage and storage tables to the configured clustering without stopping ingest. Run from the
+# repo root:
+#
+#   python -m tasks.relayout_tables --tag <tag> [--table usage|storage|both] [--settle-days 2] [--dry-run]
+#                                   [--apply-expiration]
+#
+# The live table's clustering spec is updated in place first, so everything loaded from then on is written
+# clustered. Each settled partition is then rebuilt without touching the live table: its row count and
+# last-modified time are noted and the partition is read into a clustered staging table. If the live partition
+# still looks unchanged, the swap is one multi-statement transaction: it checks, inside the transaction, that the
+# live day has as many rows as were staged, deletes the day and inserts the staged rows. The check and the swap so
+# see one snapshot, and a load that lands in the table while the transaction runs makes BigQuery abort it for a
+# concurrent update instead of losing the loaded rows. A partition that changed under us (a late log file was
+# appended) is left as it is and picked up by the next run. Partitions newer than --settle-days can still receive log files,
+# so they are not tried at all; they are small and get clustered as they are written. Finished partitions are
+# recorded in the state store, so an interrupted run picks up where it stopped.
+#
+# Partition expiration deletes data, so it is only applied when asked for with --apply-expiration; otherwise a
+# difference from ..._PARTITION_EXPIRATION_DAYS is just reported.
+#
+
+TABLE_KINDS = {
+    'usage': 'USAGE',
+    'storage': 'STORAGE',
+}
+
+
+def _state_key(full_table):
+    return 'relayout/{0}.json'.format(full_table)
+
+
+def update_table_spec(bq_client, full_table, kind, dry_run, apply_expiration=False):
+    clustering_fields, expiration_ms = table_layout(kind)
+    with api_call('bigquery'):
+        table = bq_client.get_table(full_table)
+    fields = []
+    if table.clustering_fields != clustering_fields:
+        logging.info('{0}: clustering {1} -> {2}'.format(full_table, table.clustering_fields, clustering_fields))
+        table.clustering_fields = clustering_fields
+        fields.append('clustering_fields')
+    if table.time_partitioning.expiration_ms != expiration_ms:
+        if apply_expiration:
+            logging.info('{0}: partition expiration {1} -> {2} ms'.format(
+                full_table, table.time_partitioning.expiration_ms, expiration_ms))
+            table.time_partitioning.expiration_ms = expiration_ms
+            fields.append('time_partitioning')
+        else:
+            logging.warning('{0}: partition expiration is {1} ms, configured {2} ms; '
+                            'rerun with --apply-expiration to change it'.format(
+                                full_table, table.time_partitioning.expiration_ms, expiration_ms))
+    if fields and not dry_run:
+        with api_call('bigquery'):
+            bq_client.update_table(table, fields)
+    return table
+
+
+def settled_partitions(bq_client, full_table, settle_days):
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=settle_days)).strftime('%Y%m%d')
+    with api_call('bigquery'):
+        partition_ids = bq_client.list_partitions(full_table)
+    return sorted(pid for pid in partition_ids if pid.isdigit() and pid < cutoff)
+
+
+def partition_state(bq_client, full_table, partition_id):
+    """
+    (row count, last modified) of one partition, to tell whether it changed
+    """
+    with api_call('bigquery'):
+        partition = bq_client.get_table('{0}${1}'.format(full_table, partition_id))
+    return partition.num_rows, partition.modified
+
+
+PARTITION_CHANGED = 'relayout: partition changed'
+
+
+def swap_partition_sql(full_table, staging_table, day):
+    """
+    One transaction that replaces a day of full_table with the rows of staging_table, or raises PARTITION_CHANGED
+    (rolling back) if the live day no longer has as many rows as were staged
+    """
+    return '''
+        BEGIN TRANSACTION;
+
+        IF (SELECT COUNT(*) FROM `{0}` WHERE time >= TIMESTAMP("{2}") AND time < TIMESTAMP("{3}"))
+           != (SELECT COUNT(*) FROM `{1}`) THEN
+            RAISE USING MESSAGE = "{4}";
+        END IF;
+
+        DELETE FROM `{0}` WHERE time >= TIMESTAMP("{2}") AND time < TIMESTAMP("{3}");
+
+        INSERT INTO `{0}` SELECT * FROM `{1}`;
+
+        COMMIT TRANSACTION;
+        '''.format(full_table, staging_table, day.isoformat(), (day + datetime.timedelta(days=1)).isoformat(),
+                   PARTITION_CHANGED)
+
+
+def rewrite_partition(bq_client, full_table, table, partition_id, location):
+    """
+    Rebuild one partition clustered, in a staging table, and swap it for the live partition in one transaction if
+    that has not changed meanwhile. Returns True if the partition was replaced
+    """
+    day = datetime.datetime.strptime(partition_id, '%Y%m%d').date()
+    staging_table = '{0}_relayout_{1}'.format(full_table, partition_id)
+    before = partition_state(bq_client, full_table, partition_id)
+    sql = '''
+        SELECT * FROM `{0}`
+        WHERE time >= TIMESTAMP("{1}") AND time < TIMESTAMP("{2}")
+        '''.format(full_table, day.isoformat(), (day + datetime.timedelta(days=1)).isoformat())
+    query_config = bigquery.QueryJobConfig(destination=staging_table, write_disposition='WRITE_TRUNCATE',
+                                           clustering_fields=table.clustering_fields)
+    try:
+        with metrics.span('relayout_partition', table=full_table):
+            with api_call('bigquery'):
+                job = bq_client.query(sql, location=location, job_config=query_config)
+            job.result()
+            metrics.inc('relayout_bytes_processed', job.total_bytes_processed or 0, table=full_table)
+            if partition_state(bq_client, full_table, partition_id) != before:
+                return _partition_changed(full_table, partition_id)
+            try:
+                with api_call('bigquery'):
+                    swap_job = bq_client.query(swap_partition_sql(full_table, staging_table, day), location=location)
+                swap_job.result()
+            except GoogleCloudError as e:
+                # Our own check failing, or BigQuery aborting the transaction for a concurrent change to the table:
+                if PARTITION_CHANGED in str(e) or 'concurrent update' in str(e).lower():
+                    return _partition_changed(full_table, partition_id)
+                raise
+    finally:
+        with api_call('bigquery'):
+            bq_client.delete_table(staging_table, not_found_ok=True)
+    return True
+
+
+def _partition_changed(full_table, partition_id):
+    metrics.inc('relayout_partition_changed', table=full_table)
+    logging.warning('{0}: partition {1} changed while it was rebuilt; leaving it for the next run'.format(
+        full_table, partition_id))
+    return False
+
+
+def relayout_table(bq_client, full_table, kind, settle_days, dry_run, store, apply_expiration=False):
+    LOCATION = settings['INGEST_STORAGE_LOGS_LOCATION']
+
+    table = update_table_spec(bq_client, full_table, kind, dry_run, apply_expiration)
+    done = set((store.get_json(_state_key(full_table)) or {}).get('done', []))
+    todo = [pid for pid in settled_partitions(bq_client, full_table, settle_days) if pid not in done]
+    logging.info('{0}: {1} partitions to rewrite, {2} already done'.format(full_table, len(todo), len(done)))
+    if dry_run:
+        return 0
+
+    rewritten = 0
+    for count, partition_id in enumerate(todo, 1):
+        if not rewrite_partition(bq_client, full_table, table, partition_id, LOCATION):
+            continue
+        rewritten += 1
+        done.add(partition_id)
+        store.put_json(_state_key(full_table), {'done': sorted(done)})
+        logging.info('{0}: rewrote partition {1} ({2} of {3})'.format(full_table, partition_id, count, len(todo)))
+    return rewritten
+
+
+def relayout(tag, kinds=('usage', 'storage'), settle_days=2, dry_run=False, apply_expiration=False):
+
+    DEPLOY_PROJECT_ID = settings['DEPLOY_PROJECT_ID']
+    DATASET_BASE = settings['INGEST_STORAGE_LOGS_DATASET_BASE']
+
+    bq_client = bigquery.Client(project=DEPLOY_PROJECT_ID)
+    store = get_state_store()
+    for name in kinds:
+        kind = TABLE_KINDS[name]
+        full_table = '{0}.{1}{2}.{3}'.format(DEPLOY_PROJECT_ID, DATASET_BASE, tag,
+                                             settings['INGEST_STORAGE_LOGS_{0}_TABLE'.format(kind)])
+        relayout_table(bq_client, full_table, kind, settle_days, dry_run, store, apply_expiration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite ingest tables into the configured clustered layout')
+    parser.add_argument('--tag', required=True, help='Dataset tag for the project')
+    parser.add_argument('--table', choices=['usage', 'storage', 'both'], default='both')
+    parser.add_argument('--settle-days', type=int, default=2,
+                        help='Leave partitions this recent alone; they may still be receiving logs')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+    parser.add_argument('--apply-expiration', action='store_true',
+                        help='Also set the configured partition expiration, which deletes older partitions')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    kinds = ('usage', 'storage') if args.table == 'both' else (args.table,)
+    relayout(args.tag, kinds, args.settle_days, args.dry_run, args.apply_expiration)
+
+
+if __name__ == '__main__':
+    main()
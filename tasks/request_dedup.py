@@ -0,0 +1,251 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import math
+import struct
+import datetime
+import numpy as np
+import pandas as pd
+from google_helpers.metrics import metrics
+from google_helpers.state_store import get_state_store
+from config import settings
+import logging
+
+#
+# Drops usage rows whose s_request_id we have already loaded, so a file that is loaded again (the run died
+# between the load and the archive, or the file was delivered twice) does not duplicate rows in BigQuery.
+#
+# Request ids go into Bloom filters, one per project per hour of the row's time, kept in the state store under
+# dedup/<project>/<YYYYMMDDHH>.bloom. A usage log covers about an hour, so a file touches one or two small
+# filters: they are loaded when needed, and saved right after the load succeeds and before the file is archived.
+# If we die after saving, the rerun finds every row already seen. Saving is a separate write after the load, so
+# there is still a window between the two: dying there leaves rows loaded but not recorded. With load jobs the
+# rerun's load has the same job id (load_job_id) and is found already done, so nothing is loaded twice; with the
+# write_api engine there is no such check, and a file reloaded from that window is duplicated. Hours older than
+# INGEST_STORAGE_LOGS_DEDUP_WINDOW_HOURS are not checked (a lifecycle rule on the dedup/ prefix can expire their
+# filters).
+#
+# Each hour is a scalable Bloom filter: a stack of layers. The first is sized for
+# INGEST_STORAGE_LOGS_DEDUP_HOURLY_CAPACITY ids, and when the newest layer is full another is added with
+# GROWTH times the capacity and TIGHTENING times the false positive rate. An hour busier than planned costs
+# space, not accuracy: the rate stays under INGEST_STORAGE_LOGS_DEDUP_FP_RATE, the fraction of new rows that may
+# be wrongly dropped. With the defaults (500k ids, 0.001) the first layer is about 1MB. Positions come from two
+# 64-bit hashes of each id (pandas' vectorized hash_pandas_object with two keys), combined by double hashing.
+# Set INGEST_STORAGE_LOGS_DEDUP=False to turn it off.
+#
+
+DEFAULT_CAPACITY = 500000
+DEFAULT_FP_RATE = 0.001
+DEFAULT_WINDOW_HOURS = 72
+GROWTH = 2
+TIGHTENING = 0.5
+HEADER = struct.Struct('<QII')
+SECOND_HASH_KEY = 'idc-dedup-bloom2'
+
+
+def request_id_hashes(ids):
+    """
+    Two independent uint64 hashes per id
+    """
+    h1 = pd.util.hash_pandas_object(ids, index=False).to_numpy()
+    h2 = pd.util.hash_pandas_object(ids, index=False, hash_key=SECOND_HASH_KEY).to_numpy()
+    return h1, h2 | np.uint64(1)
+
+
+class BloomFilter(object):
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else np.zeros((num_bits + 7) // 8, dtype=np.uint8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate):
+        num_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, h1, h2):
+        steps = np.arange(self.num_hashes, dtype=np.uint64)[:, None]
+        return (h1[None, :] + steps * h2[None, :]) % np.uint64(self.num_bits)
+
+    def might_contain(self, h1, h2):
+        if len(h1) == 0:
+            return np.zeros(0, dtype=bool)
+        pos = self._positions(h1, h2)
+        hits = (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1
+        return hits.all(axis=0)
+
+    def add(self, h1, h2):
+        if len(h1) == 0:
+            return
+        pos = self._positions(h1, h2).ravel()
+        np.bitwise_or.at(self.bits, pos >> np.uint64(3), np.left_shift(1, (pos & np.uint64(7))).astype(np.uint8))
+        self.count += len(h1)
+
+    def to_bytes(self):
+        return HEADER.pack(self.num_bits, self.num_hashes, self.count) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """
+        The filter at offset in data, and the offset just past it
+        """
+        num_bits, num_hashes, count = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        end = start + (num_bits + 7) // 8
+        bits = np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start).copy()
+        return cls(num_bits, num_hashes, bits, count), end
+
+
+class ScalableBloomFilter(object):
+    """
+    Layers of Bloom filters; a new, larger and stricter layer is started when the newest one is full.
+    Saved as the layers' bytes one after another, so a single-layer filter is saved as a plain BloomFilter.
+    """
+    def __init__(self, capacity, fp_rate, layers=None):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.layers = layers or []
+
+    def _layer_capacity(self, index):
+        return self.capacity * GROWTH ** index
+
+    def _add_layer(self):
+        index = len(self.layers)
+        # The layers' rates form a geometric series, whose sum stays under fp_rate:
+        layer_fp_rate = self.fp_rate * (1 - TIGHTENING) * TIGHTENING ** index
+        self.layers.append(BloomFilter.for_capacity(self._layer_capacity(index), layer_fp_rate))
+
+    @property
+    def count(self):
+        return sum(layer.count for layer in self.layers)
+
+    def might_contain(self, h1, h2):
+        seen = np.zeros(len(h1), dtype=bool)
+        for layer in self.layers:
+            seen |= layer.might_contain(h1, h2)
+        return seen
+
+    def add(self, h1, h2):
+        """
+        Add the hashes, starting new layers as needed. Returns the number of layers added
+        """
+        added = 0
+        start = 0
+        while start < len(h1):
+            if not self.layers or self.layers[-1].count >= self._layer_capacity(len(self.layers) - 1):
+                self._add_layer()
+                added += 1
+            room = self._layer_capacity(len(self.layers) - 1) - self.layers[-1].count
+            self.layers[-1].add(h1[start:start + room], h2[start:start + room])
+            start += room
+        return added
+
+    def to_bytes(self):
+        return b''.join(layer.to_bytes() for layer in self.layers)
+
+    @classmethod
+    def from_bytes(cls, data, capacity, fp_rate):
+        layers = []
+        offset = 0
+        while offset < len(data):
+            layer, offset = BloomFilter.from_bytes(data, offset)
+            layers.append(layer)
+        return cls(capacity, fp_rate, layers)
+
+
+def dedup_enabled():
+    return settings.get('INGEST_STORAGE_LOGS_DEDUP', 'True') == 'True'
+
+
+class RequestDeduper(object):
+    """
+    Hourly filters for one project. drop_seen() before a load, commit() once the load has succeeded.
+    """
+    def __init__(self, project, store=None, labels=None, now=None):
+        self.project = project
+        self.store = store or get_state_store()
+        self.labels = labels or {}
+        self.capacity = int(settings.get('INGEST_STORAGE_LOGS_DEDUP_HOURLY_CAPACITY', DEFAULT_CAPACITY))
+        self.fp_rate = float(settings.get('INGEST_STORAGE_LOGS_DEDUP_FP_RATE', DEFAULT_FP_RATE))
+        window = float(settings.get('INGEST_STORAGE_LOGS_DEDUP_WINDOW_HOURS', DEFAULT_WINDOW_HOURS))
+        now = now or pd.Timestamp(datetime.datetime.now(datetime.timezone.utc))
+        self.oldest_hour = (now - pd.Timedelta(hours=window)).floor('h')
+        self.filters = {}
+        self.pending = []
+        self.dirty = set()
+
+    def _key(self, hour):
+        return 'dedup/{0}/{1}.bloom'.format(self.project, hour.strftime('%Y%m%d%H'))
+
+    def _filter(self, hour):
+        bloom = self.filters.get(hour)
+        if bloom is None:
+            data = self.store.get_bytes(self._key(hour))
+            bloom = ScalableBloomFilter.from_bytes(data, self.capacity, self.fp_rate) if data is not None else \
+                ScalableBloomFilter(self.capacity, self.fp_rate)
+            self.filters[hour] = bloom
+        return bloom
+
+    def drop_seen(self, df):
+        """
+        The rows of df whose request ids have not been loaded before. Their hashes are held for commit()
+        """
+        self.pending = []
+        ids = df['s_request_id']
+        hours = df['time'].dt.floor('h')
+        checked = ids.notna() & (hours >= self.oldest_hour)
+        if not checked.any():
+            return df
+        h1, h2 = request_id_hashes(ids[checked])
+        checked_hours = hours[checked].to_numpy(dtype='datetime64[ns]')
+        seen = np.zeros(len(df), dtype=bool)
+        checked_rows = np.flatnonzero(checked.to_numpy())
+        with metrics.span('dedup_check', **self.labels):
+            for hour in pd.unique(checked_hours):
+                in_hour = checked_hours == hour
+                hour = pd.Timestamp(hour)
+                hour_seen = self._filter(hour).might_contain(h1[in_hour], h2[in_hour])
+                seen[checked_rows[in_hour]] = hour_seen
+                self.pending.append((hour, h1[in_hour][~hour_seen], h2[in_hour][~hour_seen]))
+        dropped = int(seen.sum())
+        if dropped:
+            metrics.inc('dedup_rows_dropped', dropped, **self.labels)
+            logging.warning('{0}: dropping {1} of {2} rows already loaded'.format(self.project, dropped, len(df)))
+        return df[~seen] if dropped else df
+
+    def commit(self):
+        """
+        Record the ids from the last drop_seen() and save the filters they went into
+        """
+        with metrics.span('dedup_commit', **self.labels):
+            for hour, h1, h2 in self.pending:
+                bloom = self._filter(hour)
+                layers_added = bloom.add(h1, h2)
+                self.dirty.add(hour)
+                if layers_added and len(bloom.layers) > 1:
+                    metrics.inc('dedup_filter_layers_added', layers_added, **self.labels)
+                    logging.info('Dedup filter {0} holds {1} ids in {2} layers'.format(
+                        self._key(hour), bloom.count, len(bloom.layers)))
+            self.pending = []
+            # A filter that failed to save last time stays dirty, so a retry saves it even with nothing new:
+            for hour in sorted(self.dirty):
+                self.store.put_bytes(self._key(hour), self.filters[hour].to_bytes())
+                self.dirty.discard(hour)
@@ -0,0 +1,148 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import bisect
+import datetime
+import hashlib
+import uuid
+from google_helpers.state_store import get_state_store
+import logging
+
+#
+# Split per-project (and optionally per-bucket) work across N shard requests, so each one can land on its own
+# instance. Keys are placed on a consistent hash ring, which keeps most keys on the same shard when the shard
+# count changes. Leases and continuation tokens are kept per project (tasks/task_runtime.py), not per shard, so
+# changing the count does not orphan them; only bucket-sharded audit slices are keyed by the shard suffix.
+#
+# Nothing is sharded unless asked: cron.yaml calls the unsharded routes. To shard a task, set
+# TASK_FOLLOW_UP_QUEUE and point its cron entry at /tasks/coordinate/<task>?shards=<n> instead.
+#
+# A shard request carries ?shard=<index>&shards=<count>; a coordinator request fans a round of shard requests out
+# through the task queue, and each shard records its completion so the coordinator can report on the round.
+#
+
+RING_REPLICAS = 64
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    def __init__(self, shard_count, replicas=RING_REPLICAS):
+        self.shard_count = shard_count
+        points = sorted((_hash('shard-{0}-{1}'.format(shard, replica)), shard)
+                        for shard in range(shard_count) for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._shards = [point[1] for point in points]
+
+    def shard_for(self, key):
+        pos = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[pos]
+
+
+class ShardSpec(object):
+    def __init__(self, index, count, round_id=None):
+        if count < 1 or not (0 <= index < count):
+            raise ValueError('Bad shard {0} of {1}'.format(index, count))
+        self.index = index
+        self.count = count
+        self.round_id = round_id
+        self._ring = HashRing(count)
+
+    @classmethod
+    def from_request_args(cls, args):
+        """
+        None unless the request names a shard; a single shard is the same as no sharding
+        """
+        if 'shard' not in args or 'shards' not in args:
+            return None
+        spec = cls(int(args['shard']), int(args['shards']), args.get('round'))
+        return spec if spec.count > 1 else None
+
+    def owns(self, key):
+        return self._ring.shard_for(key) == self.index
+
+    def suffix(self):
+        return 'shard-{0}-of-{1}'.format(self.index, self.count)
+
+
+def shard_pairs(project_list, tag_list, shard):
+    """
+    The (project, tag) pairs this shard is responsible for; all of them if shard is None
+    """
+    pairs = list(zip(project_list, tag_list))
+    if shard is None:
+        return pairs
+    return [pair for pair in pairs if shard.owns(pair[0])]
+
+
+#
+# Round bookkeeping. Each shard writes its own record, so there are no concurrent writers on any key:
+#
+
+def _round_key(task_name):
+    return 'shards/{0}/current.json'.format(task_name)
+
+
+def _shard_key(task_name, round_id, index):
+    return 'shards/{0}/{1}/{2}.json'.format(task_name, round_id, index)
+
+
+def round_status(task_name, store=None):
+    store = store or get_state_store()
+    current = store.get_json(_round_key(task_name))
+    if current is None:
+        return None
+    done = {}
+    for index in range(current['shard_count']):
+        record = store.get_json(_shard_key(task_name, current['round_id'], index))
+        if record is not None:
+            done[index] = record
+    return {'round_id': current['round_id'],
+            'started': current['started'],
+            'shard_count': current['shard_count'],
+            'shards_reported': len(done),
+            'shards_finished': sum(1 for record in done.values() if record['finished']),
+            'shards': done}
+
+
+def start_round(task_name, shard_count, store=None):
+    """
+    Log how the previous round went, then open a new one. Returns the new round id
+    """
+    store = store or get_state_store()
+    previous = round_status(task_name, store)
+    if previous is not None:
+        logging.info('{0} round {1}: {2} of {3} shards finished, {4} reported'.format(
+            task_name, previous['round_id'], previous['shards_finished'], previous['shard_count'],
+            previous['shards_reported']))
+    round_id = uuid.uuid4().hex[:12]
+    store.put_json(_round_key(task_name), {'round_id': round_id,
+                                           'shard_count': shard_count,
+                                           'started': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+    return round_id
+
+
+def record_shard_done(task_name, shard, finished, store=None):
+    if shard is None or shard.round_id is None:
+        return
+    store = store or get_state_store()
+    store.put_json(_shard_key(task_name, shard.round_id, shard.index),
+                   {'finished': finished,
+                    'reported': datetime.datetime.now(datetime.timezone.utc).isoformat()})
@@ -0,0 +1,220 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+import datetime
+from google_helpers.state_store import get_state_store
+from config import settings
+import logging
+
+#
+# Cron handlers run inside an HTTP request, and App Engine kills the request at its deadline. A TaskRun gives
+# each invocation a wall-clock budget. The task checks it at safe points (after a blob is archived, after a
+# bucket is audited, after a pipeline stage finishes) and, if the budget is spent, saves a continuation token
+# for the project it is on and returns. If TASK_FOLLOW_UP_QUEUE is configured, an unfinished run also enqueues a
+# follow-up request through Cloud Tasks instead of waiting for the next cron tick.
+#
+# Work is claimed and checkpointed per project, not per run, so that how the projects are split up (one
+# unsharded run, or shards of any count) does not matter: TaskRun.projects() takes a lease per task and project
+# (google_helpers.lease) and skips a project whose lease somebody else holds, and each project's continuation
+# token lives under checkpoints/<task>/<project>.json along with when the project was last finished. A run
+# goes through its projects least recently finished first, and skips those finished since its pass began (the
+# since= of a follow-up request, or the start of the run), so a follow-up or the next cron tick picks up where
+# the last one stopped.
+#
+# If a project's lease is lost, the run treats that like running out of time, and stops without writing a
+# token, since the new holder owns the project now. Checkpoints carry the lease's fencing token and are written
+# with a generation precondition: a run that finds a checkpoint from a newer token, or loses the race to write
+# one, is fenced off and treated as having lost its lease.
+#
+
+DEFAULT_BUDGET_SECS = 480
+
+
+class TimeBudget(object):
+    def __init__(self, secs, clock=time.monotonic):
+        self.secs = secs
+        self._clock = clock
+        self._start = clock()
+
+    def elapsed(self):
+        return self._clock() - self._start
+
+    def remaining(self):
+        return self.secs - self.elapsed()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class TaskRun(object):
+    """
+    One invocation of a task. since is the wall-clock start of the pass this invocation belongs to.
+    """
+    def __init__(self, task_name, budget, store, since=None, lease_factory=None):
+        self.task_name = task_name
+        self.budget = budget
+        self.store = store
+        self.since = since if since is not None else time.time()
+        self._lease_factory = lease_factory
+        self.lease = None
+        self.current = None
+        self.finished = False
+        self.fenced = False
+
+    def _key(self, name):
+        return 'checkpoints/{0}/{1}.json'.format(self.task_name, name)
+
+    def _new_lease(self, name):
+        if self._lease_factory is None:
+            from google_helpers.lease import get_lease
+            return get_lease(name)
+        return self._lease_factory(name)
+
+    def projects(self, pairs, key=None):
+        """
+        Yields (project, tag, resume state or None) for the (project, tag) pairs, stalest first, each while
+        holding that project's lease. Asking for the next one marks the previous project finished. key maps a
+        project to the name its lease and checkpoint are kept under (the project id by default).
+        """
+        key = key or (lambda project: project)
+        todo = []
+        for project, tag in pairs:
+            saved = self.store.get_json(self._key(key(project))) or {}
+            finished_at = saved.get('finished') or 0
+            if finished_at < self.since:
+                todo.append((finished_at, project, tag))
+        # Stable, so projects never finished keep their configured order:
+        todo.sort(key=lambda entry: entry[0])
+
+        for _, project, tag in todo:
+            name = key(project)
+            lease = self._new_lease('{0}.{1}'.format(self.task_name, name))
+            if not lease.acquire():
+                logging.info('{0}: {1} is being worked on elsewhere; skipping it'.format(self.task_name, name))
+                continue
+            lease.start_heartbeat()
+            self.lease = lease
+            self.current = name
+            self.fenced = False
+            try:
+                # Read again under the lease; the run that held it before may have just finished the project:
+                saved = self.store.get_json(self._key(name)) or {}
+                if (saved.get('finished') or 0) >= self.since:
+                    continue
+                state = saved.get('state') or None
+                if state:
+                    logging.info('{0}: resuming {1} from continuation token saved {2}'.format(
+                        self.task_name, name, saved.get('saved')))
+                yield project, tag, state
+                if not self.lease_lost():
+                    self._save({}, finished=time.time())
+            finally:
+                lease.release()
+                self.current = None
+
+    def lease_lost(self):
+        return self.fenced or (self.lease is not None and self.lease.lost)
+
+    def _fenced_write(self, record):
+        """
+        Write record as the checkpoint unless a holder with a newer fencing token got there first
+        """
+        generation, saved = self.store.get_json_versioned(self._key(self.current))
+        saved_token = (saved or {}).get('fencing_token') or 0
+        if saved_token > self.lease.fencing_token or \
+                not self.store.put_json_if_generation(self._key(self.current), record, generation):
+            self.fenced = True
+            logging.warning('{0} was fenced off {1} by a newer lease holder (token {2}, ours {3})'.format(
+                self.task_name, self.current, saved_token, self.lease.fencing_token))
+
+    def out_of_time(self):
+        return self.budget.expired() or self.lease_lost()
+
+    def checkpoint(self, state):
+        """
+        Persist progress on the current project at a safe point. Anything not in state is redone on resume.
+        """
+        if self.lease_lost():
+            logging.warning('{0} lost its lease on {1}; not saving continuation'.format(self.task_name,
+                                                                                       self.current))
+            return
+        self._save(state)
+
+    def _save(self, state, finished=None):
+        if finished is None:
+            # Keep the time the project was last finished, which orders the next pass:
+            finished = (self.store.get_json(self._key(self.current)) or {}).get('finished')
+        self._fenced_write({'task': self.task_name,
+                            'saved': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                            'fencing_token': self.lease.fencing_token,
+                            'finished': finished,
+                            'state': state})
+
+    def stop(self, state):
+        """
+        Budget is spent: save where we are in the current project and tell the caller to bail out
+        """
+        logging.info('{0} out of time after {1:.0f} secs; saving continuation'.format(self.task_name,
+                                                                                      self.budget.elapsed()))
+        self.checkpoint(state)
+        return False
+
+    def complete(self):
+        self.finished = True
+        return True
+
+
+def project_work(run, pairs, key=None):
+    """
+    run.projects(pairs, key), or every pair with no resume state when there is no run
+    """
+    if run is None:
+        return ((project, tag, None) for project, tag in pairs)
+    return run.projects(pairs, key)
+
+
+def start_run(task_name, budget_secs=None, store=None, since=None, lease_factory=None):
+    if budget_secs is None:
+        budget_secs = float(settings.get('TASK_TIME_BUDGET_SECS', DEFAULT_BUDGET_SECS))
+    if store is None:
+        store = get_state_store()
+    return TaskRun(task_name, TimeBudget(budget_secs), store, since, lease_factory)
+
+
+def enqueue_request(relative_uri):
+    """
+    Ask Cloud Tasks to call one of our routes right away (a follow-up for an unfinished run, or a shard request).
+    Only used if TASK_FOLLOW_UP_QUEUE (projects/<p>/locations/<l>/queues/<q>) is set; otherwise returns False
+    and the work waits for the next cron run.
+    """
+    queue = settings.get('TASK_FOLLOW_UP_QUEUE')
+    if not queue:
+        return False
+    from google.cloud import tasks_v2
+    client = tasks_v2.CloudTasksClient()
+    task = {
+        'app_engine_http_request': {
+            'http_method': tasks_v2.HttpMethod.GET,
+            'relative_uri': relative_uri,
+            'app_engine_routing': {'service': settings.get('TASK_FOLLOW_UP_SERVICE', 'cron')}
+        }
+    }
+    client.create_task(parent=queue, task=task)
+    logging.info('Enqueued request for {0}'.format(relative_uri))
+    return True
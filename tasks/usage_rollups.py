@@ -0,0 +1,253 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import hashlib
+from google.cloud import bigquery
+import pandas as pd
+from google_helpers.limiter import api_call
+from google_helpers.metrics import metrics
+from config import settings
+import logging
+
+#
+# Hourly and daily rollups of the usage table, maintained at ingest time so reporting queries (egress by bucket,
+# operation, status, distinct client IPs) read a few MB instead of scanning raw request rows.
+#
+# Rollups are computed from each frame as it is loaded and appended, before its file is archived, to
+# <usage>_rollup_pending, tagged with a source id (the file's load job id). So a rollup whose file is gone is never
+# only in memory, and staging the same file again is a no-op: its staging load has a job id derived from the source
+# too. At the end of a run (flush) every pending source not yet applied is folded into the rollup tables, one
+# transaction per granularity: a MERGE that adds the counts and merges the HLL++ sketches of the distinct client
+# IPs, plus a row per source in <usage>_rollup_applied. The batch is picked, and checked against the ledger, inside
+# that transaction, so the MERGE and the ledger insert see one snapshot. A source in the ledger is never merged
+# again, so a flush that dies part way, or a file staged twice, does not count anything twice; of two flushes
+# running at once (overlapping runs, or the backfill command next to cron ingest) the second to commit is aborted
+# for its concurrent update, and its sources are left for the next flush. Applied pending rows are then deleted,
+# and ledger rows a month old are pruned.
+#
+# Distinct IPs over any range are HLL_COUNT.MERGE(client_ip_sketch). Null buckets and operations are stored as ''
+# so the MERGE keys compare equal.
+#
+
+GRANULARITIES = {
+    'hourly': 'h',
+    'daily': 'D',
+}
+
+KEY_COLUMNS = ['period_start', 'cs_bucket', 'cs_operation', 'sc_status']
+
+
+def get_rollup_schema(for_staging):
+    rollup_schema = [
+        bigquery.SchemaField("period_start", "TIMESTAMP", mode="REQUIRED",
+                             description='Start of the hour or day being summarized.'),
+        bigquery.SchemaField("cs_bucket", "STRING", mode="REQUIRED",
+                             description='The bucket of the requests; empty for list bucket requests.'),
+        bigquery.SchemaField("cs_operation", "STRING", mode="REQUIRED",
+                             description='The Cloud Storage operation e.g. GET_Object.'),
+        bigquery.SchemaField("sc_status", "INTEGER", mode="REQUIRED",
+                             description='The HTTP status code of the responses.'),
+        bigquery.SchemaField("request_count", "INTEGER", mode="REQUIRED",
+                             description='Number of requests.'),
+        bigquery.SchemaField("sc_bytes", "INTEGER", mode="REQUIRED",
+                             description='Total bytes sent in responses.'),
+        bigquery.SchemaField("cs_bytes", "INTEGER", mode="REQUIRED",
+                             description='Total bytes sent in requests.'),
+    ]
+    if for_staging:
+        rollup_schema.insert(0, bigquery.SchemaField("granularity", "STRING", mode="REQUIRED",
+                                                     description='hourly or daily.'))
+        rollup_schema.append(bigquery.SchemaField("client_ips", "STRING", mode="REPEATED",
+                                                  description='Distinct client IPs in the group.'))
+        rollup_schema.append(bigquery.SchemaField("source_file", "STRING", mode="REQUIRED",
+                                                  description='Id of the load the rows came from.'))
+    else:
+        rollup_schema.append(bigquery.SchemaField("client_ip_sketch", "BYTES", mode="NULLABLE",
+                                                  description='HLL++ sketch of the distinct client IPs; '
+                                                              'use HLL_COUNT.MERGE to count them.'))
+    return rollup_schema
+
+#
+# Summarize one usage frame (as loaded, with the datetime 'time' column):
+#
+
+def compute_rollup(df, granularity):
+    keyed = pd.DataFrame({
+        'period_start': df['time'].dt.floor(GRANULARITIES[granularity]),
+        'cs_bucket': df['cs_bucket'].fillna(''),
+        'cs_operation': df['cs_operation'].fillna(''),
+        'sc_status': df['sc_status'],
+        'sc_bytes': df['sc_bytes'],
+        'cs_bytes': df['cs_bytes'].fillna(0).astype('int64'),
+        'c_ip': df['c_ip'],
+    })
+    grouped = keyed.groupby(KEY_COLUMNS, sort=False)
+    rollup = grouped.agg(request_count=('c_ip', 'size'), sc_bytes=('sc_bytes', 'sum'), cs_bytes=('cs_bytes', 'sum'),
+                         client_ips=('c_ip', 'unique'))
+    return rollup.reset_index()
+
+
+def get_applied_schema():
+    return [
+        bigquery.SchemaField("granularity", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("source_file", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("applied_at", "TIMESTAMP", mode="REQUIRED"),
+    ]
+
+
+def merge_rollup_sql(target_table, pending_table, applied_table, granularity):
+
+    return '''
+        DECLARE lo, hi TIMESTAMP;
+
+        BEGIN TRANSACTION;
+
+        CREATE TEMP TABLE batch AS
+        SELECT p.*, (SELECT HLL_COUNT.INIT(ip) FROM UNNEST(p.client_ips) AS ip) AS client_ip_sketch
+        FROM `{1}` AS p
+        WHERE p.granularity = "{3}"
+          AND NOT EXISTS (SELECT 1 FROM `{2}` AS a
+                          WHERE a.granularity = p.granularity AND a.source_file = p.source_file);
+
+        SET (lo, hi) = (SELECT AS STRUCT MIN(period_start), MAX(period_start) FROM batch);
+
+        MERGE `{0}` AS t
+        USING (
+            SELECT
+                period_start, cs_bucket, cs_operation, sc_status, SUM(request_count) AS request_count,
+                SUM(sc_bytes) AS sc_bytes, SUM(cs_bytes) AS cs_bytes,
+                HLL_COUNT.MERGE_PARTIAL(client_ip_sketch) AS client_ip_sketch
+            FROM batch
+            GROUP BY period_start, cs_bucket, cs_operation, sc_status
+        ) AS s
+        ON t.period_start BETWEEN lo AND hi
+           AND t.period_start = s.period_start
+           AND t.cs_bucket = s.cs_bucket
+           AND t.cs_operation = s.cs_operation
+           AND t.sc_status = s.sc_status
+        WHEN MATCHED THEN UPDATE SET
+            request_count = t.request_count + s.request_count,
+            sc_bytes = t.sc_bytes + s.sc_bytes,
+            cs_bytes = t.cs_bytes + s.cs_bytes,
+            client_ip_sketch = (SELECT HLL_COUNT.MERGE_PARTIAL(sketch)
+                                FROM UNNEST([t.client_ip_sketch, s.client_ip_sketch]) AS sketch)
+        WHEN NOT MATCHED THEN INSERT
+            (period_start, cs_bucket, cs_operation, sc_status, request_count, sc_bytes, cs_bytes, client_ip_sketch)
+            VALUES (s.period_start, s.cs_bucket, s.cs_operation, s.sc_status, s.request_count, s.sc_bytes,
+                    s.cs_bytes, s.client_ip_sketch);
+
+        INSERT INTO `{2}` (granularity, source_file, applied_at)
+        SELECT DISTINCT granularity, source_file, CURRENT_TIMESTAMP() FROM batch;
+
+        COMMIT TRANSACTION;
+
+        DELETE FROM `{1}` AS p
+        WHERE p.granularity = "{3}"
+          AND EXISTS (SELECT 1 FROM `{2}` AS a WHERE a.granularity = p.granularity AND a.source_file = p.source_file);
+
+        DELETE FROM `{2}` AS a
+        WHERE a.granularity = "{3}"
+          AND a.applied_at < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY)
+          AND NOT EXISTS (SELECT 1 FROM `{1}` AS p WHERE p.granularity = a.granularity AND p.source_file = a.source_file);
+        '''.format(target_table, pending_table, applied_table, granularity)
+
+
+def rollups_enabled():
+    return settings.get('INGEST_STORAGE_LOGS_ROLLUPS', 'True') == 'True'
+
+
+class RollupAccumulator(object):
+    """
+    Stages the rollup of each loaded frame with add(), and folds everything staged into the rollup tables on flush()
+    """
+    def __init__(self, bq_client, full_usage_table, location, labels=None):
+        self.bq_client = bq_client
+        self.full_usage_table = full_usage_table
+        self.location = location
+        self.labels = labels or {}
+        self.pending_table = '{0}_rollup_pending'.format(full_usage_table)
+        self.applied_table = '{0}_rollup_applied'.format(full_usage_table)
+        self.staged = 0
+        self.tables_ready = False
+
+    def _ensure_table(self, full_table, schema, partition_type=None):
+        from tasks.bucket_access_to_bq import bq_table_exists
+        project, dataset, table_name = full_table.split('.')
+        if not bq_table_exists(self.bq_client, dataset, table_name):
+            table = bigquery.Table(full_table, schema=schema)
+            if partition_type is not None:
+                table.time_partitioning = bigquery.TimePartitioning(type_=partition_type, field="period_start")
+            with api_call('bigquery'):
+                self.bq_client.create_table(table)
+
+    def _ensure_tables(self):
+        if self.tables_ready:
+            return
+        self._ensure_table(self.pending_table, get_rollup_schema(True))
+        self._ensure_table(self.applied_table, get_applied_schema())
+        for granularity in GRANULARITIES:
+            partition_type = bigquery.TimePartitioningType.DAY if granularity == 'hourly' \
+                else bigquery.TimePartitioningType.MONTH
+            self._ensure_table(self._target(granularity), get_rollup_schema(False), partition_type)
+        self.tables_ready = True
+
+    def _target(self, granularity):
+        return '{0}_rollup_{1}'.format(self.full_usage_table, granularity)
+
+    def add(self, df, source):
+        """
+        Stage the rollups of df, which was loaded under the id source. Raises if the staging load fails
+        """
+        from tasks.bucket_access_to_bq import run_load_job
+        with metrics.span('rollup_compute', **self.labels):
+            frames = []
+            for granularity in GRANULARITIES:
+                rollup = compute_rollup(df, granularity)
+                rollup.insert(0, 'granularity', granularity)
+                frames.append(rollup)
+            staged = pd.concat(frames, ignore_index=True)
+            staged['client_ips'] = staged['client_ips'].apply(list)
+            staged['source_file'] = source
+        self._ensure_tables()
+        job_config = bigquery.LoadJobConfig(schema=get_rollup_schema(True), write_disposition="WRITE_APPEND")
+        job_id = 'rollup_{0}'.format(hashlib.sha1('{0}\n{1}'.format(self.pending_table, source).encode('utf-8'))
+                                     .hexdigest()[:32])
+        run_load_job(self.bq_client, staged, self.pending_table, job_config, self.location, self.labels, job_id)
+        metrics.inc('rollup_groups', len(staged), **self.labels)
+        self.staged += 1
+
+    def flush(self):
+        """
+        Apply staged rollups. Never raises: a granularity that fails is logged and left for the next flush
+        """
+        if not self.staged:
+            return
+        for granularity in GRANULARITIES:
+            labels = dict(self.labels, granularity=granularity)
+            try:
+                sql = merge_rollup_sql(self._target(granularity), self.pending_table, self.applied_table,
+                                       granularity)
+                with metrics.span('rollup_merge', **labels):
+                    with api_call('bigquery'):
+                        merge_job = self.bq_client.query(sql, location=self.location)
+                    merge_job.result()
+            except Exception as e:
+                metrics.inc('rollup_merge_failures', **labels)
+                logging.error('Rollup merge into {0} failed, left for the next run: {1}'.format(
+                    self._target(granularity), str(e)))
+        self.staged = 0
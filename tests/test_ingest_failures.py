@@ -0,0 +1,90 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from types import SimpleNamespace
+import pytest
+from google.api_core import exceptions
+from google_helpers.limiter import CircuitOpenError
+from google_helpers.storage_write import StorageWriteError
+from tasks import bucket_access_to_bq
+from tasks.bucket_access_to_bq import BadLogFileError, LoadFailedError, failure_action, failure_reason, \
+    ingest_blob, with_retries, RETRY, STOP, QUARANTINE, SKIP
+from tasks.log_codecs import CodecUnavailableError
+
+
+@pytest.mark.parametrize('error, action', [
+    (exceptions.TooManyRequests('slow down'), RETRY),
+    (exceptions.ServiceUnavailable('down'), RETRY),
+    (exceptions.InternalServerError('oops'), RETRY),
+    (LoadFailedError('p.d.t', {'reason': 'backendError'}), RETRY),
+    (LoadFailedError('p.d.t', {'reason': 'rateLimitExceeded'}), RETRY),
+    (exceptions.Forbidden('no'), STOP),
+    (exceptions.NotFound('no table'), STOP),
+    (exceptions.Unauthorized('who'), STOP),
+    (CircuitOpenError('bigquery', 10.0), STOP),
+    (LoadFailedError('p.d.t', {'reason': 'accessDenied'}), STOP),
+    (LoadFailedError('p.d.t', {'reason': 'quotaExceeded'}), STOP),
+    (BadLogFileError('bad_name', 'not a log'), QUARANTINE),
+    (LoadFailedError('p.d.t', {'reason': 'invalid'}), QUARANTINE),
+    (ValueError('bad csv'), QUARANTINE),
+    (EOFError('truncated gzip'), QUARANTINE),
+    (StorageWriteError('rejected rows'), QUARANTINE),
+    (StorageWriteError('stream gone', 5, on_stream=True), RETRY),
+    (CodecUnavailableError('zstandard is not installed'), SKIP),
+    (LoadFailedError('p.d.t', {'reason': 'somethingNew'}), SKIP),
+    (RuntimeError('who knows'), SKIP),
+])
+def test_failure_action(error, action):
+    assert failure_action(error) == action
+
+
+def test_failure_reason():
+    assert failure_reason(BadLogFileError('bad_name', 'x')) == 'bad_name'
+    assert failure_reason(LoadFailedError('p.d.t', {'reason': 'invalid'})) == 'load_rejected'
+    assert failure_reason(ValueError('x')) == 'parse_error'
+
+
+def test_with_retries_retries_only_retryable_errors(monkeypatch):
+    monkeypatch.setattr(bucket_access_to_bq.time, 'sleep', lambda secs: None)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise exceptions.ServiceUnavailable('down')
+        return 'done'
+
+    assert with_retries(flaky, 3, {}, 'flaky') == 'done'
+    assert len(calls) == 3
+
+    calls.clear()
+
+    def broken():
+        calls.append(1)
+        raise ValueError('bad csv')
+
+    with pytest.raises(ValueError):
+        with_retries(broken, 3, {}, 'broken')
+    assert len(calls) == 1
+
+
+def test_unknown_log_kinds_are_quarantined():
+    blob = SimpleNamespace(name='bucket_other_2020_01_01_v0', size=1)
+    with pytest.raises(BadLogFileError) as raised:
+        ingest_blob(blob, 'gs://src/' + blob.name, None, 'p.d.usage', 'US', {}, None)
+    assert failure_action(raised.value) == QUARANTINE
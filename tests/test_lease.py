@@ -0,0 +1,102 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import pytest
+from google_helpers.lease import Lease, LeaseLostError, LocalFileLeaseBackend
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalFileLeaseBackend(str(tmp_path))
+
+
+def test_backend_write_needs_the_current_generation(backend):
+    assert backend.read('task') == (0, None)
+    assert backend.write('task', {'holder': 'a'}, 0) == 1
+    assert backend.write('task', {'holder': 'b'}, 0) is None
+    assert backend.read('task') == (1, {'holder': 'a'})
+    assert backend.write('task', {'holder': 'b'}, 1) == 2
+    assert backend.read('task') == (2, {'holder': 'b'})
+
+
+def test_a_held_lease_is_not_acquired_again(backend):
+    clock = Clock()
+    first = Lease(backend, 'task', 60, holder='a', clock=clock)
+    second = Lease(backend, 'task', 60, holder='b', clock=clock)
+    assert first.acquire()
+    assert first.held
+    assert first.fencing_token == 1
+    assert not second.acquire()
+    assert not second.held
+
+
+def test_release_frees_the_lease(backend):
+    clock = Clock()
+    first = Lease(backend, 'task', 60, holder='a', clock=clock)
+    second = Lease(backend, 'task', 60, holder='b', clock=clock)
+    assert first.acquire()
+    first.release()
+    assert not first.held
+    assert second.acquire()
+    assert second.fencing_token == 2
+
+
+def test_an_expired_lease_is_lost_and_taken_over(backend):
+    clock = Clock()
+    first = Lease(backend, 'task', 60, holder='a', clock=clock)
+    second = Lease(backend, 'task', 60, holder='b', clock=clock)
+    assert first.acquire()
+    clock.now += 61
+    # No renewal for a whole ttl: the holder must assume it lost the lease, even before anyone takes it
+    assert first.lost
+    assert second.acquire()
+    assert second.fencing_token > first.fencing_token
+    with pytest.raises(LeaseLostError):
+        first.renew()
+
+
+def test_renewal_keeps_the_lease(backend):
+    clock = Clock()
+    first = Lease(backend, 'task', 60, holder='a', clock=clock)
+    second = Lease(backend, 'task', 60, holder='b', clock=clock)
+    assert first.acquire()
+    for _ in range(3):
+        clock.now += 40
+        first.renew()
+    assert first.held
+    assert not second.acquire()
+
+
+def test_a_renewal_after_a_takeover_is_refused(backend):
+    clock = Clock()
+    first = Lease(backend, 'task', 60, holder='a', clock=clock)
+    assert first.acquire()
+    # Someone else wrote the record meanwhile (e.g. took it over after a pause we did not notice):
+    generation, record = backend.read('task')
+    backend.write('task', dict(record, holder='b'), generation)
+    with pytest.raises(LeaseLostError):
+        first.renew()
+    assert first.lost
@@ -0,0 +1,60 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import pytest
+from google_helpers.local_sql import translate_sql
+
+
+def test_table_names_become_quoted_identifiers():
+    assert translate_sql('SELECT * FROM `p.d.t`') == 'SELECT * FROM "p.d.t"'
+
+
+def test_strings():
+    assert translate_sql('SELECT "it\'s", r"a\\d+", \'x\\ny\'') == "SELECT 'it''s', 'a\\d+', 'x\ny'"
+
+
+def test_comments_are_dropped():
+    assert translate_sql('SELECT 1 -- one\n# two\n') == 'SELECT 1 \n\n'
+
+
+def test_cast_types():
+    assert translate_sql('CAST(x AS INT64)') == 'CAST(x AS BIGINT)'
+    assert translate_sql('CAST(x AS FLOAT64), CAST(y AS BOOL)') == 'CAST(x AS DOUBLE), CAST(y AS BOOLEAN)'
+    # Only types in a CAST; a column aliased like a type stays as it is:
+    assert translate_sql('SELECT n AS bytes FROM t') == 'SELECT n AS bytes FROM t'
+
+
+def test_regexp_contains():
+    assert translate_sql('WHERE REGEXP_CONTAINS(url, r"^/v1/")') == "WHERE regexp_matches(url, '^/v1/')"
+
+
+def test_regexp_extract_uses_the_capture_group_and_null_for_no_match():
+    assert translate_sql('REGEXP_EXTRACT(url, r"/(\\w+)/")') == \
+        "NULLIF(regexp_extract(url, '/(\\w+)/', 1), '')"
+    assert translate_sql('REGEXP_EXTRACT(url, r"\\w+")') == "NULLIF(regexp_extract(url, '\\w+', 0), '')"
+
+
+def test_nested_calls_are_rewritten():
+    sql = 'REGEXP_EXTRACT(LOWER(REGEXP_EXTRACT(url, r"(a)")), r"(b)")'
+    assert translate_sql(sql) == \
+        "NULLIF(regexp_extract(LOWER(NULLIF(regexp_extract(url, '(a)', 1), '')), '(b)', 1), '')"
+
+
+def test_unbalanced_parentheses():
+    with pytest.raises(ValueError):
+        translate_sql('REGEXP_CONTAINS(url, "x"')
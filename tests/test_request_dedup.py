@@ -0,0 +1,75 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import numpy as np
+import pandas as pd
+from tasks.request_dedup import BloomFilter, ScalableBloomFilter, request_id_hashes
+
+
+def hashes(prefix, count):
+    return request_id_hashes(pd.Series(['{0}-{1}'.format(prefix, i) for i in range(count)]))
+
+
+def test_no_false_negatives_across_layers():
+    bloom = ScalableBloomFilter(1000, 0.001)
+    h1, h2 = hashes('seen', 7000)
+    added = bloom.add(h1, h2)
+    # 1000 + 2000 + 4000 fills three layers exactly:
+    assert added == 3
+    assert len(bloom.layers) == 3
+    assert bloom.count == 7000
+    assert bloom.might_contain(h1, h2).all()
+
+
+def test_false_positive_rate_stays_bounded_as_it_grows():
+    bloom = ScalableBloomFilter(1000, 0.01)
+    bloom.add(*hashes('seen', 15000))
+    h1, h2 = hashes('unseen', 20000)
+    assert bloom.might_contain(h1, h2).mean() < 0.01 * 1.5
+
+
+def test_adding_in_pieces_fills_layers_to_capacity():
+    bloom = ScalableBloomFilter(100, 0.01)
+    for start in range(0, 1000, 30):
+        h1, h2 = hashes('piece-{0}'.format(start), 30)
+        bloom.add(h1, h2)
+    assert [layer.count for layer in bloom.layers[:-1]] == [100, 200, 400]
+    assert bloom.count == 1020
+
+
+def test_round_trip():
+    bloom = ScalableBloomFilter(500, 0.001)
+    h1, h2 = hashes('seen', 1800)
+    bloom.add(h1, h2)
+    loaded = ScalableBloomFilter.from_bytes(bloom.to_bytes(), 500, 0.001)
+    assert len(loaded.layers) == len(bloom.layers)
+    assert loaded.count == bloom.count
+    assert loaded.might_contain(h1, h2).all()
+    unseen = hashes('unseen', 1000)
+    assert np.array_equal(loaded.might_contain(*unseen), bloom.might_contain(*unseen))
+
+
+def test_a_single_bloom_filter_loads_as_one_layer():
+    legacy = BloomFilter.for_capacity(1000, 0.001)
+    h1, h2 = hashes('seen', 300)
+    legacy.add(h1, h2)
+    loaded = ScalableBloomFilter.from_bytes(legacy.to_bytes(), 1000, 0.001)
+    assert len(loaded.layers) == 1
+    assert loaded.might_contain(h1, h2).all()
+    assert loaded.add(*hashes('more', 700)) == 0
+    assert loaded.add(*hashes('overflow', 1)) == 1
@@ -0,0 +1,72 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from collections import Counter
+import pytest
+from tasks.sharding import HashRing, ShardSpec, shard_pairs
+
+KEYS = ['isb-cgc-project-{0}'.format(i) for i in range(2000)]
+
+
+def test_every_key_has_exactly_one_owner():
+    specs = [ShardSpec(index, 4) for index in range(4)]
+    for key in KEYS:
+        assert sum(spec.owns(key) for spec in specs) == 1
+
+
+def test_keys_are_spread_over_the_shards():
+    counts = Counter(HashRing(4).shard_for(key) for key in KEYS)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(KEYS) / 4 * 0.5
+
+
+def test_assignment_is_stable():
+    assert [HashRing(4).shard_for(key) for key in KEYS] == [HashRing(4).shard_for(key) for key in KEYS]
+
+
+def test_adding_a_shard_moves_few_keys():
+    before = HashRing(4)
+    after = HashRing(5)
+    moved = sum(before.shard_for(key) != after.shard_for(key) for key in KEYS)
+    # Ideally 1/5 of the keys move, all of them to the new shard; modulo hashing would move about 4/5
+    assert moved < len(KEYS) * 0.35
+    assert all(after.shard_for(key) == 4 for key in KEYS if before.shard_for(key) != after.shard_for(key))
+
+
+def test_shard_pairs():
+    projects = ['a', 'b', 'c', 'd', 'e']
+    tags = ['ta', 'tb', 'tc', 'td', 'te']
+    assert shard_pairs(projects, tags, None) == list(zip(projects, tags))
+    slices = [shard_pairs(projects, tags, ShardSpec(index, 3)) for index in range(3)]
+    assert sorted(pair for pairs in slices for pair in pairs) == list(zip(projects, tags))
+
+
+def test_from_request_args():
+    assert ShardSpec.from_request_args({}) is None
+    assert ShardSpec.from_request_args({'shard': '0'}) is None
+    # A single shard is the same as no sharding:
+    assert ShardSpec.from_request_args({'shard': '0', 'shards': '1'}) is None
+    spec = ShardSpec.from_request_args({'shard': '2', 'shards': '4', 'round': 'r1'})
+    assert (spec.index, spec.count, spec.round_id) == (2, 4, 'r1')
+    assert spec.suffix() == 'shard-2-of-4'
+
+
+@pytest.mark.parametrize('index, count', [(4, 4), (-1, 4), (0, 0)])
+def test_bad_shards_are_rejected(index, count):
+    with pytest.raises(ValueError):
+        ShardSpec(index, count)
@@ -0,0 +1,65 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import pandas as pd
+from tasks.usage_rollups import compute_rollup, merge_rollup_sql
+
+
+def usage_frame():
+    return pd.DataFrame({
+        'time': pd.to_datetime(['2024-01-01 10:05', '2024-01-01 10:50', '2024-01-01 11:10', '2024-01-01 10:20'],
+                               utc=True),
+        'cs_bucket': ['b1', 'b1', 'b1', None],
+        'cs_operation': ['GET_Object', 'GET_Object', 'GET_Object', 'GET_Bucket'],
+        'sc_status': [200, 200, 200, 200],
+        'sc_bytes': [100, 50, 7, 1],
+        'cs_bytes': [1.0, None, 2.0, 3.0],
+        'c_ip': ['1.1.1.1', '1.1.1.1', '2.2.2.2', '3.3.3.3'],
+    })
+
+
+def test_hourly_rollup():
+    rollup = compute_rollup(usage_frame(), 'hourly').set_index(['period_start', 'cs_bucket']).sort_index()
+    ten = rollup.loc[(pd.Timestamp('2024-01-01 10:00', tz='UTC'), 'b1')]
+    assert ten['request_count'] == 2
+    assert ten['sc_bytes'] == 150
+    assert ten['cs_bytes'] == 1
+    assert list(ten['client_ips']) == ['1.1.1.1']
+    assert rollup.loc[(pd.Timestamp('2024-01-01 11:00', tz='UTC'), 'b1')]['request_count'] == 1
+    # Null buckets are stored as '' so the MERGE keys compare equal:
+    assert rollup.loc[(pd.Timestamp('2024-01-01 10:00', tz='UTC'), '')]['request_count'] == 1
+
+
+def test_daily_rollup():
+    rollup = compute_rollup(usage_frame(), 'daily')
+    b1 = rollup[rollup['cs_bucket'] == 'b1'].iloc[0]
+    assert b1['period_start'] == pd.Timestamp('2024-01-01', tz='UTC')
+    assert b1['request_count'] == 3
+    assert sorted(b1['client_ips']) == ['1.1.1.1', '2.2.2.2']
+    assert rollup['request_count'].sum() == 4
+
+
+def test_merge_picks_its_batch_inside_the_transaction():
+    sql = merge_rollup_sql('p.d.rollup_hourly', 'p.d.pending', 'p.d.applied', 'hourly')
+    begin = sql.index('BEGIN TRANSACTION')
+    commit = sql.index('COMMIT TRANSACTION')
+    # The batch is picked, and checked against the ledger, after BEGIN, and the ledger insert is committed
+    # with the MERGE:
+    assert begin < sql.index('CREATE TEMP TABLE batch') < sql.index('MERGE `p.d.rollup_hourly`') < commit
+    assert begin < sql.index('INSERT INTO `p.d.applied`') < commit
+    assert sql.index('DELETE FROM `p.d.pending`') > commit